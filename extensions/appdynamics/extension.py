@@ -24,6 +24,9 @@ import re
 
 _log = logging.getLogger('appdynamics')
 
+REQUIRES = ()
+PROVIDES = ('appdynamics',)
+
 class AppDynamicsInstaller(PHPExtensionHelper):
     _detected = None                # Boolean to check if AppDynamics service is detected
     _FILTER = "app[-]?dynamics"
@@ -156,6 +159,9 @@ class AppDynamicsInstaller(PHPExtensionHelper):
             print("Error populating app, tier and node names from AppDynamics service")
 
 
+    def _prefetch(self):
+        return (self._ctx['APPDYNAMICS_DOWNLOAD_URL'],)
+
     # 2
     def _compile(self, install):
         """
@@ -26,12 +26,16 @@ import StringIO
 from build_pack_utils import utils
 from build_pack_utils import stream_output
 from extension_helpers import ExtensionHelper
+from compile_helpers import php_extension_filter
 
 from build_pack_utils.compile_extensions import CompileExtensions
 
 
 _log = logging.getLogger('composer')
 
+REQUIRES = ('php', 'php.ini')
+PROVIDES = ('php', 'composer')
+
 
 def find_composer_paths(ctx):
     build_dir = ctx['BUILD_DIR']
@@ -169,7 +173,7 @@ class ComposerExtension(ExtensionHelper):
     def _defaults(self):
         manifest_file_path = os.path.join(self._ctx["BP_DIR"], "manifest.yml")
 
-        compile_ext = CompileExtensions(self._ctx["BP_DIR"])
+        compile_ext = CompileExtensions.for_context(self._ctx)
         _, default_version = compile_ext.default_version_for(manifest_file_path=manifest_file_path, dependency="composer")
 
         return {
@@ -188,6 +192,11 @@ class ComposerExtension(ExtensionHelper):
             find_composer_paths(self._ctx)
         return (json_path is not None or lock_path is not None)
 
+    def _prefetch(self):
+        if self._ctx['COMPOSER_VERSION'] == 'latest':
+            return ()
+        return (self._ctx['COMPOSER_DOWNLOAD_URL'],)
+
     def _compile(self, install):
         self._builder = install.builder
         self.composer_runner = ComposerCommandRunner(self._ctx, self._builder)
@@ -209,7 +218,9 @@ class ComposerExtension(ExtensionHelper):
                 .done())
 
     def install(self):
-        self._builder.install().package('PHP').done()
+        # same files as the PHP extension, see PHP_SELECTIVE_EXTRACTION
+        self._builder.install().package(
+            'PHP', php_extension_filter(self._ctx)).done()
         if self._ctx['COMPOSER_VERSION'] == 'latest':
             dependencies_path = os.path.join(self._ctx['BP_DIR'],
                                              'dependencies')
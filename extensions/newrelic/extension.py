@@ -23,6 +23,9 @@ from build_pack_utils.compile_extensions import CompileExtensions
 
 _log = logging.getLogger('newrelic')
 
+REQUIRES = ('php.ini',)
+PROVIDES = ('php.ini', 'newrelic')
+
 DEFAULTS = {
     'NEWRELIC_HOST': 'download.newrelic.com',
     'NEWRELIC_PACKAGE': 'newrelic-php5-{NEWRELIC_VERSION}-linux.tar.gz',
@@ -54,7 +57,7 @@ class NewRelicInstaller(object):
                                 "NewRelic will not be available.")
 
     def _set_default_version(self, manifest_file):
-        compile_exts = CompileExtensions(self._ctx['BP_DIR'])
+        compile_exts = CompileExtensions.for_context(self._ctx)
 
         exit_code, output = compile_exts.default_version_for(manifest_file, "newrelic")
         if exit_code == 1:
@@ -178,6 +181,27 @@ def service_environment(ctx):
     return {}
 
 
+def prefetch(ctx):
+    """The agent can only be prefetched when a license key is set,
+    detection needs PHP to be installed"""
+    services = ctx.get('VCAP_SERVICES', {}).get('newrelic', [])
+    licensed = (len(services) > 0 and
+                services[0].get('credentials', {}).get('licenseKey'))
+    if ctx.get('PHP_VM') != 'php' or \
+            not (licensed or 'NEWRELIC_LICENSE' in ctx.keys()):
+        return ()
+    compile_exts = CompileExtensions.for_context(ctx)
+    exit_code, version = compile_exts.default_version_for(
+        os.path.join(ctx['BP_DIR'], 'manifest.yml'), 'newrelic')
+    if exit_code != 0:
+        return ()
+    ctx['NEWRELIC_VERSION'] = version
+    for key, val in DEFAULTS.iteritems():
+        if key not in ctx:
+            ctx[key] = val
+    return (ctx['NEWRELIC_DOWNLOAD_URL'],)
+
+
 def compile(install):
     newrelic = NewRelicInstaller(install.builder._ctx)
     if newrelic.should_install():
@@ -18,6 +18,9 @@ Configures redis or memcached for session sharing
 """
 from extension_helpers import PHPExtensionHelper
 
+REQUIRES = ('php.ini',)
+PROVIDES = ('php.ini',)
+
 
 class BaseSetup(object):
     def __init__(self, ctx, info):
@@ -13,6 +13,9 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+REQUIRES = ()
+PROVIDES = ()
+
 
 def preprocess_commands(ctx):
     preprocs = ctx.get('ADDITIONAL_PREPROCESS_CMDS', [])
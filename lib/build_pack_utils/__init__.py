@@ -9,4 +9,5 @@ from process import ProcessManager
 from runner import BuildPack
 from runner import check_output
 from runner import stream_output
+from profiler import StagingProfiler
 import utils
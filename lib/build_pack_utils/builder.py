@@ -1,5 +1,6 @@
 import os
 import sys
+import time
 import shutil
 import re
 import logging
@@ -9,6 +10,7 @@ from subprocess import Popen
 from subprocess import PIPE
 from cloudfoundry import CloudFoundryUtil
 from cloudfoundry import CloudFoundryInstaller
+from downloads import Prefetcher
 from detecter import TextFileSearch
 from detecter import ComposerJsonSearch
 from detecter import RegexFileSearch
@@ -22,14 +24,48 @@ from detecter import StartsWithFileSearch
 from detecter import EndsWithFileSearch
 from detecter import ContainsFileSearch
 from runner import BuildPack
+from runner import stream_process
 from utils import rewrite_cfgs
-from utils import process_extension
-from utils import process_extensions
+from utils import find_extension_dependencies
+from utils import ExtensionRegistry
+from utils import FormattedDict
+from utils import safe_makedirs
+from utils import Materializer
+from profiler import StagingProfiler
+from workers import WorkerPool
+from workers import run_with_dependencies
 
 
 _log = logging.getLogger('builder')
 
 
+def _profiler_for(builder):
+    profiler = getattr(builder, '_profiler', None)
+    if profiler is None:
+        profiler = StagingProfiler()
+    return profiler
+
+
+def _registry_for(builder):
+    extn_reg = getattr(builder, '_extn_reg', None)
+    if extn_reg is None:
+        return ExtensionRegistry()
+    return extn_reg.registry
+
+
+def _process_extension(builder, path, to_call, success, args=None,
+                       ignore=False, parent=None):
+    with _profiler_for(builder).measure(
+            '%s:%s' % (to_call, os.path.basename(path)), parent):
+        _registry_for(builder).call(path, builder._ctx, to_call, success,
+                                    args, ignore)
+
+
+def _process_extensions(builder, to_call, success, args=None, ignore=False):
+    for path in builder._ctx['EXTENSIONS']:
+        _process_extension(builder, path, to_call, success, args, ignore)
+
+
 def log_output(cmd, retcode, stdout, stderr):
     _log.info('Comand %s completed with [%d]', str(cmd), retcode)
     if stdout:
@@ -43,6 +79,7 @@ def log_output(cmd, retcode, stdout, stderr):
 class Configurer(object):
     def __init__(self, builder):
         self.builder = builder
+        self._span = _profiler_for(builder).start('configure')
 
     def default_config(self):
         self._merge(
@@ -76,6 +113,7 @@ class Configurer(object):
         return self
 
     def done(self):
+        _profiler_for(self.builder).stop(self._span)
         return self.builder
 
     def _merge(self, ctx):
@@ -175,13 +213,24 @@ class Installer(object):
     def __init__(self, builder):
         self.builder = builder
         self._log = _log
+        self._span = _profiler_for(builder).start('install')
         self._installer = CloudFoundryInstaller(self.builder._ctx)
 
-    def package(self, key):
+    def package(self, key, include=None):
+        """Install a package.  With `include`, a `zips.MemberFilter`,
+        only part of it is extracted and the paths in the archive are
+        saved as `<key>_ARCHIVE_INDEX`."""
         if key in self.builder._ctx.keys():
             key = self.builder._ctx[key]
-        self.builder._ctx['%s_INSTALL_PATH' % key] = \
-            self._installer.install_binary(key)
+        with _profiler_for(self.builder).measure('package:%s' % key):
+            if include is None:
+                self.builder._ctx['%s_INSTALL_PATH' % key] = \
+                    self._installer.install_binary(key)
+            else:
+                index = []
+                self.builder._ctx['%s_INSTALL_PATH' % key] = \
+                    self._installer.install_binary(key, include, index)
+                self.builder._ctx['%s_ARCHIVE_INDEX' % key] = index
         self._log.info("Installed [%s] to [%s]", key,
                        self.builder._ctx['%s_INSTALL_PATH' % key])
         return self
@@ -198,14 +247,38 @@ class Installer(object):
         return ConfigInstaller(self)
 
     def extensions(self):
+        """Call the `compile` method of every registered extension.
+
+        With EXTENSIONS_PARALLELISM above 1, which is opt in, up to that
+        many run at the same time.  The methods share the context and
+        their output, so an extension must list in `REQUIRES` the
+        resources it uses and in `PROVIDES` the ones it changes.  It
+        waits for the extensions registered before it that change what
+        it uses or uses what it changes.  Nothing checks the lists, and
+        extensions without them run on their own in registration order.
+        """
         ctx = self.builder._ctx
         extn_reg = self.builder._extn_reg
 
         def process(retcode):
             if retcode != 0:
                 raise RuntimeError('Extension Failed with [%s]' % retcode)
-        for path in extn_reg._paths:
-            process_extension(path, ctx, 'compile', process, args=[self])
+
+        def run_compile(path):
+            _process_extension(self.builder, path, 'compile', process,
+                               args=[self], parent=self._span.name)
+        parallelism = int(ctx.get('EXTENSIONS_PARALLELISM', 1))
+        if parallelism > 1:
+            self._log.debug('Running extensions with parallelism [%d]',
+                            parallelism)
+            deps = find_extension_dependencies(extn_reg._paths,
+                                               load=extn_reg.registry.load)
+            with WorkerPool(parallelism) as pool:
+                run_with_dependencies(pool, extn_reg._paths, deps,
+                                      run_compile)
+        else:
+            for path in extn_reg._paths:
+                run_compile(path)
         ctx['EXTENSIONS'].extend(extn_reg._paths)
         return self
 
@@ -221,6 +294,7 @@ class Installer(object):
         return BuildPackManager(self)
 
     def done(self):
+        _profiler_for(self.builder).stop(self._span)
         return self.builder
 
 
@@ -228,6 +302,7 @@ class Register(object):
     def __init__(self, builder):
         self._builder = builder
         self._builder._extn_reg = ExtensionRegister(builder, self)
+        self._span = _profiler_for(builder).start('register')
 
     def extension(self):
         return self._builder._extn_reg
@@ -239,7 +314,8 @@ class Register(object):
         def process(resp):
             pass  # ignore result, don't care
         for extn in self._builder._extn_reg._paths:
-            process_extension(extn, self._builder._ctx, 'configure', process)
+            _process_extension(self._builder, extn, 'configure', process)
+        _profiler_for(self._builder).stop(self._span)
         return self._builder
 
 
@@ -305,23 +381,32 @@ class ModuleInstaller(object):
         self._modules = list(set(self._modules))
         return self
 
+    def _install_module(self, module, toPath, strip):
+        try:
+            # resolve the url against a copy of the context, so modules
+            #  can be installed at the same time
+            ctx = FormattedDict(self._ctx)
+            ctx['MODULE_NAME'] = module
+            url = ctx['%s_MODULES_PATTERN' % self._moduleKey]
+            self._cf._install_binary_from_manifest(url, toPath,
+                                                   strip=strip)
+        except Exception:
+            self._log.warning('Module %s failed to install', module)
+            self._log.debug('Module %s failed to install because',
+                            module, exc_info=True)
+
     def done(self):
         toPath = os.path.join(self._ctx['BUILD_DIR'],
                               self._moduleKey.lower())
         strip = self._ctx.get('%s_MODULES_STRIP' % self._moduleKey, False)
-        for module in set(self._modules):
-            try:
-                self._ctx['MODULE_NAME'] = module
-                url = self._ctx['%s_MODULES_PATTERN' % self._moduleKey]
-                self._cf._install_binary_from_manifest(url, toPath,
-                                               strip=strip)
-            except Exception:
-                self._log.warning('Module %s failed to install', module)
-                self._log.debug('Module %s failed to install because',
-                                module, exc_info=True)
-            finally:
-                if 'MODULE_NAME' in self._ctx.keys():
-                    del self._ctx['MODULE_NAME']
+        parallelism = int(self._ctx.get(
+            '%s_MODULES_PARALLELISM' % self._moduleKey, 1))
+        self._log.debug('Installing [%d] modules with parallelism [%d]',
+                        len(set(self._modules)), parallelism)
+        with WorkerPool(parallelism) as pool:
+            pool.map(lambda module: self._install_module(module, toPath,
+                                                         strip),
+                     set(self._modules))
         return self._installer
 
 
@@ -331,6 +416,7 @@ class ExtensionRegister(object):
         self._ctx = builder._ctx
         self._paths = []
         self._reg = reg
+        self.registry = ExtensionRegistry()
 
     def from_build_pack(self, path):
         return self.from_path(os.path.join(self._ctx['BP_DIR'], path))
@@ -342,12 +428,16 @@ class ExtensionRegister(object):
         path = self._ctx.format(path)
         if os.path.exists(path):
             if os.path.exists(os.path.join(path, 'extension.py')):
-                self._paths.append(os.path.abspath(path))
+                self._add(os.path.abspath(path))
             else:
                 for p in os.listdir(path):
-                    self._paths.append(os.path.abspath(os.path.join(path, p)))
+                    self._add(os.path.abspath(os.path.join(path, p)))
         return self._reg
 
+    def _add(self, path):
+        self._paths.append(path)
+        self.registry.register(path)
+
 
 class ConfigInstaller(object):
     def __init__(self, installer):
@@ -386,56 +476,101 @@ class ConfigInstaller(object):
 
     def done(self):
         if (self._bp_path or self._app_path) and self._to_path:
+            # config files are changed in place, always copy them
             if self._bp_path:
                 self._cfInst.install_from_build_pack(self._bp_path,
-                                                     self._to_path)
+                                                     self._to_path,
+                                                     strategy='copy')
             if self._app_path:
                 self._cfInst.install_from_application(self._app_path,
-                                                      self._to_path)
+                                                      self._to_path,
+                                                      strategy='copy')
         if self._delimiter:
             self._rewrite_cfgs()
         return self._installer
 
 
 class Runner(object):
-    def __init__(self, builder):
+    def __init__(self, builder, group=None):
         self._builder = builder
+        self._group = group
         self._path = os.getcwd()
         self._shell = False
         self._cmd = []
         self._on_finish = None
         self._on_success = None
         self._on_fail = None
+        self._on_chunk = None
+        self._on_line = None
+        self._tee_path = None
+        self._retain = None
         self._env = os.environ.copy()
         self._log = _log
+        self._span = None
+        if group is None:
+            self._span = _profiler_for(builder).start('run')
+
+    def _streaming(self):
+        return (self._on_chunk or self._on_line or self._tee_path or
+                self._retain is not None)
+
+    def _popen(self):
+        return Popen(self._cmd, stdout=PIPE, env=self._env,
+                     stderr=PIPE, shell=self._shell, cwd=self._path)
+
+    def _stream(self):
+        tee = None
+        if self._tee_path:
+            safe_makedirs(os.path.dirname(self._tee_path))
+            tee = open(self._tee_path, 'wb')
+        try:
+            proc = self._popen()
+            try:
+                stdout, stderr = stream_process(proc,
+                                                on_chunk=self._on_chunk,
+                                                on_line=self._on_line,
+                                                tee=tee,
+                                                retain=self._retain)
+            finally:
+                proc.wait()
+        finally:
+            if tee is not None:
+                tee.close()
+        return proc, stdout, stderr
 
-    def done(self):
+    def _run(self):
+        """Run the command, returns the exit code or None if not run"""
+        retcode = None
         if os.path.exists(self._path):
-            cwd = os.getcwd()
-            try:
-                self._log.debug('Running [%s] from [%s] with shell [%s]',
-                                self._cmd, self._path, self._shell)
-                self._log.debug('Running with env [%s]', self._env)
-                os.chdir(self._path)
-                proc = Popen(self._cmd, stdout=PIPE, env=self._env,
-                             stderr=PIPE, shell=self._shell)
+            self._log.debug('Running [%s] from [%s] with shell [%s]',
+                            self._cmd, self._path, self._shell)
+            self._log.debug('Running with env [%s]', self._env)
+            if self._streaming():
+                proc, stdout, stderr = self._stream()
+            else:
+                proc = self._popen()
                 stdout, stderr = proc.communicate()
-                retcode = proc.poll()
-                self._log.debug("Command completed with [%s]", retcode)
-                if self._on_finish:
-                    self._on_finish(self._cmd, retcode, stdout, stderr)
-                else:
-                    if retcode == 0 and self._on_success:
-                        self._on_success(self._cmd, retcode, stdout)
-                    elif retcode != 0 and self._on_fail:
-                        self._on_fail(self._cmd, retcode, stderr)
-                    elif retcode != 0:
-                        self._log.error(
-                            'Command [%s] failed with [%d], add an '
-                            '"on_fail" or "on_finish" method to debug '
-                            'further', self._cmd, retcode)
-            finally:
-                os.chdir(cwd)
+            retcode = proc.poll()
+            self._log.debug("Command completed with [%s]", retcode)
+            if self._on_finish:
+                self._on_finish(self._cmd, retcode, stdout, stderr)
+            else:
+                if retcode == 0 and self._on_success:
+                    self._on_success(self._cmd, retcode, stdout)
+                elif retcode != 0 and self._on_fail:
+                    self._on_fail(self._cmd, retcode, stderr)
+                elif retcode != 0:
+                    self._log.error(
+                        'Command [%s] failed with [%d], add an '
+                        '"on_fail" or "on_finish" method to debug '
+                        'further', self._cmd, retcode)
+        return retcode
+
+    def done(self):
+        if self._group is not None:
+            return self._group._add(self)
+        self._run()
+        _profiler_for(self._builder).stop(self._span)
         return self._builder
 
     def environment_variable(self):
@@ -482,6 +617,94 @@ class Runner(object):
             self._on_finish = on_finish
         return self
 
+    def on_chunk(self, on_chunk):
+        """Call `on_chunk(stream, data)` with output as it's read"""
+        if hasattr(on_chunk, '__call__'):
+            self._on_chunk = on_chunk
+        return self
+
+    def on_line(self, on_line):
+        """Call `on_line(stream, line)` with each line of output"""
+        if hasattr(on_line, '__call__'):
+            self._on_line = on_line
+        return self
+
+    def tee_to(self, path):
+        """Write the stdout and stderr of the command to a file"""
+        if hasattr(path, '__call__'):
+            self._tee_path = path(self._builder._ctx)
+        elif path in self._builder._ctx.keys():
+            self._tee_path = self._builder._ctx[path]
+        else:
+            self._tee_path = self._builder._ctx.format(path)
+        return self
+
+    def retain(self, max_bytes):
+        """Keep only the last `max_bytes` of stdout and of stderr"""
+        self._retain = max_bytes
+        return self
+
+
+class RunnerGroup(object):
+    """Runs a group of independent commands at the same time.
+
+    Each command is set up with `run()`, like `Builder.run()`, and
+    `Runner.done()` adds it to the group.  `done()` runs them, up to
+    `parallelism` at once, then passes a list with the command, the
+    exit code and the duration of each to the `on_finish` callback.
+    """
+    def __init__(self, builder):
+        self._builder = builder
+        self._runners = []
+        self._parallelism = int(
+            builder._ctx.get('RUNNER_PARALLELISM', 4))
+        self._on_finish = None
+        self._log = _log
+        self.results = []
+
+    def run(self):
+        return Runner(self._builder, group=self)
+
+    def _add(self, runner):
+        self._runners.append(runner)
+        return self
+
+    def parallelism(self, parallelism):
+        self._parallelism = int(parallelism)
+        return self
+
+    def on_finish(self, on_finish):
+        if hasattr(on_finish, '__call__'):
+            self._on_finish = on_finish
+        return self
+
+    def done(self):
+        profiler = _profiler_for(self._builder)
+
+        def run(runner):
+            start = time.time()
+            with profiler.measure('run', parent='run-group'):
+                retcode = runner._run()
+            return {
+                'command': runner._cmd,
+                'cwd': runner._path,
+                'returncode': retcode,
+                'duration': time.time() - start
+            }
+        with profiler.measure('run-group'):
+            self._log.debug('Running [%d] commands with parallelism [%d]',
+                            len(self._runners), self._parallelism)
+            with WorkerPool(self._parallelism) as pool:
+                tasks = [pool.submit(run, runner)
+                         for runner in self._runners]
+            errors = [task.exc_info for task in tasks if task.exc_info]
+            if errors:
+                raise errors[0][0], errors[0][1], errors[0][2]
+            self.results = [task.result for task in tasks]
+        if self._on_finish:
+            self._on_finish(self.results)
+        return self._builder
+
 
 class RunnerEnvironmentVariableBuilder(object):
     def __init__(self, runner):
@@ -509,10 +732,122 @@ class Executor(object):
 
     def method(self, execute):
         if hasattr(execute, '__call__'):
-            execute(self.builder._ctx)
+            with _profiler_for(self.builder).measure(
+                    'execute:%s' % getattr(execute, '__name__', 'method')):
+                execute(self.builder._ctx)
         return self.builder
 
 
+# A single element of a simple regular expression, a literal character,
+#  an escaped character or '.'
+_REGEX_ATOM = re.compile(r'\\[^A-Za-z0-9]|[^\\\[\](){}|?*+^$]')
+
+
+def _prefix_verdict(regex):
+    """Build a function that judges every path under a directory.
+
+    Handles expressions like `^/some/path/.*$`, a simple prefix followed
+    by `.*`, and `^/some/file$`, a single path.  The returned function
+    is given the path to a directory and returns True when every path
+    under it matches, False when none can match and None if that's not
+    known.  Returns None if the expression is not of either form.
+    """
+    if regex.flags & ~(re.UNICODE | getattr(re, 'LOCALE', 0)):
+        return None
+    pattern = regex.pattern
+    if pattern.startswith('^'):
+        pattern = pattern[1:]
+    for suffix in ('.*$', '.*', '$'):
+        if pattern.endswith(suffix):
+            prefix = pattern[:-len(suffix)]
+            exact = (suffix == '$')
+            break
+    else:
+        return None
+    atoms = _REGEX_ATOM.findall(prefix)
+    if ''.join(atoms) != prefix:
+        return None
+
+    def verdict(dirPath):
+        start = dirPath + os.sep
+        for atom, ch in zip(atoms, start):
+            if atom == '.':
+                if ch == '\n':
+                    return False
+            elif atom[-1] != ch:
+                return False
+        if exact and len(atoms) < len(start):
+            # paths under the directory are all longer than the pattern
+            return False
+        if not exact and len(atoms) <= len(start):
+            # paths under the directory all start with the prefix
+            return True
+        return None
+    return verdict
+
+
+class _PathFilter(object):
+    """A FileUtil filter that can also judge whole directories.
+
+    Called with the full path of a file it returns True if the file
+    passes.  `subtree` is given the full path of a directory and
+    returns True or False when all of the files under it will pass or
+    fail, and None when each file has to be checked.
+    """
+    def __init__(self, test, subtree=None):
+        self._test = test
+        self._subtree = subtree
+
+    def __call__(self, path):
+        return self._test(path)
+
+    def subtree(self, dirPath):
+        if self._subtree:
+            return self._subtree(dirPath)
+
+
+class _SelectionPlan(object):
+    """The FileUtil filters that are still undecided for a directory.
+
+    Filters that already have an answer for a directory are dropped
+    from the plan of that directory, if the answer decides the match
+    the directory is either skipped or selected in full.
+    """
+    def __init__(self, filters, match):
+        self._filters = filters
+        self._match = match
+
+    def selects_all(self):
+        return self._match is all and not self._filters
+
+    def for_directory(self, dirPath):
+        """Return the plan for the directory or None to skip it"""
+        if self._match not in (all, any) or self.selects_all():
+            return self
+        left = []
+        for f in self._filters:
+            verdict = getattr(f, 'subtree', lambda p: None)(dirPath)
+            if verdict is None:
+                left.append(f)
+            elif verdict == (self._match is any):
+                # True with any_true or False with all_true decides it
+                return (self._match is any) and \
+                    _SelectionPlan([], all) or None
+        if not left and self._match is any:
+            return None
+        return _SelectionPlan(left, self._match)
+
+    def __call__(self, path):
+        if self._match in (all, any):
+            return self._match(f(path) for f in self._filters)
+        return self._match([f(path) for f in self._filters])
+
+
+def _negate(verdict):
+    if verdict is not None:
+        return not verdict
+
+
 class FileUtil(object):
     def __init__(self, builder, move=False):
         self._builder = builder
@@ -522,53 +857,61 @@ class FileUtil(object):
         self._into_path = None
         self._match = all
         self._log = _log
+        self._span = _profiler_for(builder).start(move and 'move' or 'copy')
 
     def everything(self):
-        self._filters.append((lambda path: True))
+        self._filters.append(_PathFilter(
+            lambda path: True,
+            lambda dirPath: True))
         return self
 
     def all_files(self):
-        self._filters.append(
-            lambda path: os.path.isfile(path))
+        self._filters.append(_PathFilter(
+            lambda path: os.path.isfile(path)))
         return self
 
     def hidden(self):
-        self._filters.append(
-            lambda path: path.startswith('.'))
+        self._filters.append(_PathFilter(
+            lambda path: path.startswith('.'),
+            lambda dirPath: dirPath.startswith('.')))
         return self
 
     def not_hidden(self):
-        self._filters.append(
-            lambda path: not path.startswith('.'))
+        self._filters.append(_PathFilter(
+            lambda path: not path.startswith('.'),
+            lambda dirPath: not dirPath.startswith('.')))
         return self
 
     def all_folders(self):
-        self._filters.append(
-            lambda path: os.path.isdir(path))
+        self._filters.append(_PathFilter(
+            lambda path: os.path.isdir(path)))
         return self
 
     def where_name_is(self, name):
-        self._filters.append(
-            lambda path: os.path.basename(path) == name)
+        self._filters.append(_PathFilter(
+            lambda path: os.path.basename(path) == name))
         return self
 
     def where_name_is_not(self, name):
-        self._filters.append(
-            lambda path: os.path.basename(path) != name)
+        self._filters.append(_PathFilter(
+            lambda path: os.path.basename(path) != name))
         return self
 
     def where_name_matches(self, pattern):
         if hasattr(pattern, 'strip'):
             pattern = re.compile(pattern)
-        self._filters.append(
-            lambda path: (pattern.match(path) is not None))
+        self._filters.append(_PathFilter(
+            lambda path: (pattern.match(path) is not None),
+            _prefix_verdict(pattern)))
         return self
 
     def where_name_does_not_match(self, pattern):
         if hasattr(pattern, 'strip'):
             pattern = re.compile(pattern)
-        self._filters.append(
-            lambda path: (pattern.match(path) is None))
+        verdict = _prefix_verdict(pattern)
+        self._filters.append(_PathFilter(
+            lambda path: (pattern.match(path) is None),
+            verdict and (lambda dirPath: _negate(verdict(dirPath)))))
         return self
 
     def all_true(self):
@@ -597,6 +940,54 @@ class FileUtil(object):
             self._into_path = os.path.join(self._from_path, self._into_path)
         return self
 
+    def _walk(self, top, plan):
+        """Walk the tree bottom up, like `os.walk(top, topdown=False)`.
+
+        Directories where the plan says no file can be selected are
+        not walked, in move mode directories where every file is
+        selected are renamed instead of walked.  Yields (root, dirs,
+        files, plan) for the rest.
+        """
+        try:
+            names = os.listdir(top)
+        except OSError:
+            return
+        dirs, files = [], []
+        for name in names:
+            if os.path.isdir(os.path.join(top, name)):
+                dirs.append(name)
+            else:
+                files.append(name)
+        for name in list(dirs):
+            path = os.path.join(top, name)
+            if not os.path.islink(path):
+                subplan = plan.for_directory(path)
+                if subplan is None:
+                    self._log.debug('Skipping [%s], no files match', path)
+                elif (self._move and subplan.selects_all() and
+                        self._rename(path)):
+                    dirs.remove(name)
+                else:
+                    for item in self._walk(path, subplan):
+                        yield item
+        yield top, dirs, files, plan
+
+    def _rename(self, src):
+        """Move a whole directory with one rename, if that's possible"""
+        dest = src.replace(self._from_path, self._into_path)
+        if os.path.lexists(dest) or \
+                (self._into_path + os.sep).startswith(src + os.sep):
+            return False
+        safe_makedirs(os.path.dirname(dest))
+        try:
+            os.rename(src, dest)
+        except OSError, e:
+            self._log.debug("Could not rename [%s] to [%s], moving "
+                            "files instead [%s]", src, dest, e)
+            return False
+        self._log.debug("Moved directory [%s] to [%s]", src, dest)
+        return True
+
     def _copy_or_move(self, src, dest):
         dest_base = os.path.dirname(dest)
         if not os.path.exists(dest_base):
@@ -606,7 +997,7 @@ class FileUtil(object):
             shutil.move(src, dest)
         else:
             self._log.debug("Copying [%s] to [%s]", src, dest)
-            shutil.copy(src, dest)
+            self._materialize(src, dest)
 
     def done(self):
         if self._from_path and self._into_path:
@@ -618,12 +1009,16 @@ class FileUtil(object):
             if not os.path.exists(self._from_path):
                 raise ValueError("Source path [%s] does not exist"
                                  % self._from_path)
-            for root, dirs, files in os.walk(self._from_path.decode('utf-8'),
-                                             topdown=False):
+            self._materialize = Materializer(
+                self._builder._ctx.get('FILE_MATERIALIZATION', 'copy'),
+                copy=shutil.copy)
+            plan = _SelectionPlan(list(self._filters), self._match)
+            for root, dirs, files, plan in self._walk(
+                    self._from_path.decode('utf-8'), plan):
                 for f in files:
                     fromPath = os.path.join(root, f)
                     toPath = fromPath.replace(self._from_path, self._into_path)
-                    if self._match([f(fromPath) for f in self._filters]):
+                    if plan(fromPath):
                         self._copy_or_move(fromPath, toPath)
                 if self._move:
                     for d in dirs:
@@ -633,6 +1028,10 @@ class FileUtil(object):
                                 "Cleaning up empty directory [%s]",
                                 dirPath)
                             os.rmdir(os.path.join(root, d))
+            if not self._move:
+                self._log.debug('Copied files with %s',
+                                self._materialize.summary())
+        _profiler_for(self._builder).stop(self._span)
         return self._builder
 
 
@@ -643,6 +1042,7 @@ class StartScriptBuilder(object):
         self._use_pm = False
         self._debug_console = False
         self._log = _log
+        self._span = _profiler_for(builder).start('create_start_script')
 
     def manual(self, cmd):
         self.content.append(cmd)
@@ -665,7 +1065,7 @@ class StartScriptBuilder(object):
         def process(cmds):
             for cmd in cmds:
                 self.content.append(' '.join(cmd))
-        process_extensions(self.builder._ctx, 'preprocess_commands', process)
+        _process_extensions(self.builder, 'preprocess_commands', process)
 
     def write(self, wait_forever=False):
         if os.path.exists(os.path.join(self.builder._ctx['BUILD_DIR'],
@@ -696,6 +1096,7 @@ class StartScriptBuilder(object):
             if self.content:
                 out.write('\n'.join(self.content))
         os.chmod(startScriptPath, 0755)
+        _profiler_for(self.builder).stop(self._span)
         return self.builder
 
 
@@ -839,6 +1240,7 @@ class BuildPackManager(object):
 class SaveBuilder(object):
     def __init__(self, builder):
         self._builder = builder
+        self._span = _profiler_for(builder).start('save')
 
     def runtime_environment(self):
         # run service_environment on all extensions, pool the results
@@ -852,7 +1254,7 @@ class SaveBuilder(object):
                     all_extns_env[key].extend(val)
                 else:
                     all_extns_env[key].append(val)
-        process_extensions(self._builder._ctx, 'service_environment', process)
+        _process_extensions(self._builder, 'service_environment', process)
         # Write pool of environment items to disk, a single item is
         #  written in 'key=val' format, while lists are written as
         #  'key=val:val:val' where ':' is os.pathsep.
@@ -878,7 +1280,106 @@ class SaveBuilder(object):
             with open(procPath, 'at') as procFile:
                 for name, cmd in cmds.iteritems():
                     procFile.write("%s: %s\n" % (name, ' '.join(cmd)))
-        process_extensions(self._builder._ctx, 'service_commands', process)
+        _process_extensions(self._builder, 'service_commands', process)
+        return self
+
+    def done(self):
+        _profiler_for(self._builder).stop(self._span)
+        return self._builder
+
+
+class PrefetchBuilder(object):
+    """Starts downloading the dependencies that will be installed.
+
+    Use this once the context is settled, after the extensions are
+    configured.  The downloads run in the background while staging
+    goes on, `Installer.package()` then waits only for its own.
+    """
+    def __init__(self, builder):
+        self._builder = builder
+        self._ctx = builder._ctx
+        self._urls = []
+        self._log = _log
+
+    def _add(self, urls):
+        for url in urls or ():
+            if url and url not in self._urls:
+                self._urls.append(url)
+
+    def package(self, key):
+        if key in self._ctx.keys():
+            key = self._ctx[key]
+        self._add([self._ctx.get('%s_DOWNLOAD_URL' % key)])
+        return self
+
+    def packages(self, *keys):
+        for key in keys:
+            self.package(key)
+        return self
+
+    def url(self, url):
+        self._add([self._ctx.format(url)])
+        return self
+
+    def extensions(self):
+        """Add the urls returned by the `prefetch` method of extensions.
+
+        Each is called with a copy of the context, so that guessing
+        what will be installed doesn't change the context.
+        """
+        for path in self._builder._extn_reg._paths:
+            _process_extension(self._builder, path, 'prefetch', self._add,
+                               args=[FormattedDict(self._ctx)], ignore=True)
+        return self
+
+    def done(self):
+        if int(self._ctx.get('PREFETCH_PARALLELISM', 4)) > 0:
+            self._log.info('Prefetching %s', self._urls)
+            CloudFoundryInstaller(self._ctx).prefetch(self._urls)
+        return self._builder
+
+    def shutdown(self):
+        """Stop the downloads started by `done`, once everything is
+        installed"""
+        Prefetcher.shutdown_dir(self._ctx['TMPDIR'])
+        return self._builder
+
+
+class StagingProfileBuilder(object):
+    def __init__(self, builder):
+        self._builder = builder
+        self._profiler = _profiler_for(builder)
+        self._log = _log
+
+    def to_json(self, path=None):
+        if path is None:
+            path = os.path.join(self._builder._ctx['BUILD_DIR'],
+                                '.bp', 'logs', 'staging-profile.json')
+        else:
+            path = self._builder._ctx.format(path)
+        self._log.info('Writing staging profile to [%s]', path)
+        self._profiler.write(path, extra={
+            'extensions': _registry_for(self._builder).timings()
+        })
+        return self
+
+    def context_journal(self, path=None):
+        """Write the changes made to the context, if they were recorded"""
+        journal = getattr(self._builder._ctx, 'journal', None)
+        if journal is not None:
+            if path is None:
+                path = os.path.join(self._builder._ctx['BUILD_DIR'],
+                                    '.bp', 'logs', 'context-journal.json')
+            else:
+                path = self._builder._ctx.format(path)
+            self._log.info('Writing context journal to [%s]', path)
+            journal.write(path)
+        return self
+
+    def summary(self, stream=sys.stdout):
+        stream.write('-----> Staging profile\n')
+        stream.write(self._profiler.summary())
+        stream.write('\n')
         return self
 
     def done(self):
@@ -935,10 +1436,12 @@ class Builder(object):
     def __init__(self):
         self._installer = None
         self._ctx = None
+        self._profiler = StagingProfiler()
 
     def configure(self):
+        configurer = Configurer(self)
         self._ctx = CloudFoundryUtil.initialize()
-        return Configurer(self)
+        return configurer
 
     def install(self):
         return Installer(self)
@@ -949,6 +1452,9 @@ class Builder(object):
     def run(self):
         return Runner(self)
 
+    def run_group(self):
+        return RunnerGroup(self)
+
     def execute(self):
         return Executor(self)
 
@@ -970,6 +1476,12 @@ class Builder(object):
     def save(self):
         return SaveBuilder(self)
 
+    def profile(self):
+        return StagingProfileBuilder(self)
+
+    def prefetch(self):
+        return PrefetchBuilder(self)
+
     def release(self):
         print 'default_process_types:'
         print '  web: $HOME/%s' % self._ctx.get('START_SCRIPT_NAME',
@@ -10,6 +10,9 @@ from urlparse import urlparse
 from zips import UnzipUtil
 from downloads import Downloader
 from downloads import CurlDownloader
+from downloads import DownloadCache
+from downloads import TreeCache
+from downloads import Prefetcher
 from utils import safe_makedirs
 from utils import find_git_url
 from utils import wrap
@@ -30,6 +33,8 @@ class CloudFoundryUtil(object):
              os.close(tmp_fd)
              sys.stdout = os.fdopen(fileno, "w", 0)
         ctx = utils.FormattedDict()
+        if os.environ.get('BP_DEBUG', False):
+            ctx.journal = utils.ContextJournal()
         # Add environment variables
         for key, val in os.environ.iteritems():
             ctx[key] = wrap(val)
@@ -60,8 +65,11 @@ class CloudFoundryUtil(object):
 
         # get default PHP, httpd, and nginx versions from manifest
         manifest_file = os.path.join(ctx['BP_DIR'], 'manifest.yml')
-        for dependency in ["php", "nginx", "httpd"]:
-            ctx = CloudFoundryUtil.update_default_version(dependency, manifest_file, ctx)
+        with CompileExtensions.for_context(ctx,
+                                           persistent=True) as compile_exts:
+            for dependency in ["php", "nginx", "httpd"]:
+                ctx = CloudFoundryUtil.update_default_version(
+                    dependency, manifest_file, ctx, compile_exts)
 
         # Git URL, if one exists
         ctx['BP_GIT_URL'] = find_git_url(ctx['BP_DIR'])
@@ -69,8 +77,10 @@ class CloudFoundryUtil(object):
         return ctx
 
     @staticmethod
-    def update_default_version(dependency, manifest_file, ctx):
-        compile_exts = CompileExtensions(ctx['BP_DIR'])
+    def update_default_version(dependency, manifest_file, ctx,
+                               compile_exts=None):
+        if compile_exts is None:
+            compile_exts = CompileExtensions.for_context(ctx)
 
         exit_code, output = compile_exts.default_version_for(manifest_file, dependency)
 
@@ -133,6 +143,107 @@ class CloudFoundryInstaller(object):
         self._ctx = ctx
         self._unzipUtil = UnzipUtil(ctx)
         self._dwn = self._get_downloader(ctx)(ctx)
+        self._cache = self._get_download_cache(ctx)
+        self._trees = self._get_tree_cache(ctx)
+
+    def _get_download_cache(self, ctx):
+        maxBytes = int(ctx.get('DOWNLOAD_CACHE_SIZE_MB', 0)) * 1024 * 1024
+        if ctx.get('CACHE_DIR') and maxBytes > 0:
+            return DownloadCache(ctx['CACHE_DIR'], maxBytes)
+        return None
+
+    def _get_tree_cache(self, ctx):
+        maxBytes = int(ctx.get('TREE_CACHE_SIZE_MB', 0)) * 1024 * 1024
+        if ctx.get('CACHE_DIR') and maxBytes > 0:
+            return TreeCache(ctx['CACHE_DIR'], maxBytes)
+        return None
+
+    def _tree_key(self, fileName, strip, archive_key, include=None):
+        """The tree cache key for an archive, None to extract it"""
+        if self._trees is None or \
+                not self._unzipUtil.can_extract_tree(fileName):
+            return None
+        key = archive_key()
+        if key and include is not None:
+            key = '%s\0%s' % (key, include.key())
+        return key and TreeCache.key_for(key, strip)
+
+    def _install_tree(self, treeKey, installDir, index=None):
+        """Put a tree from the cache into installDir, False if missing"""
+        if treeKey is None or not self._trees.materialize(treeKey,
+                                                          installDir,
+                                                          index):
+            return False
+        print 'Using extracted [%s]' % os.path.basename(installDir)
+        self._log.debug('Tree cache stats [%s]', self._trees.stats())
+        return True
+
+    def _extract_tree(self, treeKey, installDir, extract, index=None):
+        """Call `extract(path)`, through the tree cache when it's used"""
+        if treeKey is None:
+            return extract(installDir)
+        return (self._trees.add(treeKey, installDir, extract, index) and
+                installDir)
+
+    def _extract_verified(self, installDir, extract):
+        """Call `extract(path)` with a new directory and only move what
+        it extracted into installDir when it succeeds, so a download
+        that fails its digest check leaves nothing behind"""
+        parent = os.path.dirname(installDir)
+        safe_makedirs(parent)
+        tmpPath = tempfile.mkdtemp(dir=parent, prefix='.extract-')
+        # it becomes installDir when that's missing
+        os.chmod(tmpPath, 0755)
+        try:
+            if not extract(tmpPath):
+                return False
+            if os.path.isdir(installDir):
+                utils.link_tree(tmpPath, installDir)
+            else:
+                os.rename(tmpPath, installDir)
+        finally:
+            if os.path.exists(tmpPath):
+                # extracted directories can be read only
+                for root, dirs, files in os.walk(tmpPath):
+                    for name in dirs:
+                        os.chmod(os.path.join(root, name), 0700)
+                shutil.rmtree(tmpPath, ignore_errors=True)
+        return installDir
+
+    def _download_cached(self, key, fileToInstall, download):
+        """Get a file from the download cache or download it"""
+        if self._cache is None or key is None:
+            return download()
+        if self._cache.fetch(key, fileToInstall):
+            print 'Using cached [%s]' % os.path.basename(fileToInstall)
+            self._log.debug('Digests checked when [%s] was downloaded [%s]',
+                            fileToInstall, self._cache.digests(key))
+        else:
+            download()
+            verified = getattr(self._dwn, 'verified_digests', None)
+            self._cache.store(key, fileToInstall,
+                              verified and verified(fileToInstall))
+        self._log.debug('Download cache stats [%s]', self._cache.stats())
+
+    def _manifest_cache_key(self, url, compile_exts):
+        try:
+            exit_code, uri = compile_exts.translate_dependency_url(url)
+        except OSError, e:
+            self._log.debug("Can't translate [%s] [%s]", url, e)
+            return None
+        if exit_code != 0:
+            return None
+        return DownloadCache.key_for(uri, compile_exts.md5_for(url))
+
+    def _manifest_key(self, url):
+        with CompileExtensions.for_context(self._ctx) as compile_exts:
+            return self._manifest_cache_key(url, compile_exts)
+
+    def download_cache_stats(self):
+        return self._cache and self._cache.stats() or {}
+
+    def tree_cache_stats(self):
+        return self._trees and self._trees.stats() or {}
 
     def _get_downloader(self, ctx):
         method = ctx.get('DOWNLOAD_METHOD', 'python')
@@ -164,6 +275,18 @@ class CloudFoundryInstaller(object):
     def _is_url(self, val):
         return urlparse(val).scheme != ''
 
+    def _streams(self, fileName):
+        """Should `fileName` be extracted as it downloads"""
+        return (self._ctx.get('DOWNLOAD_EXTRACT_PIPELINE', False) and
+                hasattr(self._dwn, 'stream') and
+                self._unzipUtil.can_stream(fileName))
+
+    def _extract_while_downloading(self, fileName, installDir, strip,
+                                   include=None, index=None):
+        return lambda stream, on_chunk: self._unzipUtil.extract_stream(
+            stream, fileName, installDir, strip, on_chunk,
+            include=include, index=index)
+
     def install_binary_direct(self, url, hsh, installDir,
             fileName=None, strip=False,
             extract=True):
@@ -173,34 +296,115 @@ class CloudFoundryInstaller(object):
         fileToInstall = os.path.join(self._ctx['TMPDIR'], fileName)
 
         self._log.debug("Installing direct [%s]", url)
-        self._dwn.custom_extension_download(url, url, fileToInstall)
+        treeKey = None
+        if extract:
+            treeKey = self._tree_key(
+                fileName, strip,
+                lambda: hsh and DownloadCache.key_for(url, hsh))
+            if self._install_tree(treeKey, installDir):
+                return installDir
+        if extract and self._streams(fileName):
+            self._extract_tree(
+                treeKey, installDir,
+                lambda path: self._dwn.custom_extension_stream(
+                    url, url,
+                    self._extract_while_downloading(fileName, path, strip)))
+            return installDir
+        self._download_cached(
+            hsh and DownloadCache.key_for(url, hsh),
+            fileToInstall,
+            lambda: self._dwn.custom_extension_download(url, url,
+                                                        fileToInstall))
 
         if extract:
-            return self._unzipUtil.extract(fileToInstall,
-                    installDir,
-                    strip)
+            return self._extract_tree(
+                treeKey, installDir,
+                lambda path: self._unzipUtil.extract(fileToInstall,
+                                                     path,
+                                                     strip))
         else:
             shutil.copy(fileToInstall, installDir)
             return installDir
 
+    def _download_from_manifest(self, url):
+        fileName = urlparse(url).path.split('/')[-1]
+        fileToInstall = os.path.join(self._ctx['TMPDIR'], fileName)
+
+        key = None
+        if self._cache is not None:
+            key = self._manifest_key(url)
+        self._download_cached(
+            key,
+            fileToInstall,
+            lambda: self._dwn.download(url, self._ctx['TMPDIR']))
+        return fileToInstall
+
+    def _prefetcher(self):
+        return Prefetcher.for_dir(
+            self._ctx['TMPDIR'],
+            int(self._ctx.get('PREFETCH_PARALLELISM', 4)))
+
+    def prefetch(self, urls):
+        """Start downloading dependencies from the manifest in the
+        background, `_install_binary_from_manifest` waits for them"""
+        prefetcher = self._prefetcher()
+        for url in urls:
+            prefetcher.submit(
+                url, lambda url=url: self._download_from_manifest(url))
+        return prefetcher
+
     def _install_binary_from_manifest(self, url, installDir,
             strip=False,
-            extract=True):
+            extract=True,
+            include=None,
+            index=None):
+        """Install a dependency from the manifest.
+
+        When extracting a tar archive, only the members `include`
+        returns True for are extracted and the path of every member is
+        appended to `index`, see `UnzipUtil.extract`.
+        """
         self._log.debug("Installing binary from manifest [%s]", url)
-        self._dwn.download(url, self._ctx['TMPDIR'])
-
         fileName = urlparse(url).path.split('/')[-1]
-        fileToInstall = os.path.join(self._ctx['TMPDIR'], fileName)
+        treeKey = None
+        if extract:
+            treeKey = self._tree_key(fileName, strip,
+                                     lambda: self._manifest_key(url),
+                                     include)
+            if self._install_tree(treeKey, installDir, index):
+                return installDir
+        fileToInstall = self._prefetcher().wait_for(url)
+        if fileToInstall is None and extract and self._streams(fileName):
+            stream = lambda path: self._dwn.stream(
+                url, self._extract_while_downloading(
+                    fileName, path, strip, include, index))
+            if treeKey is None:
+                streamed = self._extract_verified(installDir, stream)
+            else:
+                streamed = self._extract_tree(treeKey, installDir, stream,
+                                              index)
+            if streamed:
+                return installDir
+            if index is not None:
+                # it wasn't streamed, start over from the file
+                del index[:]
+        if fileToInstall is None:
+            fileToInstall = self._download_from_manifest(url)
 
         if extract:
-            return self._unzipUtil.extract(fileToInstall,
-                    installDir,
-                    strip)
+            return self._extract_tree(
+                treeKey, installDir,
+                lambda path: self._unzipUtil.extract(fileToInstall,
+                                                     path,
+                                                     strip,
+                                                     include=include,
+                                                     index=index),
+                index)
         else:
             shutil.copy(fileToInstall, installDir)
             return installDir
 
-    def install_binary(self, installKey):
+    def install_binary(self, installKey, include=None, index=None):
         self._log.debug('Installing [%s]', installKey)
         url = self._ctx['%s_DOWNLOAD_URL' % installKey]
 
@@ -211,9 +415,10 @@ class CloudFoundryInstaller(object):
         strip = self._ctx.get('%s_STRIP' % installKey, False)
 
         return self._install_binary_from_manifest(url, installDir,
-                strip=strip)
+                strip=strip, include=include, index=index)
 
-    def _install_from(self, fromPath, fromLoc, toLocation=None, ignore=None):
+    def _install_from(self, fromPath, fromLoc, toLocation=None, ignore=None,
+                      strategy=None):
         """Copy file or directory from a location to the droplet
 
         Copies a file or directory from a location to the application
@@ -228,6 +433,8 @@ class CloudFoundryInstaller(object):
                           uses fromPath.
             ignore     -> an optional callable that is passed to
                           the ignore argument of shutil.copytree.
+            strategy   -> optional `utils.Materializer` strategy, if
+                          not specified uses FILE_MATERIALIZATION.
         """
         self._log.debug("Install file [%s] from [%s]", fromPath, fromLoc)
         fullPathFrom = os.path.join(fromLoc, fromPath)
@@ -237,12 +444,20 @@ class CloudFoundryInstaller(object):
                 ((toLocation is None) and fromPath or toLocation))
             safe_makedirs(os.path.dirname(fullPathTo))
             self._log.debug("Copying [%s] to [%s]", fullPathFrom, fullPathTo)
+            strategy = strategy or self._ctx.get('FILE_MATERIALIZATION',
+                                                 'copy')
             if os.path.isfile(fullPathFrom):
-                shutil.copy(fullPathFrom, fullPathTo)
+                materialize = utils.Materializer(strategy, copy=shutil.copy)
+                materialize(fullPathFrom, fullPathTo)
             else:
-                utils.copytree(fullPathFrom, fullPathTo, ignore=ignore)
-
-    def install_from_build_pack(self, fromPath, toLocation=None, ignore=None):
+                materialize = utils.Materializer(strategy)
+                utils.copytree(fullPathFrom, fullPathTo, ignore=ignore,
+                               copy_function=materialize)
+            self._log.debug("Copied [%s] to [%s] with %s", fullPathFrom,
+                            fullPathTo, materialize.summary())
+
+    def install_from_build_pack(self, fromPath, toLocation=None, ignore=None,
+                                strategy=None):
         """Copy file or directory from the build pack to the droplet
 
         Copies a file or directory from the build pack to the application
@@ -255,14 +470,17 @@ class CloudFoundryInstaller(object):
                           uses fromPath.
             ignore     -> an optional callable that is passed to
                           the ignore argument of shutil.copytree.
+            strategy   -> optional `utils.Materializer` strategy
         """
         self._install_from(
             fromPath,
             self._ctx['BP_DIR'],
             toLocation,
-            ignore)
+            ignore,
+            strategy)
 
-    def install_from_application(self, fromPath, toLocation, ignore=None):
+    def install_from_application(self, fromPath, toLocation, ignore=None,
+                                 strategy=None):
         """Copy file or directory from one place to another in the application
 
         Copies a file or directory from one place to another place within the
@@ -274,9 +492,11 @@ class CloudFoundryInstaller(object):
                           relative to app droplet.
             ignore     -> optional callable that is passed to the
                           ignore argument of shutil.copytree
+            strategy   -> optional `utils.Materializer` strategy
         """
         self._install_from(
             fromPath,
             self._ctx['BUILD_DIR'],
             toLocation,
-            ignore)
+            ignore,
+            strategy)
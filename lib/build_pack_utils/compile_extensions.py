@@ -1,38 +1,263 @@
 import os
+import pipes
+import logging
+import threading
 import subprocess
+import urllib2
+from urlparse import urlparse
+from manifest import Manifest
+from manifest import ManifestError
+from manifest import manifest_index_dir
+from resumable import ResumableDownload
+from integrity import Digests
+from integrity import IntegrityError
+
+
+_log = logging.getLogger('compile_extensions')
+
+
+class ScriptHelper(object):
+    """A long lived shell which runs `compile-extensions` scripts.
+
+    Scripts are sent to the shell over a pipe and run one after another.
+    The output of each is read as it's written, up to a marker with the
+    exit code, so a script with a lot of output can't fill up the pipe
+    and block.
+    """
+    EXIT_KEY = '##compile-extensions-exit-code##'
+
+    def __init__(self, bin_dir, shell='/bin/sh'):
+        self._bin_dir = bin_dir
+        self._lock = threading.Lock()
+        self._proc = subprocess.Popen([shell], stdin=subprocess.PIPE,
+                                      stdout=subprocess.PIPE)
+
+    def call(self, script, *args):
+        cmd = ' '.join(pipes.quote(arg) for arg in
+                       [os.path.join(self._bin_dir, script)] + list(args))
+        with self._lock:
+            if self._proc is None:
+                raise ValueError('Helper for [%s] is closed' % self._bin_dir)
+            self._proc.stdin.write('%s </dev/null; rc=$?; echo; '
+                                   'echo "%s$rc"\n' % (cmd, self.EXIT_KEY))
+            self._proc.stdin.flush()
+            lines = []
+            for line in iter(self._proc.stdout.readline, ''):
+                if line.startswith(self.EXIT_KEY):
+                    return (int(line[len(self.EXIT_KEY):]),
+                            ''.join(lines).rstrip())
+                lines.append(line)
+        raise RuntimeError('Helper for [%s] exited' % self._bin_dir)
+
+    def close(self):
+        with self._lock:
+            if self._proc is not None:
+                self._proc.stdin.close()
+                self._proc.wait()
+                self._proc = None
+
 
 class CompileExtensions(object):
-    def __init__(self, buildpack_dir):
+    """Answers the questions the `compile-extensions` scripts answer.
+
+    The answers come from `manifest.yml`, parsed in process.  When
+    `use_scripts` is True, or the manifest can't be loaded, the scripts
+    are run instead.  It defaults to the `BP_COMPILE_EXTENSIONS_SCRIPTS`
+    environment variable.
+
+    With `persistent` the scripts are run by one `ScriptHelper`, which
+    is kept until `close()`.  Dependencies are downloaded in process
+    with `opener`, which defaults to `urllib2.urlopen`, and are retried
+    up to `retries` times after a `backoff` that doubles each time.
+    The index of the manifest is kept in `index_dir`.
+    """
+    def __init__(self, buildpack_dir, use_scripts=None, persistent=False,
+                 opener=None, retries=3, backoff=0.5, index_dir=None):
         self._buildpack_dir = buildpack_dir
+        self._opener = opener or urllib2.urlopen
+        self._retries = retries
+        self._backoff = backoff
+        self._index_dir = index_dir
+        if use_scripts is None:
+            use_scripts = bool(os.environ.get('BP_COMPILE_EXTENSIONS_SCRIPTS'))
+        self._use_scripts = use_scripts
+        self._persistent = persistent
+        self._helper = None
+        self._lock = threading.Lock()
+        self.verified = {}
+
+    @classmethod
+    def for_context(cls, ctx, **kwargs):
+        """For the buildpack in `ctx`, sharing the manifest index under
+        CACHE_DIR and downloading with DOWNLOAD_RETRIES and
+        DOWNLOAD_RETRY_BACKOFF"""
+        kwargs.setdefault('retries', int(ctx.get('DOWNLOAD_RETRIES', 3)))
+        kwargs.setdefault('backoff',
+                          float(ctx.get('DOWNLOAD_RETRY_BACKOFF', 0.5)))
+        return cls(ctx['BP_DIR'], index_dir=manifest_index_dir(ctx),
+                   **kwargs)
+
+    def _bin_dir(self):
+        return os.path.join(self._buildpack_dir, 'compile-extensions', 'bin')
 
     def call_compile_extensions_script(self, script, *args):
-        process = subprocess.Popen([os.path.join(self._buildpack_dir, 'compile-extensions', 'bin', script)] + list(args), stdout=subprocess.PIPE)
-        exit_code = process.wait()
-        output = process.stdout.read().rstrip()
-        return (exit_code, output)
+        if self._persistent:
+            with self._lock:
+                if self._helper is None:
+                    self._helper = ScriptHelper(self._bin_dir())
+            return self._helper.call(script, *args)
+        process = subprocess.Popen([os.path.join(self._bin_dir(), script)] + list(args), stdout=subprocess.PIPE)
+        output = process.communicate()[0].rstrip()
+        return (process.returncode, output)
 
-    def filter_dependency_url(self, url):
-        _, filter_output = self.call_compile_extensions_script('filter_dependency_url', url)
-        return filter_output
+    def query(self, queries):
+        """Answer a batch of questions.
 
-    def default_version_for(self, manifest_file_path, dependency):
-        exit_code, default_version = self.call_compile_extensions_script('default_version_for', manifest_file_path, dependency)
-        return (exit_code, default_version)
+        Each query is the name of a method and its arguments, for
+        example `('default_version_for', manifest_path, 'php')`.  The
+        scripts needed for the whole batch are run by one helper.
+        Returns the answers in the same order.
+        """
+        batch = CompileExtensions(self._buildpack_dir,
+                                  use_scripts=self._use_scripts,
+                                  persistent=True,
+                                  opener=self._opener,
+                                  retries=self._retries,
+                                  backoff=self._backoff,
+                                  index_dir=self._index_dir)
+        batch._helper = self._helper
+        try:
+            return [getattr(batch, query[0])(*query[1:])
+                    for query in queries]
+        finally:
+            if self._helper is None:
+                batch.close()
 
-    def download_dependency(self, url, toFile):
-        exit_code, default_version = self.call_compile_extensions_script('download_dependency', url, toFile)
-        return (exit_code, default_version)
+    def close(self):
+        with self._lock:
+            if self._helper is not None:
+                self._helper.close()
+                self._helper = None
 
-    def warn_if_newer_patch(self, url):
-        manifestFile = os.path.join(self._buildpack_dir, 'manifest.yml')
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.close()
+        return False
+
+    def _manifest(self, manifest_file_path=None):
+        """Load the manifest, None means use the scripts instead"""
+        if self._use_scripts:
+            return None
+        if manifest_file_path is None:
+            manifest_file_path = os.path.join(self._buildpack_dir,
+                                              'manifest.yml')
+        try:
+            return Manifest.load(manifest_file_path,
+                                 buildpack_dir=self._buildpack_dir,
+                                 cache_dir=self._index_dir)
+        except (ImportError, IOError, OSError), e:
+            _log.debug("Can't load manifest [%s], using the "
+                       "compile-extensions scripts [%s]",
+                       manifest_file_path, e)
+            return None
 
-        exit_code, stdout  = self.call_compile_extensions_script('warn_if_newer_patch', url, manifestFile)
-        return (exit_code, stdout)
+    def filter_dependency_url(self, url):
+        _, filter_output = self.call_compile_extensions_script('filter_dependency_url', url)
+        return filter_output
 
+    def default_version_for(self, manifest_file_path, dependency):
+        manifest = self._manifest(manifest_file_path)
+        if manifest is None:
+            exit_code, default_version = self.call_compile_extensions_script('default_version_for', manifest_file_path, dependency)
+            return (exit_code, default_version)
+        try:
+            return (0, manifest.default_version_for(dependency))
+        except ManifestError, e:
+            return (1, str(e))
 
+    def translate_dependency_url(self, url):
+        manifest = self._manifest()
+        if manifest is None:
+            return self.call_compile_extensions_script('translate_dependency_url', url)
+        try:
+            return (0, manifest.translate_url(url))
+        except ManifestError, e:
+            return (1, str(e))
 
+    def md5_for(self, url):
+        """The md5 the manifest expects for `url`, None if unknown"""
+        manifest = self._manifest()
+        return manifest and manifest.md5_for(url)
 
+    def open_dependency(self, url):
+        """Open the dependency for `url` to read it as it downloads.
 
+        Returns the response, the translated uri and the expected
+        digests, or None if the dependency can only be downloaded to a
+        file.
+        """
+        manifest = self._manifest()
+        if manifest is None:
+            return None
+        try:
+            translated_uri = manifest.translate_url(url)
+        except ManifestError:
+            return None
+        return (self._opener(translated_uri), translated_uri,
+                manifest.digests_for(url))
 
+    def deprecation_warning(self, url):
+        manifest = self._manifest()
+        return manifest and manifest.deprecation_warning(url) or ''
 
+    def download_dependency(self, url, toFile):
+        manifest = self._manifest()
+        if manifest is None:
+            exit_code, default_version = self.call_compile_extensions_script('download_dependency', url, toFile)
+            return (exit_code, default_version)
+        try:
+            translated_uri = manifest.translate_url(url)
+        except ManifestError, e:
+            return (1, str(e))
+        if os.path.isdir(toFile):
+            # like the script, download into a directory by name
+            toFile = os.path.join(toFile,
+                                  urlparse(url).path.split('/')[-1])
+        # hash as it downloads and only put a verified file at toFile
+        digests = Digests(manifest.digests_for(url))
+        partFile = '%s.part' % toFile
+        try:
+            try:
+                ResumableDownload(translated_uri,
+                                  retries=self._retries,
+                                  backoff=self._backoff,
+                                  opener=self._opener).to_file(
+                    partFile, digests.update, digests.reset)
+            except (urllib2.URLError, IOError, OSError), e:
+                _log.error("Could not download [%s] [%s]", translated_uri, e)
+                return (1, translated_uri)
+            try:
+                verified = digests.verify()
+            except IntegrityError, e:
+                _log.error("Could not verify [%s] [%s]", translated_uri, e)
+                return ((e.algorithm == 'md5') and 3 or 4, translated_uri)
+            os.rename(partFile, toFile)
+        finally:
+            if os.path.exists(partFile):
+                os.remove(partFile)
+        with self._lock:
+            self.verified[toFile] = verified
+        deprecation = manifest.deprecation_warning(url)
+        if deprecation:
+            print deprecation
+        return (0, translated_uri)
 
+    def warn_if_newer_patch(self, url):
+        manifestFile = os.path.join(self._buildpack_dir, 'manifest.yml')
+        manifest = self._manifest(manifestFile)
+        if manifest is None:
+            exit_code, stdout  = self.call_compile_extensions_script('warn_if_newer_patch', url, manifestFile)
+            return (exit_code, stdout)
+        return (0, manifest.newer_patch_warning(url))
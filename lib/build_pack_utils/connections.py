@@ -0,0 +1,239 @@
+import base64
+import socket
+import httplib
+import logging
+import urllib2
+import threading
+from StringIO import StringIO
+from urlparse import urlparse
+from urlparse import urljoin
+
+
+_log = logging.getLogger('connections')
+
+
+def proxies_from(ctx):
+    """The proxies set in the context, by scheme, like `_init_proxy`"""
+    proxies = {}
+    for key in ctx.keys():
+        if key.lower().endswith('_proxy') and key.lower() != 'no_proxy':
+            proxies[key.split('_')[0].lower()] = ctx[key]
+    return proxies
+
+
+def no_proxy_from(ctx):
+    """The hosts in `no_proxy` in the context, which aren't proxied"""
+    for key in ('no_proxy', 'NO_PROXY'):
+        if ctx.get(key):
+            return [name.strip() for name in ctx[key].split(',')
+                    if name.strip()]
+    return []
+
+
+def bypass_proxy(host, port, no_proxy):
+    """If `host` matches `no_proxy`, like `urllib.proxy_bypass`"""
+    for name in no_proxy:
+        if name == '*':
+            return True
+        name = name.lstrip('.')
+        for candidate in (host, '%s:%d' % (host, port)):
+            if candidate == name or candidate.endswith('.' + name):
+                return True
+    return False
+
+
+def _proxy_location(proxy):
+    """Return (host, port, Proxy-Authorization header or None)"""
+    if '://' not in proxy:
+        proxy = 'http://%s' % proxy
+    parts = urlparse(proxy)
+    auth = None
+    if parts.username is not None:
+        auth = 'Basic %s' % base64.b64encode('%s:%s' % (
+            urllib2.unquote(parts.username),
+            urllib2.unquote(parts.password or '')))
+    return parts.hostname, parts.port or 80, auth
+
+
+class PooledResponse(object):
+    """A response which gives its connection back to the pool.
+
+    The connection is kept when the body was read to the end and the
+    server didn't ask to close it, otherwise it's closed.
+    """
+    def __init__(self, pool, key, conn, res, url):
+        self._pool = pool
+        self._key = key
+        self._conn = conn
+        self._res = res
+        self._url = url
+        self.code = res.status
+        self.msg = res.reason
+
+    def read(self, amt=None):
+        return self._res.read(amt)
+
+    def getcode(self):
+        return self.code
+
+    def geturl(self):
+        return self._url
+
+    def info(self):
+        return self._res.msg
+
+    def close(self):
+        if self._conn is None:
+            return
+        if self._res.isclosed() and not self._res.will_close:
+            self._pool.release(self._key, self._conn)
+        else:
+            self._res.close()
+            self._conn.close()
+        self._conn = None
+
+
+class ConnectionPool(object):
+    """Keeps HTTP connections open, so requests to the same host share
+    them instead of connecting, and for HTTPS shaking hands, each time.
+
+    Up to `size` idle connections are kept for each host.  `open` takes
+    the same arguments as `urllib2.urlopen` and follows redirects.
+    Urls that aren't HTTP or HTTPS are opened with `urllib2.urlopen`.
+    Hosts in `no_proxy` are connected to without the `proxies`.
+    """
+    MAX_REDIRECTS = 5
+    _shared = {}
+    _shared_lock = threading.Lock()
+
+    def __init__(self, size=4, proxies=None, timeout=None, no_proxy=None):
+        self._size = size
+        self._proxies = proxies or {}
+        self._no_proxy = no_proxy or []
+        self._timeout = timeout
+        self._idle = {}
+        self._lock = threading.Lock()
+        self._log = _log
+        self._stats = {'connections': 0, 'reused': 0, 'requests': 0}
+
+    @classmethod
+    def shared(cls, size=4, proxies=None, no_proxy=None):
+        """One pool for each size and set of proxies"""
+        key = (size, tuple(sorted((proxies or {}).items())),
+               tuple(no_proxy or ()))
+        with cls._shared_lock:
+            if key not in cls._shared:
+                cls._shared[key] = cls(size, proxies, no_proxy=no_proxy)
+            return cls._shared[key]
+
+    def _count(self, name):
+        with self._lock:
+            self._stats[name] += 1
+
+    def stats(self):
+        with self._lock:
+            return dict(self._stats)
+
+    def _proxy_for(self, scheme, host, port):
+        if bypass_proxy(host, port, self._no_proxy):
+            return None
+        return self._proxies.get(scheme)
+
+    def _connect(self, scheme, host, port, timeout):
+        self._count('connections')
+        proxy = self._proxy_for(scheme, host, port)
+        kwargs = {}
+        if timeout:
+            kwargs['timeout'] = timeout
+        if proxy is None:
+            cls = (scheme == 'https') and httplib.HTTPSConnection \
+                or httplib.HTTPConnection
+            return cls(host, port, **kwargs)
+        proxyHost, proxyPort, auth = _proxy_location(proxy)
+        if scheme == 'http':
+            return httplib.HTTPConnection(proxyHost, proxyPort, **kwargs)
+        conn = httplib.HTTPSConnection(proxyHost, proxyPort, **kwargs)
+        conn.set_tunnel(host, port,
+                        auth and {'Proxy-Authorization': auth} or None)
+        return conn
+
+    def acquire(self, key, timeout=None):
+        """An idle connection for `key` or a new one, and if it's reused"""
+        with self._lock:
+            idle = self._idle.get(key)
+            if idle:
+                self._stats['reused'] += 1
+                return idle.pop(), True
+        return self._connect(key[0], key[1], key[2], timeout), False
+
+    def release(self, key, conn):
+        with self._lock:
+            idle = self._idle.setdefault(key, [])
+            if len(idle) < self._size:
+                idle.append(conn)
+                return
+        conn.close()
+
+    def close(self):
+        with self._lock:
+            idle = self._idle
+            self._idle = {}
+        for conns in idle.values():
+            for conn in conns:
+                conn.close()
+
+    def _request(self, url, headers, timeout):
+        parts = urlparse(url)
+        port = parts.port or (parts.scheme == 'https' and 443 or 80)
+        key = (parts.scheme, parts.hostname, port)
+        path = parts.path or '/'
+        if parts.query:
+            path = '%s?%s' % (path, parts.query)
+        headers = dict(headers)
+        proxy = self._proxy_for(*key)
+        if parts.scheme == 'http' and proxy is not None:
+            path = url
+            auth = _proxy_location(proxy)[2]
+            if auth:
+                headers['Proxy-Authorization'] = auth
+        self._count('requests')
+        while True:
+            conn, reused = self.acquire(key, timeout)
+            try:
+                conn.request('GET', path, headers=headers)
+                res = conn.getresponse()
+            except (socket.error, httplib.HTTPException), e:
+                conn.close()
+                if reused:
+                    # the server closed it while it was idle
+                    self._log.debug('Reconnecting to [%s] [%s]', key, e)
+                    continue
+                raise urllib2.URLError(e)
+            return PooledResponse(self, key, conn, res, url)
+
+    def open(self, req, data=None, timeout=None):
+        if not isinstance(req, urllib2.Request):
+            req = urllib2.Request(req)
+        url = req.get_full_url()
+        if urlparse(url).scheme not in ('http', 'https'):
+            return urllib2.urlopen(req, data, timeout or
+                                   socket._GLOBAL_DEFAULT_TIMEOUT)
+        headers = dict(req.header_items())
+        headers.setdefault('User-Agent', 'Python-urllib/%s' %
+                           urllib2.__version__)
+        for i in range(self.MAX_REDIRECTS + 1):
+            res = self._request(url, headers, timeout or self._timeout)
+            if res.code in (301, 302, 303, 307, 308):
+                location = res.info().getheader('Location')
+                res.read()
+                res.close()
+                url = urljoin(url, location)
+                continue
+            if res.code >= 400:
+                body = res.read()
+                res.close()
+                raise urllib2.HTTPError(url, res.code, res.msg, res.info(),
+                                        StringIO(body))
+            return res
+        raise urllib2.URLError('Too many redirects for [%s]' %
+                               req.get_full_url())
@@ -1,9 +1,360 @@
+import os
+import json
+import shutil
 import urllib2
 import re
+import hashlib
 import logging
+import tempfile
+import threading
 from compile_extensions import CompileExtensions
 from subprocess import Popen
 from subprocess import PIPE
+from utils import Materializer
+from utils import safe_makedirs
+from utils import link_tree
+from workers import WorkerPool
+from resumable import ResumableDownload
+from integrity import Digests
+from connections import ConnectionPool
+from connections import proxies_from
+from connections import no_proxy_from
+from mirrors import MirrorRace
+from mirrors import parse_mirrors
+
+
+class DownloadCache(object):
+    """Keeps downloaded files in the cache directory.
+
+    Files are stored by a key made from where they were downloaded
+    from and their expected hash, so a file is only found again if
+    it's the same dependency.  Files are published with a rename, so
+    other readers never see part of a file.  When the files take more
+    than `max_bytes`, the least recently used are removed.
+
+    The digests checked when a file was downloaded can be stored with
+    it, so a file from the cache doesn't have to be hashed again.
+
+    Files are cloned or copied in and out of the cache, never hard
+    linked, so a later download which writes over the same path can't
+    change the file in the cache.
+    """
+    def __init__(self, cache_dir, max_bytes):
+        self._dir = os.path.join(cache_dir, 'downloads')
+        self._max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._log = logging.getLogger('downloads')
+        self._stats = {'hits': 0, 'misses': 0, 'stores': 0,
+                       'evictions': 0, 'bytes_from_cache': 0}
+
+    @staticmethod
+    def key_for(uri, hsh=None):
+        return hashlib.sha1('%s\0%s' % (uri, hsh or '')).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self._dir, key)
+
+    def _count(self, name, amount=1):
+        with self._lock:
+            self._stats[name] += amount
+
+    def fetch(self, key, toFile):
+        """Put the file for `key` at `toFile`, returns False if missing"""
+        path = self._path(key)
+        try:
+            # the modification time orders the files for eviction
+            os.utime(path, None)
+            safe_makedirs(os.path.dirname(toFile))
+            Materializer('clone')(path, toFile)
+        except (IOError, OSError):
+            self._count('misses')
+            return False
+        self._count('hits')
+        self._count('bytes_from_cache', os.path.getsize(toFile))
+        self._log.debug('Found [%s] in the download cache', toFile)
+        return True
+
+    def digests(self, key):
+        """The digests stored with the file for `key`, or None"""
+        try:
+            with open('%s.digests' % self._path(key), 'rt') as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return None
+
+    def _publish(self, path, write):
+        fd, tmpPath = tempfile.mkstemp(dir=self._dir, prefix='.tmp-')
+        os.close(fd)
+        write(tmpPath)
+        os.rename(tmpPath, path)
+
+    def _write_digests(self, path, digests):
+        with open(path, 'wt') as f:
+            json.dump(digests, f)
+
+    def store(self, key, fromFile, digests=None):
+        """Add a copy of `fromFile` to the cache"""
+        try:
+            safe_makedirs(self._dir)
+            if digests:
+                self._publish('%s.digests' % self._path(key),
+                              lambda path: self._write_digests(path, digests))
+            self._publish(self._path(key),
+                          lambda path: Materializer('clone')(fromFile, path))
+        except (IOError, OSError), e:
+            self._log.warning('Could not add [%s] to the download cache '
+                              '[%s]', fromFile, e)
+            return
+        self._count('stores')
+        self.evict()
+
+    def evict(self):
+        """Remove the least recently used files over the budget"""
+        entries = []
+        total = 0
+        for name in os.listdir(self._dir):
+            if name.startswith('.tmp-') or name.endswith('.digests'):
+                continue
+            try:
+                st = os.stat(os.path.join(self._dir, name))
+            except OSError:
+                continue
+            entries.append((st.st_mtime, st.st_size, name))
+            total += st.st_size
+        for mtime, size, name in sorted(entries):
+            if total <= self._max_bytes:
+                break
+            try:
+                os.remove(os.path.join(self._dir, name))
+            except OSError:
+                continue
+            try:
+                os.remove(os.path.join(self._dir, '%s.digests' % name))
+            except OSError:
+                pass
+            total -= size
+            self._count('evictions')
+            self._log.debug('Evicted [%s] from the download cache', name)
+
+    def stats(self):
+        with self._lock:
+            return dict(self._stats)
+
+
+class TreeCache(object):
+    """Keeps the files extracted from archives in the cache directory.
+
+    A tree is stored by the key of the archive it was extracted from,
+    so installing the same dependency again links the files of the
+    tree instead of extracting the archive.  Files are hard linked or
+    cloned by a `Materializer('link')`, so they must not be changed in
+    place.  Trees are published with a rename and the least recently
+    used are removed when they take more than `max_bytes`.
+    """
+    def __init__(self, cache_dir, max_bytes):
+        self._dir = os.path.join(cache_dir, 'trees')
+        self._max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._log = logging.getLogger('downloads')
+        self._stats = {'hits': 0, 'misses': 0, 'stores': 0,
+                       'evictions': 0, 'files_linked': 0}
+
+    @staticmethod
+    def key_for(archive_key, strip=False):
+        return hashlib.sha1('%s\0%s' % (archive_key,
+                                        strip and 'strip' or '')).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self._dir, key)
+
+    def _count(self, name, amount=1):
+        with self._lock:
+            self._stats[name] += amount
+
+    def _materialize(self, path, intoDir):
+        materialize = link_tree(path, intoDir)
+        self._count('files_linked', sum(materialize.counts.values()))
+        self._log.debug('Materialized [%s] into [%s] with %s', path,
+                        intoDir, materialize.summary())
+
+    def _remove(self, path):
+        # extracted directories can be read only
+        for root, dirs, files in os.walk(path):
+            for name in dirs:
+                os.chmod(os.path.join(root, name), 0700)
+        shutil.rmtree(path, ignore_errors=True)
+
+    def materialize(self, key, intoDir, index=None):
+        """Put the tree for `key` into `intoDir`, returns False if
+        it's missing.  The index of the archive stored with the tree
+        is appended to `index`."""
+        path = self._path(key)
+        if not os.path.isdir(path):
+            self._count('misses')
+            return False
+        try:
+            if index is not None:
+                with open('%s.json' % path, 'rt') as f:
+                    stored = json.load(f).get('index')
+                if stored is None:
+                    raise IOError('No index for [%s]' % key)
+            # the modification time orders the trees for eviction
+            os.utime(path, None)
+            self._materialize(path, intoDir)
+            if index is not None:
+                index.extend(stored)
+        except (shutil.Error, IOError, OSError, ValueError), e:
+            self._log.warning('Could not use [%s] from the tree cache [%s]',
+                              intoDir, e)
+            self._count('misses')
+            return False
+        self._count('hits')
+        return True
+
+    def add(self, key, intoDir, extract, index=None):
+        """Extract a tree with `extract(path)`, add it to the cache and
+        put it into `intoDir`, returns what `extract` returned.  The
+        tree is only kept when that's true.  `index`, the members of
+        the archive filled in by `extract`, is stored with it."""
+        try:
+            safe_makedirs(self._dir)
+            tmpPath = tempfile.mkdtemp(dir=self._dir, prefix='.tmp-')
+        except (IOError, OSError), e:
+            self._log.warning('Could not use the tree cache [%s]', e)
+            return extract(intoDir)
+        try:
+            result = extract(tmpPath)
+            if not result:
+                return result
+            size = 0
+            for root, dirs, files in os.walk(tmpPath):
+                size += sum(os.lstat(os.path.join(root, name)).st_size
+                            for name in files)
+            path = self._path(key)
+            try:
+                with open('%s.json' % path, 'wt') as f:
+                    json.dump({'bytes': size, 'index': index}, f)
+                os.rename(tmpPath, path)
+            except (IOError, OSError), e:
+                # another stager added it first or the cache is full
+                self._log.debug('Could not add [%s] to the tree cache [%s]',
+                                intoDir, e)
+                path = tmpPath
+            try:
+                self._materialize(path, intoDir)
+            except (shutil.Error, IOError, OSError), e:
+                self._log.warning('Could not use [%s] from the tree cache '
+                                  '[%s]', intoDir, e)
+                return extract(intoDir)
+        finally:
+            if os.path.exists(tmpPath):
+                self._remove(tmpPath)
+        self._count('stores')
+        self.evict()
+        return result
+
+    def evict(self):
+        """Remove the least recently used trees over the budget"""
+        entries = []
+        total = 0
+        for name in os.listdir(self._dir):
+            path = self._path(name)
+            if name.startswith('.tmp-') or not os.path.isdir(path):
+                continue
+            try:
+                with open('%s.json' % path, 'rt') as f:
+                    size = json.load(f)['bytes']
+                mtime = os.stat(path).st_mtime
+            except (IOError, OSError, ValueError, KeyError):
+                continue
+            entries.append((mtime, size, name))
+            total += size
+        for mtime, size, name in sorted(entries):
+            if total <= self._max_bytes:
+                break
+            # unpublish it first, so it isn't used while it's removed
+            tmpPath = tempfile.mkdtemp(dir=self._dir, prefix='.tmp-')
+            try:
+                os.rename(self._path(name), os.path.join(tmpPath, name))
+            except OSError:
+                os.rmdir(tmpPath)
+                continue
+            self._remove(tmpPath)
+            try:
+                os.remove('%s.json' % self._path(name))
+            except OSError:
+                pass
+            total -= size
+            self._count('evictions')
+            self._log.debug('Evicted [%s] from the tree cache', name)
+
+    def stats(self):
+        with self._lock:
+            return dict(self._stats)
+
+
+class Prefetcher(object):
+    """Downloads dependencies in the background before they're installed.
+
+    There is one prefetcher for each download directory, so installers
+    created later find the downloads started earlier.  Installing a
+    dependency waits only for its own download.  A failed download is
+    logged and left to the installer, which downloads it again and
+    reports the error.
+    """
+    _prefetchers = {}
+    _prefetchers_lock = threading.Lock()
+
+    def __init__(self, parallelism):
+        self._pool = WorkerPool(parallelism)
+        self._tasks = {}
+        self._lock = threading.Lock()
+        self._log = logging.getLogger('downloads')
+
+    @classmethod
+    def for_dir(cls, path, parallelism=4):
+        with cls._prefetchers_lock:
+            if path not in cls._prefetchers:
+                cls._prefetchers[path] = cls(parallelism)
+            return cls._prefetchers[path]
+
+    def submit(self, url, fetch):
+        """Start `fetch()` for `url`, unless it has been started"""
+        with self._lock:
+            if url in self._tasks:
+                return self._tasks[url]
+            self._log.debug('Prefetching [%s]', url)
+            task = self._pool.submit(fetch)
+            self._tasks[url] = task
+            return task
+
+    def wait_for(self, url):
+        """What `fetch()` returned for `url`, None if it wasn't
+        prefetched or failed"""
+        with self._lock:
+            task = self._tasks.get(url)
+        if task is None:
+            return None
+        try:
+            return task.wait()
+        except Exception, e:
+            self._log.debug('Prefetching [%s] failed [%s]', url, e)
+            return None
+
+    def urls(self):
+        with self._lock:
+            return sorted(self._tasks.keys())
+
+    def shutdown(self):
+        self._pool.shutdown()
+
+    @classmethod
+    def shutdown_dir(cls, path):
+        """Wait for the downloads into `path` and stop its prefetcher"""
+        with cls._prefetchers_lock:
+            prefetcher = cls._prefetchers.pop(path, None)
+        if prefetcher is not None:
+            prefetcher.shutdown()
 
 
 class Downloader(object):
@@ -11,7 +362,40 @@ class Downloader(object):
     def __init__(self, config):
         self._ctx = config
         self._log = logging.getLogger('downloads')
-        self._init_proxy()
+        self._open = self._init_mirrors(self._init_pool())
+        self._verified = {}
+        self._verified_lock = threading.Lock()
+
+    def verified_digests(self, path):
+        """The digests checked while downloading `path`, or None"""
+        with self._verified_lock:
+            return self._verified.get(path)
+
+    def _init_pool(self):
+        """Share connections with a pool, unless DOWNLOAD_POOL_SIZE is 0,
+        then use urllib2 with the proxies installed"""
+        size = int(self._ctx.get('DOWNLOAD_POOL_SIZE', 0))
+        if size <= 0:
+            self._init_proxy()
+            return urllib2.urlopen
+        pool = ConnectionPool.shared(size, proxies_from(self._ctx),
+                                     no_proxy_from(self._ctx))
+        self._log.debug('Using connection pool [%s]', pool.stats())
+        return pool.open
+
+    def _init_mirrors(self, opener):
+        """Race the DOWNLOAD_MIRRORS of the upstream host, if any are set"""
+        mirrors = parse_mirrors(self._ctx.get('DOWNLOAD_MIRRORS'))
+        if not mirrors:
+            return opener
+        race = MirrorRace(
+            mirrors,
+            self._ctx.get('DOWNLOAD_MIRROR_UPSTREAM',
+                          'https://buildpacks.cloudfoundry.org'),
+            race=int(self._ctx.get('DOWNLOAD_MIRROR_RACE', 2)),
+            opener=opener)
+        self._log.debug('Using mirrors %s', mirrors)
+        return race.open
 
     def _init_proxy(self):
         handlers = {}
@@ -28,29 +412,84 @@ class Downloader(object):
             opener = urllib2.build_opener(*openers)
             urllib2.install_opener(opener)
 
+    def _compile_extensions(self):
+        return CompileExtensions.for_context(self._ctx, persistent=True,
+                                             opener=self._open)
+
     def download(self, url, toFile):
-        compile_exts = CompileExtensions(self._ctx['BP_DIR'])
-        exit_code, translated_uri = compile_exts.download_dependency(url, toFile)
+        with self._compile_extensions() as compile_exts:
+            exit_code, translated_uri = compile_exts.download_dependency(url, toFile)
+
+            if exit_code == 0:
+                print "Downloaded [%s] to [%s]" % (translated_uri, toFile)
+                with self._verified_lock:
+                    self._verified.update(compile_exts.verified)
+            elif exit_code == 1:
+                raise RuntimeError("Could not download dependency: %s" % url)
+            elif exit_code == 3:
+                raise RuntimeError("MD5 of downloaded dependency does not match expected value")
+            elif exit_code == 4:
+                raise RuntimeError("SHA256 of downloaded dependency does not match expected value")
+
+            _, patch_warning = compile_exts.warn_if_newer_patch(url)
+            print patch_warning
+
+    def stream(self, url, consume):
+        """Download a dependency from the manifest without saving it.
+
+        The response is passed to `consume(stream, on_chunk)` while it
+        downloads, `on_chunk` must be called with the data read so it
+        can be checked.  Returns False, without calling `consume`, if
+        the dependency can only be downloaded to a file.
+        """
+        with self._compile_extensions() as compile_exts:
+            try:
+                opened = compile_exts.open_dependency(url)
+            except (urllib2.URLError, IOError), e:
+                self._log.error("Could not download [%s] [%s]", url, e)
+                raise RuntimeError("Could not download dependency: %s" % url)
+            if opened is None:
+                return False
+            res, translated_uri, expected = opened
+            digests = Digests(expected)
+            try:
+                consume(res, digests.update)
+            finally:
+                res.close()
+            digests.verify()
+            print "Downloaded and extracted [%s]" % translated_uri
+            deprecation = compile_exts.deprecation_warning(url)
+            if deprecation:
+                print deprecation
+            _, patch_warning = compile_exts.warn_if_newer_patch(url)
+            print patch_warning
+        return True
 
-        if exit_code == 0:
-            print "Downloaded [%s] to [%s]" % (translated_uri, toFile)
-        elif exit_code == 1:
-            raise RuntimeError("Could not download dependency: %s" % url)
-        elif exit_code == 3:
-            raise RuntimeError("MD5 of downloaded dependency does not match expected value")
+    def custom_extension_stream(self, url, filtered_url, consume):
+        """Download `url` without saving it, see `stream`"""
+        res = self._open(url)
+        try:
+            consume(res, None)
+        finally:
+            res.close()
+        print 'Downloaded and extracted [%s]' % filtered_url
+        self._log.info('Downloaded and extracted [%s]', filtered_url)
+        return True
 
-        _, patch_warning = compile_exts.warn_if_newer_patch(url)
-        print patch_warning
+    def _resumable(self, url):
+        return ResumableDownload(
+            url,
+            retries=int(self._ctx.get('DOWNLOAD_RETRIES', 3)),
+            backoff=float(self._ctx.get('DOWNLOAD_RETRY_BACKOFF', 0.5)),
+            opener=self._open)
 
     def custom_extension_download(self, url, filtered_url, toFile):
-        res = urllib2.urlopen(url)
-        with open(toFile, 'w') as f:
-            f.write(res.read())
+        self._resumable(url).to_file(toFile)
         print 'Downloaded [%s] to [%s]' % (filtered_url, toFile)
         self._log.info('Downloaded [%s] to [%s]', filtered_url, toFile)
 
     def download_direct(self, url):
-        buf = urllib2.urlopen(url).read()
+        buf = self._resumable(url).read()
         self._log.info('Downloaded [%s] to memory', url)
         self._log.debug("Downloaded [%s] [%s]", url, buf)
         return buf
@@ -0,0 +1,48 @@
+import hashlib
+
+
+class IntegrityError(RuntimeError):
+    """Downloaded data doesn't have the digest that was expected"""
+
+    def __init__(self, algorithm):
+        RuntimeError.__init__(
+            self, '%s of downloaded dependency does not match expected '
+                  'value' % algorithm.upper())
+        self.algorithm = algorithm
+
+
+class Digests(object):
+    """Hashes data as it arrives, to check it once the last byte is in.
+
+    Only the algorithms with an expected digest are used, or md5 when
+    nothing is expected, so that there is always a digest to record.
+    """
+    ALGORITHMS = ('md5', 'sha256')
+
+    def __init__(self, expected=None):
+        self.expected = dict((name, str(val).lower())
+                             for name, val in (expected or {}).iteritems()
+                             if val and name in self.ALGORITHMS)
+        self._names = sorted(self.expected.keys()) or ['md5']
+        self.reset()
+
+    def reset(self):
+        """Start again, for a download that starts over"""
+        self._hashes = [(name, hashlib.new(name)) for name in self._names]
+        self.size = 0
+
+    def update(self, chunk):
+        for name, hsh in self._hashes:
+            hsh.update(chunk)
+        self.size += len(chunk)
+
+    def hexdigests(self):
+        return dict((name, hsh.hexdigest()) for name, hsh in self._hashes)
+
+    def verify(self):
+        """Return the digests, raises IntegrityError on a mismatch"""
+        found = self.hexdigests()
+        for name in self.ALGORITHMS:
+            if name in self.expected and found[name] != self.expected[name]:
+                raise IntegrityError(name)
+        return found
@@ -0,0 +1,339 @@
+import os
+import re
+import json
+import hashlib
+import logging
+import tempfile
+import threading
+from datetime import date
+from datetime import datetime
+
+
+_log = logging.getLogger('manifest')
+
+
+class ManifestError(Exception):
+    """The manifest can not answer a question about a dependency"""
+    pass
+
+
+def manifest_index_dir(ctx):
+    """Where the manifest index is kept between stagings, None unless
+    CACHE_DIR exists.  It's not kept under BUILD_DIR, that's in the
+    droplet."""
+    if not ctx.get('CACHE_DIR') or not os.path.isdir(ctx['CACHE_DIR']):
+        return None
+    return os.path.join(ctx['CACHE_DIR'], 'manifest-index')
+
+
+def _version_key(version):
+    return [(part.isdigit() and (0, int(part)) or (1, part))
+            for part in str(version).split('.')]
+
+
+def _substitute(value, match):
+    # `$1` in url_to_dependency_map refers to a group of `match`
+    value = str(value)
+    if value.startswith('$') and value[1:].isdigit():
+        return match.group(int(value[1:]))
+    return value
+
+
+def _jsonable(data):
+    # dates in the manifest are kept as `YYYY-MM-DD` strings
+    if isinstance(data, dict):
+        return dict((key, _jsonable(val)) for key, val in data.iteritems())
+    if isinstance(data, (list, tuple)):
+        return [_jsonable(val) for val in data]
+    if isinstance(data, date):
+        return data.isoformat()
+    return data
+
+
+class ManifestIndex(object):
+    """The data in `manifest.yml`, compiled for quick lookups.
+
+    An index is built the first time a manifest is seen, which means
+    parsing the YAML, and is saved as JSON under `cache_dir` in a file
+    named after the SHA1 of the manifest.  After that it's loaded from
+    that file, or from memory in the same process.
+    """
+    VERSION = 1
+    _cache = {}
+    _cache_lock = threading.Lock()
+
+    def __init__(self, index):
+        self._index = index
+
+    @staticmethod
+    def build(data, digest=None):
+        data = _jsonable(data or {})
+        dependencies = {}
+        versions = {}
+        for dependency in data.get('dependencies') or []:
+            name = dependency.get('name')
+            version = str(dependency.get('version'))
+            dependencies.setdefault(name, {})[version] = dependency
+            versions.setdefault(name, []).append(version)
+        templates = {}
+        for name, deps in dependencies.iteritems():
+            found = set(dep.get('uri', '').replace(version, '{version}')
+                        for version, dep in deps.iteritems())
+            templates[name] = (len(found) == 1) and found.pop() or None
+        defaults = {}
+        for item in data.get('default_versions') or []:
+            defaults.setdefault(item.get('name'), str(item.get('version')))
+        return {
+            'index_version': ManifestIndex.VERSION,
+            'sha1': digest,
+            'manifest': data,
+            'dependencies': dependencies,
+            'versions': versions,
+            'uri_templates': templates,
+            'defaults': defaults
+        }
+
+    @classmethod
+    def load(cls, path, cache_dir=None):
+        with open(path, 'rb') as f:
+            raw = f.read()
+        digest = hashlib.sha1(raw).hexdigest()
+        with cls._cache_lock:
+            if digest in cls._cache:
+                return cls._cache[digest]
+        cachePath = None
+        index = None
+        if cache_dir:
+            cachePath = os.path.join(cache_dir, 'manifest-%s.json' % digest)
+            index = cls._read(cachePath)
+        if index is None:
+            import yaml
+            _log.debug('Building manifest index for [%s]', path)
+            index = cls.build(yaml.safe_load(raw), digest)
+            if cachePath:
+                cls._write(cachePath, index)
+        manifestIndex = cls(index)
+        with cls._cache_lock:
+            cls._cache[digest] = manifestIndex
+        return manifestIndex
+
+    @staticmethod
+    def _read(path):
+        try:
+            with open(path, 'rt') as f:
+                index = json.load(f)
+            if index.get('index_version') == ManifestIndex.VERSION:
+                _log.debug('Loaded manifest index [%s]', path)
+                return index
+        except (IOError, ValueError):
+            pass
+        return None
+
+    @staticmethod
+    def _write(path, index):
+        # write and rename, so a reader never sees part of the file
+        try:
+            if not os.path.exists(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            fd, tmpPath = tempfile.mkstemp(dir=os.path.dirname(path))
+            with os.fdopen(fd, 'wt') as f:
+                json.dump(index, f)
+            os.rename(tmpPath, path)
+        except (IOError, OSError), e:
+            _log.debug("Can't save manifest index [%s] [%s]", path, e)
+
+    @property
+    def sha1(self):
+        return self._index['sha1']
+
+    @property
+    def manifest(self):
+        """The parsed manifest, with dates as strings"""
+        return self._index['manifest']
+
+    def names(self):
+        return sorted(self._index['dependencies'].keys())
+
+    def versions_for(self, name):
+        """The versions of a dependency, in manifest order"""
+        return list(self._index['versions'].get(name, []))
+
+    def dependency(self, name, version):
+        return self._index['dependencies'].get(name, {}).get(str(version))
+
+    def uri_for(self, name, version):
+        dependency = self.dependency(name, version)
+        return dependency and dependency.get('uri')
+
+    def md5_for(self, name, version):
+        dependency = self.dependency(name, version)
+        return dependency and dependency.get('md5')
+
+    def modules_for(self, name, version):
+        dependency = self.dependency(name, version)
+        return list((dependency and dependency.get('modules')) or [])
+
+    def uri_template_for(self, name):
+        """The uri of a dependency with `{version}` for the version, or
+        None if the uris of its versions don't follow one pattern"""
+        return self._index['uri_templates'].get(name)
+
+    def default_version_for(self, name):
+        return self._index['defaults'].get(name)
+
+
+class Manifest(object):
+    """Answers questions about the dependencies in `manifest.yml`.
+
+    This does in process what the `compile-extensions` scripts do, so
+    that the manifest is only parsed once and no script is started for
+    each question.
+    """
+    _cache = {}
+    _cache_lock = threading.Lock()
+
+    def __init__(self, data, buildpack_dir=None, stack=None):
+        self._data = data or {}
+        self._buildpack_dir = buildpack_dir
+        self._stack = stack
+        self._url_map = [(re.compile(str(mapping['match'])), mapping)
+                         for mapping in
+                         self._data.get('url_to_dependency_map') or []]
+        self._deprecations = [(re.compile(str(item['match'])), item)
+                              for item in
+                              self._data.get('dependency_deprecation_dates')
+                              or []]
+
+    @classmethod
+    def load(cls, path, buildpack_dir=None, stack=None, cache_dir=None):
+        """Load a manifest, it's only parsed again when it changes.  The
+        index of it is kept in `cache_dir`, see `ManifestIndex.load`."""
+        path = os.path.abspath(path)
+        if buildpack_dir is None:
+            buildpack_dir = os.path.dirname(path)
+        if stack is None:
+            stack = os.environ.get('CF_STACK')
+        st = os.stat(path)
+        key = (path, buildpack_dir, stack)
+        with cls._cache_lock:
+            cached = cls._cache.get(key)
+            if cached and cached[0] == (st.st_mtime, st.st_size):
+                return cached[1]
+        manifest = cls(ManifestIndex.load(path, cache_dir).manifest,
+                       buildpack_dir, stack)
+        _log.debug('Loaded manifest [%s]', path)
+        with cls._cache_lock:
+            cls._cache[key] = ((st.st_mtime, st.st_size), manifest)
+        return manifest
+
+    def dependencies(self, name=None):
+        """Dependencies for the current stack, all or those named `name`"""
+        found = []
+        for dependency in self._data.get('dependencies') or []:
+            if name is not None and dependency.get('name') != name:
+                continue
+            stacks = dependency.get('cf_stacks')
+            if self._stack and stacks and self._stack not in stacks:
+                continue
+            found.append(dependency)
+        return found
+
+    def default_version_for(self, name):
+        defaults = [item for item in self._data.get('default_versions') or []
+                    if item.get('name') == name]
+        if len(defaults) > 1:
+            raise ManifestError('Found more than one default version for %s'
+                                % name)
+        if not defaults:
+            raise ManifestError('No default version found for %s' % name)
+        version = str(defaults[0]['version'])
+        if not [dep for dep in self.dependencies(name)
+                if str(dep.get('version')) == version]:
+            raise ManifestError('Default version %s of %s is not in the '
+                                'manifest dependencies' % (version, name))
+        return version
+
+    def find_dependency(self, url):
+        """Find the dependency for a url using `url_to_dependency_map`"""
+        for regex, mapping in self._url_map:
+            match = regex.search(url)
+            if match:
+                name = _substitute(mapping['name'], match)
+                version = _substitute(mapping['version'], match)
+                for dependency in self.dependencies(name):
+                    if str(dependency.get('version')) == version:
+                        return dependency
+                return None
+        return None
+
+    def is_cached(self):
+        return (self._buildpack_dir is not None and
+                os.path.exists(os.path.join(self._buildpack_dir,
+                                            'dependencies')))
+
+    def translate_url(self, url):
+        """Return the url to download the dependency for `url` from.
+
+        For cached buildpacks this is a `file://` url in the
+        `dependencies` directory.  Raises ManifestError if the url
+        does not map to a dependency in the manifest.
+        """
+        dependency = self.find_dependency(url)
+        if dependency is None:
+            raise ManifestError('DEPENDENCY MISSING IN MANIFEST: %s' % url)
+        uri = dependency['uri']
+        if self.is_cached():
+            return 'file://%s' % os.path.join(
+                self._buildpack_dir, 'dependencies',
+                re.sub(r'[:/]', '_', uri))
+        return uri
+
+    def md5_for(self, url):
+        dependency = self.find_dependency(url)
+        return dependency and dependency.get('md5')
+
+    def digests_for(self, url):
+        """The digests the manifest has for `url`, by algorithm"""
+        dependency = self.find_dependency(url) or {}
+        return dict((name, dependency[name]) for name in ('md5', 'sha256')
+                    if dependency.get(name))
+
+    def deprecation_warning(self, url, today=None, days=30):
+        """Warn when support for the dependency ends within `days`"""
+        dependency = self.find_dependency(url)
+        if dependency is None:
+            return ''
+        today = today or date.today()
+        version = str(dependency.get('version'))
+        for regex, item in self._deprecations:
+            if item.get('name') != dependency.get('name') or \
+                    not regex.match(version):
+                continue
+            end = item['date']
+            if not isinstance(end, date):
+                end = datetime.strptime(str(end), '%Y-%m-%d').date()
+            if (end - today).days <= days:
+                return ('**WARNING** %s %s will no longer be available in '
+                        'new buildpacks released after %s.' % (
+                            item['name'], item['version_line'], end))
+        return ''
+
+    def newer_patch_warning(self, url):
+        """Warn when the manifest has a newer patch of the dependency"""
+        dependency = self.find_dependency(url)
+        if dependency is None:
+            return ''
+        name = dependency['name']
+        version = str(dependency['version'])
+        line = version.split('.')[:-1]
+        newer = [str(dep['version']) for dep in self.dependencies(name)
+                 if str(dep['version']).split('.')[:-1] == line and
+                 _version_key(dep['version']) > _version_key(version)]
+        if not newer:
+            return ''
+        newest = max(newer, key=_version_key)
+        return ('**WARNING** A newer version of %s is available in this '
+                'buildpack. Please adjust your app to use version %s '
+                'instead of version %s as soon as possible. Old versions '
+                'of %s are only provided to assist in migrating to newer '
+                'versions.' % (name, newest, version, name))
@@ -0,0 +1,167 @@
+import time
+import socket
+import httplib
+import logging
+import urllib2
+import threading
+from Queue import Queue
+
+
+_log = logging.getLogger('mirrors')
+
+
+def parse_mirrors(value):
+    """A list of mirrors from a list or a comma or space separated string"""
+    if not value:
+        return []
+    if isinstance(value, basestring):
+        value = value.replace(',', ' ').split()
+    return [str(mirror).rstrip('/') for mirror in value]
+
+
+class _FirstBytes(object):
+    """A response with the first bytes already read"""
+
+    def __init__(self, res, first):
+        self._res = res
+        self._first = first
+
+    def read(self, amt=None):
+        first, self._first = self._first, ''
+        if amt is None:
+            return first + self._res.read()
+        if first:
+            return first
+        return self._res.read(amt)
+
+    def getcode(self):
+        return self._res.getcode()
+
+    def geturl(self):
+        return self._res.geturl()
+
+    def info(self):
+        return self._res.info()
+
+    def close(self):
+        self._res.close()
+
+
+class MirrorRace(object):
+    """Opens a url from whichever of its mirrors answers first.
+
+    Urls under `upstream` can also be downloaded from each of the
+    `mirrors`, by replacing the `upstream` part of the url.  The first
+    `race` mirrors are asked at the same time, the first one to send a
+    byte is used and the others are closed.  If they all fail, the next
+    `race` mirrors are tried, and the upstream url itself is tried
+    last unless it's in the list.  `open` works like `urllib2.urlopen`.
+    """
+
+    def __init__(self, mirrors, upstream, race=2, opener=None):
+        self._mirrors = mirrors
+        self._upstream = upstream.rstrip('/')
+        self._race_size = max(int(race), 1)
+        self._open = opener or urllib2.urlopen
+        self._log = _log
+        self._lock = threading.Lock()
+        self._stats = {}
+
+    def urls_for(self, url):
+        """The urls to try for `url`, in order"""
+        if not url.startswith(self._upstream + '/'):
+            return [url]
+        path = url[len(self._upstream):]
+        urls = []
+        for mirror in self._mirrors + [self._upstream]:
+            if mirror + path not in urls:
+                urls.append(mirror + path)
+        return urls
+
+    def stats(self):
+        """Wins, losses, failures and time to first byte by mirror"""
+        with self._lock:
+            return dict((mirror, dict(stat))
+                        for mirror, stat in self._stats.iteritems())
+
+    def _record(self, url, result, seconds):
+        mirror = url.split('/')[2]
+        with self._lock:
+            stat = self._stats.setdefault(mirror, {
+                'won': 0, 'lost': 0, 'failed': 0, 'first_byte_times': []})
+            stat[result] += 1
+            if seconds is not None:
+                stat['first_byte_times'].append(seconds)
+
+    def _first_byte(self, url, headers, timeout, start, race):
+        """Open `url` and read a byte, then enter the race"""
+        try:
+            req = urllib2.Request(url, headers=headers)
+            if timeout:
+                res = self._open(req, timeout=timeout)
+            else:
+                res = self._open(req)
+            first = res.read(1)
+        except (IOError, socket.error, httplib.HTTPException), e:
+            self._log.debug('Mirror [%s] failed [%s]', url, e)
+            self._record(url, 'failed', None)
+            race.put((url, None, e))
+            return
+        seconds = time.time() - start
+        race.put((url, _FirstBytes(res, first), seconds))
+
+    def _race(self, urls, headers, timeout):
+        start = time.time()
+        race = Queue()
+        for url in urls:
+            thread = threading.Thread(target=self._first_byte,
+                                      args=(url, headers, timeout,
+                                            start, race))
+            thread.daemon = True
+            thread.start()
+        error = None
+        for i in range(len(urls)):
+            url, res, result = race.get()
+            if res is None:
+                error = result
+                continue
+            self._record(url, 'won', result)
+            self._log.info('Downloading from mirror [%s], first byte '
+                           'after [%.3f]s', url, result)
+            # the others are closed as they answer
+            losers = threading.Thread(target=self._close_losers,
+                                      args=(race, len(urls) - i - 1))
+            losers.daemon = True
+            losers.start()
+            return res, None
+        return None, error
+
+    def _close_losers(self, race, count):
+        for i in range(count):
+            url, res, result = race.get()
+            if res is not None:
+                self._record(url, 'lost', result)
+                self._log.debug('Mirror [%s] lost, first byte after '
+                                '[%.3f]s', url, result)
+                res.close()
+        self._log.info('Mirror stats [%s]', self.stats())
+
+    def open(self, req, data=None, timeout=None):
+        if not isinstance(req, urllib2.Request):
+            req = urllib2.Request(req)
+        urls = self.urls_for(req.get_full_url())
+        if len(urls) == 1:
+            if timeout:
+                return self._open(req, timeout=timeout)
+            return self._open(req)
+        headers = dict(req.header_items())
+        error = None
+        for i in range(0, len(urls), self._race_size):
+            res, error = self._race(urls[i:i + self._race_size], headers,
+                                    timeout)
+            if res is not None:
+                return res
+            self._log.warning('Mirrors %s failed, trying the next ones',
+                              urls[i:i + self._race_size])
+        self._log.debug('Mirror stats [%s]', self.stats())
+        raise error
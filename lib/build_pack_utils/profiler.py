@@ -0,0 +1,192 @@
+import os
+import time
+import json
+import logging
+import threading
+from utils import safe_makedirs
+
+
+_log = logging.getLogger('profiler')
+
+
+def _read_io_counters():
+    """Return (bytes read, bytes written) by this process.
+
+    Values come from `/proc/self/io` and include the I/O of child
+    processes that have already been waited on.  Returns (None, None)
+    when the counters are not available.
+    """
+    try:
+        counters = {}
+        with open('/proc/self/io', 'rt') as f:
+            for line in f:
+                key, val = line.split(':', 1)
+                counters[key.strip()] = int(val)
+        return counters.get('rchar'), counters.get('wchar')
+    except (IOError, ValueError):
+        return None, None
+
+
+def _delta(end, start):
+    if end is None or start is None:
+        return None
+    return end - start
+
+
+class Sample(object):
+    """Snapshot of the resource counters for the current process"""
+
+    def __init__(self):
+        times = os.times()
+        self.wall = time.time()
+        self.cpu = times[0] + times[1]
+        self.children = times[2] + times[3]
+        self.bytes_read, self.bytes_written = _read_io_counters()
+
+
+class Span(object):
+    """A single measured stage of the staging process"""
+
+    def __init__(self, name, parent):
+        self.name = name
+        self.parent = parent
+        self.start = Sample()
+        self.end = None
+
+    def finish(self):
+        if self.end is None:
+            self.end = Sample()
+
+    def to_dict(self):
+        return {
+            'name': self.name,
+            'parent': self.parent,
+            'wall_time': _delta(self.end.wall, self.start.wall),
+            'cpu_time': _delta(self.end.cpu, self.start.cpu),
+            'child_time': _delta(self.end.children, self.start.children),
+            'bytes_read': _delta(self.end.bytes_read,
+                                 self.start.bytes_read),
+            'bytes_written': _delta(self.end.bytes_written,
+                                    self.start.bytes_written)
+        }
+
+
+class StagingProfiler(object):
+    """Records wall time, CPU time, child time and I/O per stage.
+
+    Stages may be nested.  Each thread keeps its own stack of open
+    stages, a stage that is closed also closes any stages opened
+    after it and not closed yet.  CPU and I/O counters are process
+    wide, so stages which run at the same time overlap.
+    """
+
+    def __init__(self):
+        self._log = _log
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._spans = []
+        self._created = Sample()
+
+    def _stack(self):
+        if not hasattr(self._local, 'stack'):
+            self._local.stack = []
+        return self._local.stack
+
+    def start(self, name, parent=None):
+        stack = self._stack()
+        if parent is None and stack:
+            parent = stack[-1].name
+        span = Span(name, parent)
+        stack.append(span)
+        with self._lock:
+            self._spans.append(span)
+        return span
+
+    def stop(self, span):
+        if span is None:
+            return
+        stack = self._stack()
+        if span in stack:
+            while stack:
+                top = stack.pop()
+                top.finish()
+                if top is span:
+                    break
+        else:
+            span.finish()
+
+    def measure(self, name, parent=None):
+        return _Measure(self, name, parent)
+
+    def spans(self):
+        with self._lock:
+            return [span.to_dict() for span in self._spans
+                    if span.end is not None]
+
+    def to_dict(self):
+        end = Sample()
+        return {
+            'stages': self.spans(),
+            'total': {
+                'wall_time': _delta(end.wall, self._created.wall),
+                'cpu_time': _delta(end.cpu, self._created.cpu),
+                'child_time': _delta(end.children, self._created.children),
+                'bytes_read': _delta(end.bytes_read,
+                                     self._created.bytes_read),
+                'bytes_written': _delta(end.bytes_written,
+                                        self._created.bytes_written)
+            }
+        }
+
+    def write(self, path, extra=None):
+        data = self.to_dict()
+        if extra:
+            data.update(extra)
+        safe_makedirs(os.path.dirname(path))
+        self._log.debug('Writing staging profile to [%s]', path)
+        with open(path, 'wt') as out:
+            json.dump(data, out, indent=4, sort_keys=True)
+        return path
+
+    def summary(self):
+        data = self.to_dict()
+        lines = ['%-40s %9s %9s %9s %11s %11s' % (
+            'Stage', 'Wall (s)', 'CPU (s)', 'Child (s)', 'Read (KB)',
+            'Write (KB)')]
+        for stage in data['stages'] + [dict(data['total'], name='total',
+                                            parent=None)]:
+            name = stage['name']
+            if stage['parent']:
+                name = '  ' + name
+            lines.append('%-40s %9s %9s %9s %11s %11s' % (
+                name[:40],
+                _fmt_secs(stage['wall_time']),
+                _fmt_secs(stage['cpu_time']),
+                _fmt_secs(stage['child_time']),
+                _fmt_kb(stage['bytes_read']),
+                _fmt_kb(stage['bytes_written'])))
+        return '\n'.join(lines)
+
+
+class _Measure(object):
+    def __init__(self, profiler, name, parent):
+        self._profiler = profiler
+        self._name = name
+        self._parent = parent
+        self._span = None
+
+    def __enter__(self):
+        self._span = self._profiler.start(self._name, self._parent)
+        return self._span
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self._profiler.stop(self._span)
+        return False
+
+
+def _fmt_secs(val):
+    return (val is None) and '-' or '%.2f' % val
+
+
+def _fmt_kb(val):
+    return (val is None) and '-' or '%d' % (val / 1024)
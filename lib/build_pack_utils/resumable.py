@@ -0,0 +1,143 @@
+import time
+import socket
+import httplib
+import logging
+import urllib2
+from functools import partial
+
+
+_log = logging.getLogger('resumable')
+
+
+class ResumableDownload(object):
+    """Downloads a url in chunks, resuming after errors.
+
+    When the connection fails, or the body is shorter than the
+    `Content-Length`, the download is retried after a backoff that
+    doubles each time.  Retries ask for the rest of the body with a
+    `Range` header.  When the server sends the whole body again, the
+    download starts over if `restart` was given, otherwise it fails.
+
+    Only one chunk is held in memory at a time.  Once finished,
+    `metrics` holds the size, time, time to first byte, throughput
+    and number of retries, which are also logged.
+    """
+    RETRY_HTTP_CODES = (408, 429, 500, 502, 503, 504)
+
+    def __init__(self, url, retries=3, backoff=0.5, chunk_size=65536,
+                 timeout=None, opener=None, sleep=time.sleep):
+        self.url = url
+        self._retries = retries
+        self._backoff = backoff
+        self._chunk_size = chunk_size
+        self._timeout = timeout
+        self._open = opener or urllib2.urlopen
+        self._sleep = sleep
+        self._log = _log
+        self.metrics = None
+
+    def _request(self, offset):
+        req = urllib2.Request(self.url)
+        if offset:
+            req.add_header('Range', 'bytes=%d-' % offset)
+        if self._timeout:
+            return self._open(req, timeout=self._timeout)
+        return self._open(req)
+
+    def _should_retry(self, e, attempt):
+        if attempt >= self._retries:
+            return False
+        if isinstance(e, urllib2.HTTPError):
+            return e.code in self.RETRY_HTTP_CODES
+        return True
+
+    def write_to(self, write, restart=None):
+        """Call `write` with each chunk of the body, returns the metrics
+
+        :param write: called with each chunk, in order
+        :param restart: called when the download has to start over,
+                        after which `write` gets the body from the start
+
+        """
+        start = time.time()
+        firstByte = None
+        offset = 0
+        attempt = 0
+        while True:
+            try:
+                res = self._request(offset)
+                try:
+                    if offset and res.getcode() != 206:
+                        if restart is None:
+                            raise IOError("Can't resume [%s], the server "
+                                          "sent the whole body" % self.url)
+                        self._log.debug('Restarting [%s]', self.url)
+                        restart()
+                        offset = 0
+                    length = res.info().getheader('Content-Length')
+                    expected = length and offset + int(length) or None
+                    for chunk in iter(partial(res.read, self._chunk_size),
+                                      ''):
+                        if firstByte is None:
+                            firstByte = time.time() - start
+                        write(chunk)
+                        offset += len(chunk)
+                    if expected is not None and offset < expected:
+                        raise IOError('Got [%d] of [%d] bytes' %
+                                      (offset, expected))
+                finally:
+                    res.close()
+                break
+            except (IOError, socket.error, httplib.HTTPException), e:
+                if not self._should_retry(e, attempt):
+                    raise
+                delay = self._backoff * (2 ** attempt)
+                attempt += 1
+                self._log.warning('Downloading [%s] failed at byte [%d], '
+                                  'retry [%d] in [%.1f]s [%s]',
+                                  self.url, offset, attempt, delay, e)
+                self._sleep(delay)
+        seconds = time.time() - start
+        self.metrics = {
+            'url': self.url,
+            'bytes': offset,
+            'seconds': seconds,
+            'time_to_first_byte': firstByte,
+            'bytes_per_second': seconds and offset / seconds or None,
+            'retries': attempt
+        }
+        self._log.info('Downloaded [%s] [%d] bytes in [%.2f]s, [%.0f] '
+                       'bytes/s, first byte after [%.2f]s, [%d] retries',
+                       self.url, offset, seconds,
+                       self.metrics['bytes_per_second'] or 0,
+                       firstByte or 0, attempt)
+        return self.metrics
+
+    def to_file(self, path, on_chunk=None, on_restart=None):
+        """Download into the file at `path`, returns the metrics
+
+        :param on_chunk: also called with each chunk written
+        :param on_restart: also called when the file starts over
+
+        """
+        with open(path, 'wb') as out:
+            def write(chunk):
+                if on_chunk:
+                    on_chunk(chunk)
+                out.write(chunk)
+
+            def restart():
+                if on_restart:
+                    on_restart()
+                out.seek(0)
+                out.truncate()
+            return self.write_to(write, restart)
+
+    def read(self):
+        """Download into memory, for small bodies"""
+        chunks = []
+
+        def restart():
+            del chunks[:]
+        self.write_to(chunks.append, restart)
+        return ''.join(chunks)
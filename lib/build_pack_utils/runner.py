@@ -4,6 +4,8 @@ import sys
 import tempfile
 import subprocess
 import logging
+import threading
+from collections import deque
 
 
 # This and check_output are shims to support features of Python 2.7
@@ -109,6 +111,106 @@ def stream_output(*popenargs, **kwargs):
         raise CalledProcessError(retcode, cmd)
 
 
+class RetainedOutput(object):
+    """Keeps the output of a process, at most `limit` bytes of it.
+
+    When there is more output than that, the oldest is dropped and the
+    number of bytes dropped is kept in `dropped`.
+    """
+    def __init__(self, limit=None):
+        self._limit = limit
+        self._chunks = deque()
+        self._size = 0
+        self.dropped = 0
+
+    def append(self, data):
+        self._chunks.append(data)
+        self._size += len(data)
+        if self._limit is not None:
+            while self._size > self._limit:
+                extra = self._size - self._limit
+                first = self._chunks[0]
+                if len(first) <= extra:
+                    self._chunks.popleft()
+                    self._size -= len(first)
+                    self.dropped += len(first)
+                else:
+                    self._chunks[0] = first[extra:]
+                    self._size -= extra
+                    self.dropped += extra
+
+    def value(self):
+        return ''.join(self._chunks)
+
+
+def stream_process(proc, on_chunk=None, on_line=None, tee=None,
+                   retain=None, chunk_size=8192, max_line=65536):
+    """Read the output of a process while it runs.
+
+    Reads `proc.stdout` and `proc.stderr`, if they are pipes, until
+    they are closed.  Each chunk is passed to `on_chunk` and each
+    complete line, without the line feed, to `on_line`.  Both are called
+    with the name of the stream, `stdout` or `stderr`, and the data and
+    never at the same time.  A line longer than `max_line` bytes, like
+    a progress bar without line feeds, is passed in parts of that
+    size, so it isn't kept waiting for the end of the line.  All
+    output is also written to the file like object `tee`.
+
+    Returns the tuple (stdout, stderr) with the last `retain` bytes of
+    each, or all of it when `retain` is None.  An error raised by a
+    callback is raised again once all of the output has been read.
+    """
+    lock = threading.Lock()
+    errors = []
+    results = {}
+
+    def call(callback, *args):
+        # stop calling back after an error, but keep reading the output
+        if callback and not errors:
+            try:
+                callback(*args)
+            except Exception:
+                errors.append(sys.exc_info())
+
+    def read(name, pipe):
+        output = RetainedOutput(retain)
+        partial = ''
+        for chunk in iter(lambda: os.read(pipe.fileno(), chunk_size), ''):
+            output.append(chunk)
+            lines = []
+            if on_line:
+                lines = (partial + chunk).split('\n')
+                partial = lines.pop()
+                while len(partial) > max_line:
+                    lines.append(partial[:max_line])
+                    partial = partial[max_line:]
+            with lock:
+                if tee is not None:
+                    call(tee.write, chunk)
+                call(on_chunk, name, chunk)
+                for line in lines:
+                    call(on_line, name, line)
+        if partial:
+            with lock:
+                call(on_line, name, partial)
+        pipe.close()
+        results[name] = output.value()
+
+    readers = []
+    for name, pipe in (('stdout', proc.stdout), ('stderr', proc.stderr)):
+        if pipe is not None:
+            reader = threading.Thread(target=read, args=(name, pipe))
+            reader.daemon = True
+            reader.start()
+            readers.append(reader)
+    for reader in readers:
+        reader.join()
+    if errors:
+        exc_type, exc_value, tb = errors[0]
+        raise exc_type, exc_value, tb
+    return results.get('stdout'), results.get('stderr')
+
+
 class BuildPack(object):
     def __init__(self, ctx, url, branch=None, stream=sys.stdout):
         self._ctx = ctx
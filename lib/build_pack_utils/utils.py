@@ -3,10 +3,17 @@ import sys
 import shutil
 import logging
 import codecs
-import inspect
+import json
 import re
+import time
+import threading
 from string import Template
+from string import Formatter
 from runner import check_output
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
 
 
 _log = logging.getLogger('utils')
@@ -79,11 +86,145 @@ def process_extensions(ctx, to_call, success, args=None, ignore=False):
         process_extension(path, ctx, to_call, success, args, ignore)
 
 
+class ExtensionRegistry(object):
+    """Loads each extension once and keeps a table of its methods.
+
+    `load_extension` changes `sys.path` and imports the extension every
+    time it's called.  The registry does that once per extension, looks
+    up all of the extension methods listed in `HOOKS` at the same time
+    and records how long loading and calling each extension takes.
+    """
+    HOOKS = ('configure',
+             'compile',
+             'preprocess_commands',
+             'service_commands',
+             'service_environment',
+             'prefetch')
+
+    def __init__(self):
+        self._log = _log
+        self._lock = threading.RLock()
+        self._paths = []
+        self._hooks = {}
+        self._modules = {}
+        self._timings = {}
+
+    def register(self, path):
+        with self._lock:
+            if path not in self._paths:
+                self._paths.append(path)
+        return self
+
+    def paths(self):
+        return list(self._paths)
+
+    def load(self, path):
+        with self._lock:
+            if path not in self._modules:
+                start = time.time()
+                extn = load_extension(path)
+                self._modules[path] = extn
+                self._hooks[path] = dict(
+                    (hook, getattr(extn, hook)) for hook in self.HOOKS
+                    if hasattr(extn, hook))
+                self._timings[path] = {
+                    'load_time': time.time() - start,
+                    'calls': {}
+                }
+            return self._modules[path]
+
+    def hook(self, path, to_call):
+        """Return the extension method `to_call` or None"""
+        self.load(path)
+        method = self._hooks[path].get(to_call)
+        if method is None and to_call not in self.HOOKS:
+            method = getattr(self._modules[path], to_call, None)
+        return method
+
+    def _record(self, path, to_call, elapsed):
+        with self._lock:
+            calls = self._timings[path]['calls']
+            count, total = calls.get(to_call, (0, 0.0))
+            calls[to_call] = (count + 1, total + elapsed)
+
+    def call(self, path, ctx, to_call, success, args=None, ignore=False):
+        """Same as `process_extension`, using the cached extension"""
+        self._log.debug('Processing extension from [%s] with method [%s]',
+                        path, to_call)
+        if not args:
+            args = [ctx]
+        method = self.hook(path, to_call)
+        try:
+            if method is not None:
+                start = time.time()
+                try:
+                    result = method(*args)
+                finally:
+                    self._record(path, to_call, time.time() - start)
+                success(result)
+        except Exception:
+            if ignore:
+                _log.exception("Error with extension [%s]" % path)
+            else:
+                raise
+
+    def timings(self):
+        """Return load time and time spent in each method by extension"""
+        with self._lock:
+            timings = {}
+            for path, data in self._timings.iteritems():
+                calls = {}
+                for to_call, (count, total) in data['calls'].iteritems():
+                    calls[to_call] = {'count': count, 'time': total}
+                timings[path] = {'load_time': data['load_time'],
+                                 'calls': calls}
+            return timings
+
+
+def find_extension_dependencies(paths, load=load_extension):
+    """Work out which extensions have to run before each extension.
+
+    Extensions declare the resources they need with a `REQUIRES`
+    list and the resources they create or modify with a `PROVIDES`
+    list.  An extension depends on every extension registered before
+    it that provides something it requires or provides, or that
+    requires something it provides.  Extensions which declare neither
+    depend on, and are depended on by, every other extension so they
+    keep running in registration order.
+
+    Returns a dict mapping the index of each path to the set of
+    indexes it depends on.
+    """
+    declared = []
+    for path in paths:
+        extn = load(path)
+        if hasattr(extn, 'REQUIRES') or hasattr(extn, 'PROVIDES'):
+            declared.append((set(getattr(extn, 'REQUIRES', ())),
+                             set(getattr(extn, 'PROVIDES', ()))))
+        else:
+            declared.append(None)
+    deps = {}
+    for i, cur in enumerate(declared):
+        deps[i] = set()
+        for j, prev in enumerate(declared[:i]):
+            if cur is None or prev is None:
+                deps[i].add(j)
+            elif (prev[1] & (cur[0] | cur[1])) or (prev[0] & cur[1]):
+                deps[i].add(j)
+    return deps
+
+
 def rewrite_with_template(template, cfgPath, ctx):
     with codecs.open(cfgPath, encoding='utf-8') as fin:
         data = fin.read()
+    st = os.stat(cfgPath)
+    if st.st_nlink > 1:
+        # hard linked by a Materializer, don't change the other links
+        os.unlink(cfgPath)
     with codecs.open(cfgPath, encoding='utf-8', mode='wt') as out:
         out.write(template(data).safe_substitute(ctx))
+    if st.st_nlink > 1:
+        os.chmod(cfgPath, st.st_mode & 07777)
 
 
 def rewrite_cfgs(toPath, ctx, delim='#'):
@@ -133,11 +274,159 @@ def wrap(obj):
     return FormattedDictWrapper(obj)
 
 
+_FIELD_NAME = re.compile(r'^[^.\[]*')
+_formatter = Formatter()
+_placeholders_cache = {}
+
+
+def _placeholders(template):
+    """Return the names of the keyword fields used by a format string.
+
+    Includes fields nested in format specs.  Returns None when the
+    string can not be parsed, formatting it will raise the error.
+    """
+    try:
+        return _placeholders_cache[template]
+    except KeyError:
+        pass
+    names = set()
+    try:
+        for literal, field, spec, conversion in _formatter.parse(template):
+            if field is not None:
+                name = _FIELD_NAME.match(field).group(0)
+                if name and not name.isdigit():
+                    names.add(name)
+            if spec and '{' in spec:
+                nested = _placeholders(spec)
+                if nested is None:
+                    return None
+                names.update(nested)
+    except ValueError:
+        return None
+    names = frozenset(names)
+    if len(_placeholders_cache) > 10000:
+        _placeholders_cache.clear()
+    _placeholders_cache[template] = names
+    return names
+
+
+def _jsonable(val):
+    if hasattr(val, 'unwrap'):
+        val = val.unwrap()
+    try:
+        json.dumps(val)
+        return val
+    except (TypeError, ValueError):
+        return repr(val)
+
+
+class ContextJournal(object):
+    """Records each change made to a FormattedDict and who made it.
+
+    The caller is found with `sys._getframe`, which is cheap, rather
+    than by reading the stack with `inspect`.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._entries = []
+
+    def record(self, action, key, old, new, depth=0):
+        """Add an entry for a change made `depth` frames above the caller"""
+        frame = sys._getframe(depth + 1)
+        entry = (action, key, old, new, frame.f_code.co_filename,
+                 frame.f_lineno, frame.f_code.co_name)
+        with self._lock:
+            self._entries.append(entry)
+        return entry
+
+    def entries(self):
+        with self._lock:
+            entries = list(self._entries)
+        return [{
+            'action': action,
+            'key': key,
+            'old': _jsonable(old),
+            'new': _jsonable(new),
+            'file': path,
+            'line': line,
+            'function': function
+        } for action, key, old, new, path, line, function in entries]
+
+    def write(self, path):
+        safe_makedirs(os.path.dirname(path))
+        with open(path, 'wt') as out:
+            json.dump(self.entries(), out, indent=4)
+        return path
+
+
 class FormattedDict(dict):
+    """A dict which formats its values with the other values in it.
+
+    Formatted values are cached until one of the keys they use is
+    changed.  Values are only cached when every key they use holds a
+    string, as other values could be changed without the dict knowing.
+    Each key has a version, which changes with it, so a value formatted
+    while a key it uses was changed by another thread isn't cached.
+    """
+    MAX_CACHED = 10000
+
     def __init__(self, *args, **kwargs):
         dict.__init__(self, *args, **kwargs)
+        self.journal = None
+        self._lock = threading.RLock()
+        self._cache = {}
+        self._dependents = {}
+        self._versions = {}
+        self._cleared = 0
+
+    def _format_once(self, val, used, versions):
+        names = _placeholders(val)
+        if names is None:
+            return val.format(**self)
+        kwargs = {}
+        for name in names:
+            # the version is read first, so a change made after it
+            #  is seen when the value is stored
+            versions.setdefault(name, self._versions.get(name, 0))
+            kwargs[name] = dict.__getitem__(self, name)
+            used[name] = kwargs[name]
+        return val.format(**kwargs)
+
+    def _resolve(self, val):
+        used = {}
+        versions = {}
+        val = self._format_once(val, used, versions)
+        newVal = self._format_once(val, used, versions)
+        while val != newVal:
+            val = newVal
+            newVal = self._format_once(newVal, used, versions)
+        return val, used, versions
 
     def format(self, val):
+        if isinstance(val, basestring):
+            cacheKey = (type(val), val)
+            with self._lock:
+                try:
+                    return self._cache[cacheKey]
+                except KeyError:
+                    pass
+                cleared = self._cleared
+            resolved, used, versions = self._resolve(val)
+            if all(isinstance(v, basestring) for v in used.itervalues()):
+                with self._lock:
+                    if cleared != self._cleared or \
+                            any(self._versions.get(name, 0) != version
+                                for name, version in versions.iteritems()):
+                        # changed while it was formatted, don't keep it
+                        return resolved
+                    if len(self._cache) > self.MAX_CACHED:
+                        self._cache.clear()
+                        self._dependents.clear()
+                    self._cache[cacheKey] = resolved
+                    for name in used:
+                        self._dependents.setdefault(name, set()).add(
+                            cacheKey)
+            return resolved
         if hasattr(val, 'format'):
             val = val.format(**self)
             newVal = val.format(**self)
@@ -147,6 +436,12 @@ class FormattedDict(dict):
             return val
         return val.unwrap() if hasattr(val, 'unwrap') else val
 
+    def _invalidate(self, key):
+        with self._lock:
+            self._versions[key] = self._versions.get(key, 0) + 1
+            for cacheKey in self._dependents.pop(key, ()):
+                self._cache.pop(cacheKey, None)
+
     def __getitem__(self, key):
         return self.format(dict.__getitem__(self, key))
 
@@ -157,14 +452,62 @@ class FormattedDict(dict):
             tmp = dict.get(self, *args)
             return tmp.unwrap() if hasattr(tmp, 'unwrap') else tmp
 
-    def __setitem__(self, key, val):
-        if _log.isEnabledFor(logging.DEBUG):
-            frame = inspect.currentframe()
-            caller = inspect.getouterframes(frame, 2)
-            info = caller[1]
+    def _changed(self, action, key, old, new):
+        """Journal and log a change made by the caller of our caller"""
+        self._invalidate(key)
+        if self.journal is not None:
+            entry = self.journal.record(action, key, old, new, depth=2)
+        elif _log.isEnabledFor(logging.DEBUG):
+            entry = ContextJournal().record(action, key, old, new, depth=2)
+        else:
+            return
+        if action == 'set':
             _log.debug('line #%s in %s, "%s" is setting [%s] = [%s]',
-                       info[2], info[1], info[3], key, val)
+                       entry[5], entry[4], entry[6], key, new)
+        else:
+            _log.debug('line #%s in %s, "%s" is deleting [%s]',
+                       entry[5], entry[4], entry[6], key)
+
+    def __setitem__(self, key, val):
+        old = dict.get(self, key)
         dict.__setitem__(self, key, val)
+        self._changed('set', key, old, val)
+
+    def __delitem__(self, key):
+        old = dict.get(self, key)
+        dict.__delitem__(self, key)
+        self._changed('delete', key, old, None)
+
+    def update(self, *args, **kwargs):
+        for key, val in dict(*args, **kwargs).iteritems():
+            old = dict.get(self, key)
+            dict.__setitem__(self, key, val)
+            self._changed('set', key, old, val)
+
+    def setdefault(self, key, default=None):
+        if key not in self:
+            dict.__setitem__(self, key, default)
+            self._changed('set', key, None, default)
+        return dict.__getitem__(self, key)
+
+    def pop(self, key, *args):
+        exists = key in self
+        val = dict.pop(self, key, *args)
+        if exists:
+            self._changed('delete', key, val, None)
+        return val
+
+    def popitem(self):
+        key, val = dict.popitem(self)
+        self._changed('delete', key, val, None)
+        return key, val
+
+    def clear(self):
+        dict.clear(self)
+        with self._lock:
+            self._cleared += 1
+            self._cache.clear()
+            self._dependents.clear()
 
 
 class ConfigFileEditor(object):
@@ -205,6 +548,137 @@ class ConfigFileEditor(object):
             cfg.writelines(self._lines)
 
 
+# ioctl to clone a file, sharing its blocks until they're changed
+_FICLONE = 0x40049409
+
+
+class Materializer(object):
+    """Creates files with the contents of other files.
+
+    With the `copy` strategy every file is copied.  The `clone` strategy
+    clones the file on filesystems which support copy-on-write and
+    copies it everywhere else, so both files can always be changed.
+    The `link` strategy tries to clone the file, then to hard link it
+    and finally copies it.  Hard links share the file, so it must not
+    be changed in place at either location.
+
+    Instances are passed as the copy function to `copytree` and count
+    how each file was created.
+    """
+    STRATEGIES = ('copy', 'clone', 'link')
+
+    def __init__(self, strategy='copy', copy=shutil.copy2):
+        if strategy not in self.STRATEGIES:
+            raise ValueError("Unknown materialization strategy [%s]"
+                             % strategy)
+        self._strategy = strategy
+        self._copy = copy
+        self._lock = threading.Lock()
+        self._reflink = (fcntl is not None)
+        self._hardlink = hasattr(os, 'link')
+        self.counts = {'reflink': 0, 'hardlink': 0, 'copy': 0}
+
+    def __call__(self, src, dst):
+        if os.path.isdir(dst):
+            dst = os.path.join(dst, os.path.basename(src))
+        method = 'copy'
+        if self._strategy in ('clone', 'link'):
+            if os.path.exists(dst):
+                if os.path.samefile(src, dst):
+                    raise shutil.Error("`%s` and `%s` are the same file"
+                                       % (src, dst))
+                os.unlink(dst)
+            if self._reflink and self._try_reflink(src, dst):
+                method = 'reflink'
+            elif (self._strategy == 'link' and self._hardlink and
+                    self._try_hardlink(src, dst)):
+                method = 'hardlink'
+        if method == 'copy':
+            if os.path.isfile(dst) and os.stat(dst).st_nlink > 1:
+                # hard linked from a cache, don't write through the link
+                os.unlink(dst)
+            self._copy(src, dst)
+        _log.debug("Materialized [%s] to [%s] with [%s]", src, dst, method)
+        with self._lock:
+            self.counts[method] += 1
+        return dst
+
+    def _try_reflink(self, src, dst):
+        try:
+            with open(src, 'rb') as fin:
+                with open(dst, 'wb') as fout:
+                    fcntl.ioctl(fout.fileno(), _FICLONE, fin.fileno())
+            shutil.copystat(src, dst)
+            return True
+        except (IOError, OSError), e:
+            # not supported here, don't try again for other files
+            _log.debug("Can't reflink [%s] to [%s] [%s]", src, dst, e)
+            self._reflink = False
+            if os.path.exists(dst):
+                os.unlink(dst)
+            return False
+
+    def _try_hardlink(self, src, dst):
+        try:
+            os.link(src, dst)
+            return True
+        except OSError, e:
+            _log.debug("Can't hard link [%s] to [%s] [%s]", src, dst, e)
+            self._hardlink = False
+            return False
+
+    def summary(self):
+        return ', '.join('%s=%d' % (method, self.counts[method])
+                         for method in ('reflink', 'hardlink', 'copy'))
+
+
+def _replace(path):
+    """Remove what's at `path` so it can be created again, unless it's
+    a directory"""
+    if os.path.islink(path) or (os.path.lexists(path) and
+                                not os.path.isdir(path)):
+        os.unlink(path)
+
+
+def link_tree(src, dst, materialize=None):
+    """Put the files of `src` into `dst` with `materialize`, by default
+    a `Materializer('link')`.
+
+    Unlike `copytree`, `dst` can already have the tree: files and
+    symbolic links which are there are replaced, files which are
+    already linked to the ones in `src` are kept and read only
+    directories are written to.  The mode of `dst` itself is not
+    changed.  Returns the materializer.
+    """
+    materialize = materialize or Materializer('link')
+    dirs_made = []
+    for root, dirs, files in os.walk(src):
+        toDir = os.path.normpath(os.path.join(dst, os.path.relpath(root,
+                                                                   src)))
+        _replace(toDir)
+        safe_makedirs(toDir)
+        os.chmod(toDir, os.stat(toDir).st_mode | 0700)
+        if root != src:
+            dirs_made.append((root, toDir))
+        for name in dirs + files:
+            srcname = os.path.join(root, name)
+            dstname = os.path.join(toDir, name)
+            if os.path.islink(srcname):
+                _replace(dstname)
+                os.symlink(os.readlink(srcname), dstname)
+            elif name in files:
+                if (os.path.isfile(dstname) and
+                        not os.path.islink(dstname) and
+                        os.path.samefile(srcname, dstname)):
+                    continue
+                _replace(dstname)
+                materialize(srcname, dstname)
+    # read only directories get their mode once they are filled in
+    for root, toDir in reversed(dirs_made):
+        shutil.copystat(root, toDir)
+    return materialize
+
+
 def unique(seq):
     """Return only the unique items in the given list, but preserve order"""
     # http://stackoverflow.com/a/480227
@@ -237,7 +711,7 @@ def unique(seq):
 # WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
 
 
-def copytree(src, dst, symlinks=False, ignore=None):
+def copytree(src, dst, symlinks=False, ignore=None, copy_function=None):
     """Recursively copy a directory tree using copy2().
 
     If exception(s) occur, an Error is raised with a list of reasons.
@@ -259,6 +733,9 @@ def copytree(src, dst, symlinks=False, ignore=None):
     list of names relative to the `src` directory that should
     not be copied.
 
+    The optional copy_function is used to copy each file, in place of
+    copy2(), for example a Materializer.
+
     XXX Consider this example code rather than the ultimate tool.
 
     """
@@ -283,10 +760,10 @@ def copytree(src, dst, symlinks=False, ignore=None):
                 linkto = os.readlink(srcname)
                 os.symlink(linkto, dstname)
             elif os.path.isdir(srcname):
-                copytree(srcname, dstname, symlinks, ignore)
+                copytree(srcname, dstname, symlinks, ignore, copy_function)
             else:
                 # Will raise a SpecialFileError for unsupported file types
-                shutil.copy2(srcname, dstname)
+                (copy_function or shutil.copy2)(srcname, dstname)
         # catch the Error from the recursive copytree so that we can
         # continue with other files
         except shutil.Error, err:
@@ -0,0 +1,145 @@
+import sys
+import logging
+import threading
+from Queue import Queue
+
+
+_log = logging.getLogger('workers')
+
+
+class Task(object):
+    """The result of a function submitted to a `WorkerPool`"""
+
+    def __init__(self, fn, args, kwargs):
+        self._fn = fn
+        self._args = args
+        self._kwargs = kwargs
+        self._lock = threading.Lock()
+        self._event = threading.Event()
+        self._callbacks = []
+        self.result = None
+        self.exc_info = None
+
+    def run(self):
+        try:
+            self.result = self._fn(*self._args, **self._kwargs)
+        except:  # noqa - SystemExit from an extension must reach the caller
+            self.exc_info = sys.exc_info()
+        with self._lock:
+            self._event.set()
+            callbacks = self._callbacks
+            self._callbacks = []
+        for callback in callbacks:
+            callback(self)
+
+    def add_done_callback(self, callback):
+        with self._lock:
+            if not self._event.isSet():
+                self._callbacks.append(callback)
+                return
+        callback(self)
+
+    def done(self):
+        return self._event.isSet()
+
+    def wait(self):
+        """Wait for the task and return its result or re-raise its error"""
+        self._event.wait()
+        if self.exc_info:
+            raise self.exc_info[0], self.exc_info[1], self.exc_info[2]
+        return self.result
+
+
+class WorkerPool(object):
+    """A fixed size pool of threads which run submitted functions.
+
+    A pool with a size of one or less runs everything in the thread
+    that submits it, which keeps the behaviour of the serial code.
+    """
+
+    def __init__(self, size):
+        self.size = int(size)
+        self._queue = Queue()
+        self._threads = []
+        self._log = _log
+
+    def _work(self):
+        for task in iter(self._queue.get, None):
+            task.run()
+
+    def submit(self, fn, *args, **kwargs):
+        task = Task(fn, args, kwargs)
+        if self.size <= 1:
+            task.run()
+            return task
+        if len(self._threads) < self.size:
+            thread = threading.Thread(target=self._work)
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+        self._queue.put(task)
+        return task
+
+    def map(self, fn, items):
+        """Run `fn` for every item and return the results in order"""
+        return [task.wait() for task in [self.submit(fn, item)
+                                         for item in items]]
+
+    def shutdown(self):
+        for thread in self._threads:
+            self._queue.put(None)
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.shutdown()
+        return False
+
+
+def run_with_dependencies(pool, items, dependencies, fn):
+    """Run `fn` for each item once the items it depends on are done.
+
+    `dependencies` maps the index of an item to the indexes of the
+    items that have to finish first.  Independent items run at the
+    same time on the pool.  After the first failure no new items are
+    started, the running ones are waited for and the error is raised.
+
+    Returns the results in the same order as `items`.
+    """
+    pending = {}
+    for i in range(len(items)):
+        pending[i] = set(dependencies.get(i, ()))
+    results = [None] * len(items)
+    running = {}
+    finished = Queue()
+    error = None
+    while pending or running:
+        if error is None:
+            for i in sorted(pending.keys()):
+                if not pending[i]:
+                    del pending[i]
+                    running[i] = pool.submit(fn, items[i])
+                    running[i].add_done_callback(
+                        lambda task, i=i: finished.put(i))
+        if not running:
+            if error is None:
+                raise RuntimeError('Unable to order items %s, their '
+                                   'dependencies can not be met'
+                                   % [items[i] for i in sorted(pending)])
+            break
+        i = finished.get()
+        task = running.pop(i)
+        if task.exc_info:
+            if error is None:
+                error = task.exc_info
+        else:
+            results[i] = task.result
+            for deps in pending.values():
+                deps.discard(i)
+    if error:
+        raise error[0], error[1], error[2]
+    return results
@@ -1,21 +1,189 @@
 import os
+import copy
 import gzip
 import bz2
 import zipfile
-import shutil
+import tarfile
 import logging
-import tempfile
+import posixpath
+import threading
+from fnmatch import fnmatchcase
 from functools import partial
 from subprocess import Popen
 from subprocess import PIPE
+from utils import safe_makedirs
+
+
+def _strip_name(name, strip):
+    """The path of an archive member after stripping, None if it's gone"""
+    parts = [part for part in name.split('/') if part and part != '.']
+    if strip:
+        parts = parts[1:]
+    return parts and '/'.join(parts) or None
+
+
+class MemberFilter(object):
+    """Picks the members of an archive to extract.
+
+    Files in a directory matching the glob `pattern` are only extracted
+    when their name is one of `names`, all other members are extracted.
+    """
+
+    def __init__(self, pattern, names):
+        self.pattern = pattern
+        self.names = frozenset(names)
+
+    def __call__(self, name):
+        head, tail = posixpath.split(name.rstrip('/'))
+        return tail in self.names or not fnmatchcase(head, self.pattern)
+
+    def key(self):
+        """Identifies the members picked, for cache keys"""
+        return '%s:%s' % (self.pattern, ','.join(sorted(self.names)))
+
+
+class _ReadHook(object):
+    """A file which calls `on_chunk` with the data read from it"""
+
+    def __init__(self, stream, on_chunk):
+        self._stream = stream
+        self._on_chunk = on_chunk
+
+    def read(self, size=-1):
+        chunk = self._stream.read(size)
+        self._on_chunk(chunk)
+        return chunk
 
 
 class UnzipUtil(object):
-    """Extract files from compressed archives."""
+    """Extract files from compressed archives.
+
+    Tar archives are extracted in process, unless TAR_EXTRACTION is
+    `shell`, which runs `tar` instead.  Set `cancel` to stop an
+    extraction between files, `stats()` returns the files and bytes
+    written.  Tar archives can be extracted partly, see `MemberFilter`.
+    """
 
     def __init__(self, config):
         self._ctx = config
         self._log = logging.getLogger('zips')
+        self.cancel = threading.Event()
+        self._lock = threading.Lock()
+        self._stats = {'archives': 0, 'files': 0, 'dirs': 0, 'links': 0,
+                       'bytes': 0, 'skipped': 0, 'filtered': 0}
+
+    def stats(self):
+        with self._lock:
+            return dict(self._stats)
+
+    def _native(self):
+        return self._ctx.get('TAR_EXTRACTION', 'native') != 'shell'
+
+    def _inside(self, root, path):
+        path = os.path.realpath(path)
+        return path == root or path.startswith(root + os.sep)
+
+    def _safe(self, root, name, linkname, hardlink):
+        """If the member can be extracted without leaving `root`"""
+        if '..' in name.split('/'):
+            return False
+        if not self._inside(root, os.path.dirname(os.path.join(root, name))):
+            return False
+        if hardlink:
+            return (linkname is not None and
+                    self._inside(root, os.path.join(root, linkname)))
+        return True
+
+    def _extract_tar(self, fileobj, zipFile, intoDir, compression, strip,
+                     include=None, index=None):
+        """Extract a tar archive as it is read from `fileobj`.
+
+        Members are extracted one after another, so the archive is
+        never held in memory or seeked.  The first element of each
+        path is removed when `strip` is set, members outside of
+        `intoDir` are skipped, and files in the way are replaced,
+        not written through.  Modes, times and links are kept like
+        `TarFile.extractall` does.
+
+        Only the files and links `include` returns True for are
+        extracted, and the path of every member is appended to
+        `index`, if given.
+        """
+        safe_makedirs(intoDir)
+        root = os.path.realpath(intoDir)
+        counts = dict((key, 0) for key in self._stats)
+        dirs = []
+        filtered = set()
+        try:
+            tar = tarfile.open(fileobj=fileobj,
+                               mode='r|%s' % (compression or ''))
+            try:
+                for member in tar:
+                    if self.cancel.isSet():
+                        raise RuntimeError("Extracting [%s] was cancelled"
+                                           % zipFile)
+                    name = _strip_name(member.name, strip)
+                    if name is None:
+                        continue
+                    if index is not None:
+                        index.append(member.isdir() and name + '/' or name)
+                    if include is not None and not member.isdir() and \
+                            not include(name):
+                        filtered.add(name)
+                        counts['filtered'] += 1
+                        continue
+                    linkname = member.linkname
+                    if member.islnk():
+                        linkname = _strip_name(member.linkname, strip)
+                        if linkname in filtered:
+                            # what it links to wasn't extracted
+                            filtered.add(name)
+                            counts['filtered'] += 1
+                            continue
+                    if not self._safe(root, name, linkname, member.islnk()):
+                        self._log.warning("Skipping [%s] from [%s], it's "
+                                          "outside of [%s]", member.name,
+                                          zipFile, intoDir)
+                        counts['skipped'] += 1
+                        continue
+                    member.name = name
+                    member.linkname = linkname
+                    target = os.path.join(root, name)
+                    if os.path.islink(target) or (
+                            os.path.lexists(target) and
+                            not (member.isdir() and os.path.isdir(target))):
+                        os.unlink(target)
+                    if member.isdir():
+                        # set the mode once the files are in, like
+                        #  extractall, in case it's read only
+                        dirs.append(member)
+                        member = copy.copy(member)
+                        member.mode = 0700
+                        counts['dirs'] += 1
+                    elif member.issym() or member.islnk():
+                        counts['links'] += 1
+                    else:
+                        counts['files'] += 1
+                        counts['bytes'] += member.size
+                    tar.extract(member, root)
+                dirs.sort(key=lambda member: member.name, reverse=True)
+                for member in dirs:
+                    path = os.path.join(root, member.name)
+                    tar.chown(member, path)
+                    tar.utime(member, path)
+                    tar.chmod(member, path)
+            finally:
+                tar.close()
+        except (tarfile.TarError, EOFError, IOError, OSError), e:
+            raise RuntimeError("Extracting [%s] failed [%s]" % (zipFile, e))
+        counts['archives'] = 1
+        with self._lock:
+            for key, val in counts.iteritems():
+                self._stats[key] += val
+        self._log.info("Extracted [%d] files, [%d] bytes from [%s] into "
+                       "[%s]", counts['files'], counts['bytes'], zipFile,
+                       intoDir)
+        return intoDir
 
     def _unzip(self, zipFile, intoDir, strip):
         """Extract files from a zip archive.
@@ -31,37 +199,52 @@ class UnzipUtil(object):
         :param strip: trim leading element from path in archive
 
         """
-        if strip:
-            tmpDir = tempfile.mkdtemp(prefix='zips-')
-        else:
-            tmpDir = intoDir
         zipIn = None
+        counts = {'archives': 1, 'files': 0, 'dirs': 0, 'bytes': 0}
         try:
             zipIn = zipfile.ZipFile(zipFile, 'r')
-            zipIn.extractall(tmpDir)
+            prefix = ''
             if strip:
-                members = zipIn.namelist()
-                if len(members) > 0:
-                    firstDir = members[0].split('/')[0]
-                    if all([firstDir == m.split('/')[0] for m in members]):
-                        moveFrom = os.path.join(tmpDir, firstDir)
-                        if os.path.exists(moveFrom) and \
-                           os.path.isdir(moveFrom):
-                            for item in os.listdir(moveFrom):
-                                shutil.move(os.path.join(moveFrom, item),
-                                            intoDir)
-                            return intoDir
+                prefix = self._zip_prefix(zipIn.namelist())
+                if not prefix:
                     self._log.warn("Zip file does not need stripped")
-                    for item in os.listdir(tmpDir):
-                        shutil.move(os.path.join(tmpDir, item), intoDir)
-                    return intoDir
+            # write each member straight to its stripped path, one
+            #  after another, instead of moving them after extracting
+            for member in zipIn.infolist():
+                name = member.filename[len(prefix):]
+                if not name.strip('/'):
+                    continue
+                if self.cancel.isSet():
+                    raise RuntimeError("Extracting [%s] was cancelled"
+                                       % zipFile)
+                stripped = copy.copy(member)
+                stripped.filename = name
+                zipIn.extract(stripped, intoDir)
+                if name.endswith('/'):
+                    counts['dirs'] += 1
+                else:
+                    counts['files'] += 1
+                    counts['bytes'] += member.file_size
         finally:
             if zipIn:
                 zipIn.close()
-            if intoDir != tmpDir and os.path.exists(tmpDir):
-                shutil.rmtree(tmpDir)
+        with self._lock:
+            for key, val in counts.iteritems():
+                self._stats[key] += val
         return intoDir
 
+    def _zip_prefix(self, members):
+        """The directory all of the members are in, with a trailing
+        slash, or an empty string if they're not in one"""
+        if not members:
+            return ''
+        firstDir = members[0].split('/')[0]
+        if not all(firstDir == m.split('/')[0] for m in members):
+            return ''
+        if not any(m.startswith(firstDir + '/') for m in members):
+            return ''
+        return firstDir + '/'
+
     def _gunzip(self, zipFile, intoDir, strip):
         """Uncompress a gzip'd file.
 
@@ -150,20 +333,14 @@ class UnzipUtil(object):
         """
         return self._tar_helper(zipFile, intoDir, None, strip)
 
-    def _tar_helper(self, zipFile, intoDir, compression, strip):
-        """Uncompress and extract files from the archive.
+    def _tar_command(self, zipFile, compression, strip):
+        """Build the shell command to extract a tar archive.
 
-        Uncompress and extract all of the files from the archive into
-        the given folder, optionally stripping off the first element
-        of the path.
-
-        :param zipFile: full path to possibly compressed tar archive
-        :param intoDir: full path to root of extracted files
+        :param zipFile: full path to the archive, `-` for stdin
         :param compression: type of compression (None, 'gz' or 'bz2')
         :param strip: set `--strip-components 1` argument to tar
 
         """
-        # build command
         cmd = []
         if compression == 'gz':
             cmd.append('gunzip -c %s' % zipFile)
@@ -179,22 +356,127 @@ class UnzipUtil(object):
                 cmd.append('tar xf %s' % zipFile)
             else:
                 cmd.append('tar xf -')
-        command = (len(cmd) > 1) and ' | '.join(cmd) or ''.join(cmd)
-        # run it
-        cwd = os.getcwd()
-        try:
-            if not os.path.exists(intoDir):
-                os.makedirs(intoDir)
-            os.chdir(intoDir)
+        return (len(cmd) > 1) and ' | '.join(cmd) or ''.join(cmd)
+
+    def _tar_helper(self, zipFile, intoDir, compression, strip,
+                    include=None, index=None):
+        """Uncompress and extract files from the archive.
+
+        Uncompress and extract all of the files from the archive into
+        the given folder, optionally stripping off the first element
+        of the path.
+
+        This is done in process, or with `tar` when TAR_EXTRACTION is
+        `shell`.
+
+        :param zipFile: full path to possibly compressed tar archive
+        :param intoDir: full path to root of extracted files
+        :param compression: type of compression (None, 'gz' or 'bz2')
+        :param strip: set `--strip-components 1` argument to tar
+        :param include: extract only members this returns True for,
+                        ignored by `tar`
+        :param index: list to append the path of every member to
+
+        """
+        if self._native():
             if os.path.exists(zipFile):
-                proc = Popen(command, stdout=PIPE, shell=True)
-                output, unused_err = proc.communicate()
-                retcode = proc.poll()
-                if retcode:
-                    raise RuntimeError("Extracting [%s] failed with code [%d]"
-                                       % (zipFile, retcode))
+                with open(zipFile, 'rb') as fileobj:
+                    self._extract_tar(fileobj, zipFile, intoDir,
+                                      compression, strip, include, index)
+            return intoDir
+        if include is not None:
+            self._log.debug("Extracting all of [%s] with tar", zipFile)
+        command = self._tar_command(zipFile, compression, strip)
+        # run it, from intoDir without changing the cwd of this process
+        safe_makedirs(intoDir)
+        if os.path.exists(zipFile):
+            proc = Popen(command, stdout=PIPE, shell=True, cwd=intoDir)
+            output, unused_err = proc.communicate()
+            retcode = proc.poll()
+            if retcode:
+                raise RuntimeError("Extracting [%s] failed with code [%d]"
+                                   % (zipFile, retcode))
+        return intoDir
+
+    def _tar_compression(self, zipFile):
+        """The compression of a tar archive, False if it isn't one"""
+        if zipFile.endswith('.tar.gz') or zipFile.endswith('.tgz'):
+            return 'gz'
+        if zipFile.endswith('.tar.bz2'):
+            return 'bz2'
+        if zipFile.endswith('.tar'):
+            return None
+        return False
+
+    def can_stream(self, zipFile):
+        """Can the archive be extracted with `extract_stream`"""
+        return self._tar_compression(zipFile) is not False
+
+    def can_extract_tree(self, zipFile):
+        """Does extracting the archive create a directory of files,
+        rather than uncompress one file"""
+        return (self.can_stream(zipFile) or
+                os.path.splitext(zipFile)[1] in ('.zip', '.war', '.jar'))
+
+    def extract_stream(self, stream, zipFile, intoDir, strip=False,
+                       on_chunk=None, chunk_size=65536, include=None,
+                       index=None):
+        """Extract files from an archive as it is read.
+
+        The data read from `stream` is fed to the extracting process
+        without being saved, so an archive can be extracted while it
+        downloads.  Only tar archives can be extracted like this, see
+        `can_stream`.
+
+        :param stream: file like object to read the archive from
+        :param zipFile: name of the archive, picks the compression
+        :param intoDir: full path to root of extracted files
+        :param strip: set `--strip-components 1` argument to tar
+        :param on_chunk: called with each chunk of data read
+        :param chunk_size: how much data to read at once
+        :param include: extract only members this returns True for,
+                        ignored by `tar`
+        :param index: list to append the path of every member to
+
+        """
+        compression = self._tar_compression(zipFile)
+        if compression is False:
+            raise ValueError("Can't extract [%s] as it is read" % zipFile)
+        self._log.info("Extracting [%s] into [%s] as it is read",
+                       zipFile, intoDir)
+        if self._native():
+            if on_chunk:
+                stream = _ReadHook(stream, on_chunk)
+            self._extract_tar(stream, zipFile, intoDir, compression, strip,
+                              include, index)
+            # read past the end of the archive, so on_chunk sees it all
+            for chunk in iter(lambda: stream.read(chunk_size), ''):
+                pass
+            return intoDir
+        safe_makedirs(intoDir)
+        proc = Popen(self._tar_command('-', compression, strip),
+                     stdin=PIPE, stdout=PIPE, shell=True, cwd=intoDir)
+        try:
+            for chunk in iter(partial(stream.read, chunk_size), ''):
+                if on_chunk:
+                    on_chunk(chunk)
+                try:
+                    proc.stdin.write(chunk)
+                except IOError, e:
+                    # the process stopped reading, its exit code says why
+                    self._log.debug("Extracting [%s] stopped [%s]",
+                                    zipFile, e)
+                    break
         finally:
-            os.chdir(cwd)
+            try:
+                proc.stdin.close()
+            except IOError:
+                pass
+            proc.stdout.read()
+            retcode = proc.wait()
+        if retcode:
+            raise RuntimeError("Extracting [%s] failed with code [%d]"
+                               % (zipFile, retcode))
         return intoDir
 
     def _pick_based_on_file_extension(self, zipFile):
@@ -220,7 +502,8 @@ class UnzipUtil(object):
         if zipFile.endswith('.jar') and zipfile.is_zipfile(zipFile):
             return self._unzip
 
-    def extract(self, zipFile, intoDir, strip=False, method=None):
+    def extract(self, zipFile, intoDir, strip=False, method=None,
+                include=None, index=None):
         """Extract files from the archive.
 
         Extract all of the files from the given archive.  Files are
@@ -252,9 +535,18 @@ class UnzipUtil(object):
                        (Default value = False)
         :param method: method used to extract files from archive
                        (Default value = None)
+        :param include: for tar archives, extract only the members
+                        this returns True for (Default value = None)
+        :param index: for tar archives, list to append the path of
+                      every member to (Default value = None)
 
         """
         self._log.info("Extracting [%s] into [%s]", zipFile, intoDir)
+        compression = self._tar_compression(zipFile)
+        if not method and compression is not False and \
+                (include is not None or index is not None):
+            return self._tar_helper(zipFile, intoDir, compression, strip,
+                                    include, index)
         if not method:
             method = self._pick_based_on_file_extension(zipFile)
         return method(zipFile, intoDir, strip)
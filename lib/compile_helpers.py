@@ -15,10 +15,14 @@
 from __future__ import print_function
 import os
 import os.path
-import yaml
 import logging
 import glob
+from fnmatch import fnmatchcase
 from build_pack_utils import FileUtil
+from build_pack_utils.manifest import ManifestIndex
+from build_pack_utils.manifest import manifest_index_dir
+from build_pack_utils.utils import FormattedDict
+from build_pack_utils.zips import MemberFilter
 
 
 _log = logging.getLogger('helpers')
@@ -73,10 +77,14 @@ def setup_log_dir(ctx):
         os.makedirs(logPath)
 
 
-def load_manifest(ctx):
+def load_manifest_index(ctx):
     manifest_path = os.path.join(ctx['BP_DIR'], 'manifest.yml')
-    _log.debug('Loading manifest from %s', manifest_path)
-    return yaml.load(open(manifest_path))
+    _log.debug('Loading manifest index for %s', manifest_path)
+    return ManifestIndex.load(manifest_path, manifest_index_dir(ctx))
+
+
+def load_manifest(ctx):
+    return load_manifest_index(ctx).manifest
 
 
 def find_all_php_versions(dependencies):
@@ -99,8 +107,52 @@ def validate_php_version(ctx):
         ctx['PHP_VERSION'] = ctx['PHP_55_LATEST']
 
 
+def module_urls(ctx, key):
+    """The urls `ModuleInstaller` downloads the modules listed in
+    `<key>_MODULES` from, made with `<key>_MODULES_PATTERN`"""
+    pattern = '%s_MODULES_PATTERN' % key
+    if pattern not in ctx:
+        return []
+    urls = []
+    for module in ctx.get('%s_MODULES' % key, []):
+        # don't leave MODULE_NAME in the context
+        moduleCtx = FormattedDict(ctx)
+        moduleCtx['MODULE_NAME'] = module
+        urls.append(moduleCtx[pattern])
+    return urls
+
+
+PHP_EXTENSION_DIR = 'lib/php/extensions/no-debug-non-zts-*'
+
+
+def php_extension_filter(ctx):
+    """Picks the core of PHP and the extensions the app asked for from
+    the PHP archive, or None to extract all of it.
+
+    Only used with `PHP_SELECTIVE_EXTRACTION`.  The filter is made
+    once, while PHP_EXTENSIONS is still a list, and kept as
+    PHP_EXTRACT_FILTER so installing PHP again picks the same files.
+    """
+    if not ctx.get('PHP_SELECTIVE_EXTRACTION', False):
+        return None
+    include = ctx.get('PHP_EXTRACT_FILTER')
+    if include is None:
+        names = ['%s.so' % ex for ex in
+                 ctx.get('PHP_EXTENSIONS', []) +
+                 ctx.get('ZEND_EXTENSIONS', [])]
+        include = MemberFilter(PHP_EXTENSION_DIR, names)
+        ctx['PHP_EXTRACT_FILTER'] = include
+    return include
+
+
 def _get_supported_php_extensions(ctx):
-    php_extensions = []
+    # when PHP was extracted partly, only the archive has all of them
+    php_extensions = [os.path.basename(name).replace('.so', '')
+                      for name in ctx.get('PHP_ARCHIVE_INDEX', [])
+                      if fnmatchcase(os.path.dirname(name), PHP_EXTENSION_DIR)
+                      and '.so' in name]
+    if php_extensions:
+        return php_extensions
     php_extension_glob = os.path.join(ctx["PHP_INSTALL_PATH"], 'lib', 'php', 'extensions', 'no-debug-non-zts-*')
     php_extension_directory = glob.glob(php_extension_glob)[0]
     for root, dirs, files in os.walk(php_extension_directory):
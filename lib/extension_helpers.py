@@ -35,11 +35,12 @@ class ExtensionHelper(object):
         if hasattr(module, 'strip'):
             import sys
             module = sys.modules[module]
-        # register four methods that take a ctx param
+        # register five methods that take a ctx param
         for method in ('configure',
                        'preprocess_commands',
                        'service_commands',
-                       'service_environment'):
+                       'service_environment',
+                       'prefetch'):
             setattr(module, method, cls._make_helper(method))
 
         # register 'compile' method, which takes install
@@ -113,6 +114,10 @@ class ExtensionHelper(object):
         """Return dict of environment variables x[var]=val"""
         return {}
 
+    def _prefetch(self):
+        """Return list of manifest urls `compile` will install"""
+        return ()
+
     def configure(self):
         """Configure extension.
 
@@ -145,6 +150,14 @@ class ExtensionHelper(object):
         return (self._should_compile() and
                 self._service_environment() or {})
 
+    def prefetch(self):
+        """Return list of urls to start downloading before `compile`.
+
+        This method maps to the extension's `prefetch` method.
+        """
+        return (self._should_compile() and
+                self._prefetch() or ())
+
     def compile(self, install):
         """Build and install the extension.
 
@@ -12,6 +12,14 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
+from compile_helpers import module_urls
+
+REQUIRES = ()
+PROVIDES = ('web-server',)
+
+
+def configure(ctx):
+    ctx['PHP_FPM_LISTEN'] = '127.0.0.1:9000'
 
 
 def preprocess_commands(ctx):
@@ -36,11 +44,14 @@ def service_environment(ctx):
     }
 
 
+def prefetch(ctx):
+    return [ctx['HTTPD_DOWNLOAD_URL']] + module_urls(ctx, 'HTTPD')
+
+
 def compile(install):
     print 'Installing HTTPD'
     print 'HTTPD %s' % (install.builder._ctx['HTTPD_VERSION'])
 
-    install.builder._ctx['PHP_FPM_LISTEN'] = '127.0.0.1:9000'
     (install
         .package('HTTPD')
         .config()
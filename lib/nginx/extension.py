@@ -13,6 +13,13 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+REQUIRES = ()
+PROVIDES = ('web-server',)
+
+
+def configure(ctx):
+    ctx['PHP_FPM_LISTEN'] = '{TMPDIR}/php-fpm.socket'
+
 
 def preprocess_commands(ctx):
     return ((
@@ -32,9 +39,12 @@ def service_environment(ctx):
     return {}
 
 
+def prefetch(ctx):
+    return (ctx['NGINX_DOWNLOAD_URL'],)
+
+
 def compile(install):
     print 'Installing Nginx'
-    install.builder._ctx['PHP_FPM_LISTEN'] = '{TMPDIR}/php-fpm.socket'
     (install
         .package('NGINX')
         .config()
@@ -13,6 +13,9 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+REQUIRES = ()
+PROVIDES = ('web-server',)
+
 
 def preprocess_commands(ctx):
     return ()
@@ -17,13 +17,18 @@ import string
 import json
 from compile_helpers import convert_php_extensions
 from compile_helpers import is_web_app
+from compile_helpers import php_extension_filter
 from compile_helpers import find_stand_alone_app_to_run
-from compile_helpers import load_manifest
-from compile_helpers import find_all_php_versions
+from compile_helpers import load_manifest_index
+from compile_helpers import module_urls
 from compile_helpers import validate_php_version
 from compile_helpers import validate_php_extensions
 from extension_helpers import ExtensionHelper
 
+REQUIRES = ()
+PROVIDES = ('php', 'php.ini')
+
+
 def find_composer_paths(ctx):
     build_dir = ctx['BUILD_DIR']
     webdir = ctx['WEBDIR']
@@ -67,9 +72,8 @@ class PHPExtension(ExtensionHelper):
         return self._ctx['PHP_VM'] == 'php'
 
     def _configure(self):
-        manifest = load_manifest(self._ctx)
-        dependencies = manifest['dependencies']
-        self._ctx['ALL_PHP_VERSIONS'] = find_all_php_versions(dependencies)
+        manifest = load_manifest_index(self._ctx)
+        self._ctx['ALL_PHP_VERSIONS'] = manifest.versions_for('php')
 
     def _preprocess_commands(self):
         return (('$HOME/.bp/bin/rewrite', '"$HOME/php/etc"'),)
@@ -102,6 +106,10 @@ class PHPExtension(ExtensionHelper):
             env['MIBDIRS'] = '$HOME/php/mibs'
         return env
 
+    def _prefetch(self):
+        validate_php_version(self._ctx)
+        return [self._ctx['PHP_DOWNLOAD_URL']] + module_urls(self._ctx, 'PHP')
+
     def _compile(self, install):
         ctx = install.builder._ctx
 
@@ -124,7 +132,7 @@ class PHPExtension(ExtensionHelper):
         major_minor = '.'.join(string.split(ctx['PHP_VERSION'], '.')[0:2])
 
         (install
-            .package('PHP')
+            .package('PHP', php_extension_filter(ctx))
             .done())
 
         validate_php_extensions(ctx)
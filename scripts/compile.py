@@ -49,10 +49,15 @@ if __name__ == '__main__':
             .extension()
                 .from_build_pack('lib/additional_commands')
             .done()
+        .prefetch()
+            .extensions()
+            .done()
         .install()
             .build_pack_utils()
             .extensions()
             .done()
+        .prefetch()
+            .shutdown()
         .copy()
             .under('{BP_DIR}/bin')
             .into('{BUILD_DIR}/.bp/bin')
@@ -66,6 +71,11 @@ if __name__ == '__main__':
             .done()
         .create_start_script()
             .using_process_manager()
-            .write())
+            .write()
+        .profile()
+            .to_json()
+            .context_journal()
+            .summary()
+            .done())
 
     print 'Finished: [%s]' % datetime.now()
@@ -17,6 +17,9 @@
 from build_pack_utils import Builder
 import sys
 
+# the buildpack version, not the cache dir `CloudFoundryUtil` looks for
+version = sys.argv.pop(2)
+
 (Builder()
      .configure()  # noqa
          .default_config()
@@ -24,16 +27,16 @@ import sys
          .done()
      .detect()
          .find_composer_path()
-         .if_found_output('php ' + sys.argv[2])
+         .if_found_output('php ' + version)
          .when_not_found_continue()
          .done()
      .detect()
          .ends_with(".php")
          .recursive()
-         .if_found_output('php ' + sys.argv[2])
+         .if_found_output('php ' + version)
          .when_not_found_continue()
          .done()
      .detect()
         .by_name('{WEBDIR}')
-        .if_found_output('php ' + sys.argv[2])
+        .if_found_output('php ' + version)
         .done())
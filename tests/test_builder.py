@@ -0,0 +1,371 @@
+import os
+import shutil
+import tempfile
+import threading
+import subprocess
+from nose.tools import eq_
+from build_pack_utils import utils
+from build_pack_utils.builder import Builder
+from build_pack_utils.builder import FileUtil
+from build_pack_utils.builder import ModuleInstaller
+from build_pack_utils.builder import PrefetchBuilder
+from build_pack_utils.builder import Runner
+from build_pack_utils.builder import RunnerGroup
+from build_pack_utils.runner import stream_process
+
+
+class FakeBuilder(object):
+    def __init__(self, ctx):
+        self._ctx = ctx
+        self._profiler = None
+
+
+class FakeInstaller(object):
+    def __init__(self, builder):
+        self.builder = builder
+
+
+class RecordingCloudFoundryInstaller(object):
+    def __init__(self, fail=()):
+        self.urls = []
+        self._fail = fail
+        self._lock = threading.Lock()
+
+    def _install_binary_from_manifest(self, url, installDir, strip=False,
+                                      extract=True):
+        with self._lock:
+            self.urls.append((url, installDir, strip))
+        for name in self._fail:
+            if name in url:
+                raise RuntimeError('Could not download dependency: %s' % url)
+        return installDir
+
+
+class TestModuleInstaller(object):
+    def setUp(self):
+        self.build_dir = tempfile.mkdtemp(prefix='build-')
+
+    def tearDown(self):
+        if os.path.exists(self.build_dir):
+            shutil.rmtree(self.build_dir)
+
+    def _installer(self, parallelism, cf):
+        ctx = utils.FormattedDict({
+            'BUILD_DIR': self.build_dir,
+            'TMPDIR': tempfile.gettempdir(),
+            'PHP_VERSION': '5.6.30',
+            'PHP_MODULES_PATTERN': '/php/{PHP_VERSION}/'
+                                   'php-{MODULE_NAME}-{PHP_VERSION}.tar.gz',
+            'PHP_MODULES_STRIP': True,
+            'PHP_MODULES_PARALLELISM': parallelism
+        })
+        installer = FakeInstaller(FakeBuilder(ctx))
+        modules = ModuleInstaller(installer, 'PHP')
+        modules._cf = cf
+        return installer, modules
+
+    def _assert_installed(self, cf, names):
+        toPath = os.path.join(self.build_dir, 'php')
+        eq_(sorted([('/php/5.6.30/php-%s-5.6.30.tar.gz' % name, toPath, True)
+                    for name in names]),
+            sorted(cf.urls))
+
+    def test_serial(self):
+        cf = RecordingCloudFoundryInstaller()
+        installer, modules = self._installer(1, cf)
+        eq_(installer, (modules.include_module('bz2')
+                               .include_module('zlib')
+                               .done()))
+        self._assert_installed(cf, ['bz2', 'zlib'])
+        eq_(False, 'MODULE_NAME' in installer.builder._ctx)
+
+    def test_parallel_failures_are_warnings(self):
+        cf = RecordingCloudFoundryInstaller(fail=('php-zlib',))
+        installer, modules = self._installer(4, cf)
+        for name in ('bz2', 'zlib', 'curl', 'gd', 'mcrypt'):
+            modules.include_module(name)
+        eq_(installer, modules.done())
+        self._assert_installed(cf, ['bz2', 'zlib', 'curl', 'gd', 'mcrypt'])
+        eq_(False, 'MODULE_NAME' in installer.builder._ctx)
+
+
+EXTENSION = """
+import time
+%(declare)s
+
+def compile(install):
+    events = install.builder._ctx['EVENTS']
+    events.append(('start', %(name)r))
+    time.sleep(%(delay)r)
+    if %(fail)r:
+        raise RuntimeError('%(name)s failed')
+    events.append(('end', %(name)r))
+    return %(retcode)r
+"""
+
+
+class TestInstallerExtensions(object):
+    def setUp(self):
+        self.extn_dir = tempfile.mkdtemp(prefix='extensions_')
+        self.build_dir = tempfile.mkdtemp(prefix='build-')
+        self.builder = Builder()
+        self.builder._ctx = utils.FormattedDict({
+            'BP_DIR': self.extn_dir,
+            'BUILD_DIR': self.build_dir,
+            'TMPDIR': self.build_dir,
+            'EXTENSIONS': [],
+            'EXTENSIONS_PARALLELISM': 4,
+            'EVENTS': []
+        })
+        self.register = self.builder.register()
+
+    def tearDown(self):
+        shutil.rmtree(self.extn_dir)
+        shutil.rmtree(self.build_dir)
+
+    def _extension(self, name, requires=None, provides=None, delay=0,
+                   fail=False, retcode=0):
+        # extensions are imported by folder name, keep them unique
+        path = os.path.join(self.extn_dir, '%s_%s' % (
+            name, os.path.basename(self.extn_dir)))
+        os.makedirs(path)
+        declare = ''
+        if requires is not None:
+            declare += 'REQUIRES = %r\n' % (requires,)
+        if provides is not None:
+            declare += 'PROVIDES = %r\n' % (provides,)
+        with open(os.path.join(path, 'extension.py'), 'wt') as f:
+            f.write(EXTENSION % {
+                'name': name, 'declare': declare, 'delay': delay,
+                'fail': fail, 'retcode': retcode})
+        self.register.extension().from_path(path)
+
+    def _events(self):
+        return self.builder._ctx['EVENTS']
+
+    def test_dependent_hooks_run_in_order(self):
+        self._extension('php', provides=('php',), delay=0.3)
+        self._extension('composer', requires=('php',), provides=('vendor',))
+        self._extension('newrelic', provides=('newrelic',), delay=0.1)
+        self.builder.install().extensions()
+        events = self._events()
+        eq_(6, len(events))
+        # composer waits for php, newrelic doesn't
+        eq_(True, events.index(('end', 'php')) <
+            events.index(('start', 'composer')))
+        eq_(True, events.index(('start', 'newrelic')) <
+            events.index(('end', 'php')))
+        eq_(3, len(self.builder._ctx['EXTENSIONS']))
+
+    def test_undeclared_hooks_run_alone(self):
+        self._extension('php', provides=('php',), delay=0.1)
+        self._extension('legacy', delay=0.1)
+        self._extension('newrelic', provides=('newrelic',))
+        self.builder.install().extensions()
+        eq_([('start', 'php'), ('end', 'php'),
+             ('start', 'legacy'), ('end', 'legacy'),
+             ('start', 'newrelic'), ('end', 'newrelic')], self._events())
+
+    def test_failure_fails_the_build(self):
+        self._extension('php', provides=('php',), fail=True)
+        self._extension('composer', requires=('php',))
+        try:
+            self.builder.install().extensions()
+        except RuntimeError, e:
+            eq_('php failed', str(e))
+        else:
+            assert False, 'expected RuntimeError'
+        # dependents of the failed hook don't run
+        eq_([('start', 'php')], self._events())
+        eq_([], self.builder._ctx['EXTENSIONS'])
+
+    def test_exit_code_fails_the_build(self):
+        self._extension('php', provides=('php',), retcode=1)
+        self._extension('newrelic', provides=('newrelic',))
+        try:
+            self.builder.install().extensions()
+        except RuntimeError, e:
+            eq_('Extension Failed with [1]', str(e))
+        else:
+            assert False, 'expected RuntimeError'
+
+
+class TestPrefetchBuilder(object):
+    def test_collects_urls_once(self):
+        builder = FakeBuilder(utils.FormattedDict({
+            'PHP_VERSION': '5.6.30',
+            'PHP_DOWNLOAD_URL': '/php/{PHP_VERSION}/php-{PHP_VERSION}.tar.gz',
+            'HTTPD_DOWNLOAD_URL': '/httpd/2.4.25/httpd-2.4.25.tar.gz',
+            'PREFETCH_PARALLELISM': 0
+        }))
+        prefetch = (PrefetchBuilder(builder)
+                    .packages('PHP', 'HTTPD', 'NGINX')
+                    .url('/php/{PHP_VERSION}/php-{PHP_VERSION}.tar.gz'))
+        eq_(['/php/5.6.30/php-5.6.30.tar.gz',
+             '/httpd/2.4.25/httpd-2.4.25.tar.gz'], prefetch._urls)
+        eq_(builder, prefetch.done())
+
+
+class TestFileUtil(object):
+    def setUp(self):
+        self.build_dir = tempfile.mkdtemp(prefix='build-')
+        self.from_dir = os.path.join(self.build_dir, 'from')
+        self.into_dir = os.path.join(self.build_dir, 'into')
+        for path in ('index.php', 'lib/a.php', 'lib/sub/b.php',
+                     'vendor/c.php', '.bp/d.txt'):
+            path = os.path.join(self.from_dir, path)
+            utils.safe_makedirs(os.path.dirname(path))
+            open(path, 'wt').close()
+        os.makedirs(os.path.join(self.from_dir, 'vendor', 'empty'))
+
+    def tearDown(self):
+        if os.path.exists(self.build_dir):
+            shutil.rmtree(self.build_dir)
+
+    def _file_util(self, move=False):
+        builder = FakeBuilder(utils.FormattedDict({
+            'BUILD_DIR': self.build_dir}))
+        return (FileUtil(builder, move=move)
+                .under(self.from_dir)
+                .into(self.into_dir))
+
+    def _files(self, path):
+        found = []
+        for root, dirs, files in os.walk(path):
+            for f in files:
+                found.append(os.path.relpath(os.path.join(root, f), path))
+        return sorted(found)
+
+    def test_prunes_excluded_subtrees(self):
+        fu = (self._file_util()
+              .where_name_does_not_match('^%s.*$' %
+                                         os.path.join(self.from_dir,
+                                                      'vendor')))
+        walked = []
+        walk = fu._walk
+
+        def record(top, plan):
+            for item in walk(top, plan):
+                walked.append(os.path.relpath(item[0], self.from_dir))
+                yield item
+        fu._walk = record
+        fu.done()
+        eq_(['.bp/d.txt', 'index.php', 'lib/a.php', 'lib/sub/b.php'],
+            self._files(self.into_dir))
+        eq_(False, any(path.startswith('vendor') for path in walked))
+
+    def test_selects_matching_subtree(self):
+        (self._file_util()
+            .where_name_matches('^%s/.*$' % os.path.join(self.from_dir,
+                                                          'lib'))
+            .done())
+        eq_(['a.php', 'sub/b.php'],
+            self._files(os.path.join(self.into_dir, 'lib')))
+        eq_(['lib/a.php', 'lib/sub/b.php'], self._files(self.into_dir))
+
+    def test_any_true_with_complex_filters(self):
+        (self._file_util(move=True)
+            .any_true()
+            .where_name_is('c.php')
+            .where_name_matches('^%s/.*\\.txt$' % self.from_dir)
+            .done())
+        eq_(['.bp/d.txt', 'vendor/c.php'], self._files(self.into_dir))
+        eq_(['index.php', 'lib/a.php', 'lib/sub/b.php'],
+            self._files(self.from_dir))
+        eq_(False, os.path.exists(os.path.join(self.from_dir, 'vendor')))
+
+    def test_move_renames_whole_directories(self):
+        lib = os.stat(os.path.join(self.from_dir, 'lib'))
+        vendor = os.stat(os.path.join(self.from_dir, 'vendor'))
+        (self._file_util(move=True)
+            .where_name_does_not_match('^%s$' %
+                                       os.path.join(self.from_dir,
+                                                    'index.php'))
+            .where_name_does_not_match('^%s/vendor/c.*$' % self.from_dir)
+            .done())
+        eq_(['.bp/d.txt', 'lib/a.php', 'lib/sub/b.php'],
+            self._files(self.into_dir))
+        eq_(['index.php', 'vendor/c.php'], self._files(self.from_dir))
+        eq_(lib.st_ino, os.stat(os.path.join(self.into_dir, 'lib')).st_ino)
+        eq_(vendor.st_ino,
+            os.stat(os.path.join(self.from_dir, 'vendor')).st_ino)
+        eq_(True, os.path.exists(os.path.join(self.into_dir, 'vendor',
+                                              'empty')))
+
+
+class TestRunner(object):
+    def setUp(self):
+        self.build_dir = tempfile.mkdtemp(prefix='build-')
+        self.builder = FakeBuilder(utils.FormattedDict({
+            'BUILD_DIR': self.build_dir}))
+
+    def tearDown(self):
+        if os.path.exists(self.build_dir):
+            shutil.rmtree(self.build_dir)
+
+    def test_streams_lines(self):
+        lines = []
+        finished = []
+        (Runner(self.builder)
+            .command(['sh', '-c', 'echo one; echo two >&2; printf three'])
+            .out_of('BUILD_DIR')
+            .on_line(lambda stream, line: lines.append((stream, line)))
+            .tee_to('{BUILD_DIR}/logs/output.log')
+            .on_finish(lambda cmd, code, out, err: finished.append(
+                (code, out, err)))
+            .done())
+        eq_([('stderr', 'two'), ('stdout', 'one'), ('stdout', 'three')],
+            sorted(lines))
+        eq_([(0, 'one\nthree', 'two\n')], finished)
+        with open(os.path.join(self.build_dir, 'logs', 'output.log')) as f:
+            eq_(sorted('one\ntwo\nthree'), sorted(f.read()))
+
+    def test_retains_last_bytes(self):
+        chunks = []
+        finished = []
+        (Runner(self.builder)
+            .command(['sh', '-c', 'seq 1 1000; exit 3'])
+            .on_chunk(lambda stream, data: chunks.append(data))
+            .retain(9)
+            .on_finish(lambda cmd, code, out, err: finished.append(
+                (code, out, err)))
+            .done())
+        eq_([(3, '\n999\n1000\n'[-9:], '')], finished)
+        eq_('\n'.join(str(i) for i in range(1, 1001)) + '\n',
+            ''.join(chunks))
+
+    def test_long_line_without_line_feed(self):
+        lines = []
+        proc = subprocess.Popen(
+            ['sh', '-c', 'head -c 10000 /dev/zero | tr "\\0" x; echo; '
+                         'echo done'],
+            stdout=subprocess.PIPE)
+        out, err = stream_process(
+            proc, on_line=lambda stream, line: lines.append(line),
+            retain=16, chunk_size=512, max_line=4096)
+        proc.wait()
+        eq_([4096, 4096, 1808, 4], [len(line) for line in lines])
+        eq_('x' * 10000, ''.join(lines[:3]))
+        eq_('done', lines[-1])
+        eq_('x' * 10 + '\ndone\n', out)
+
+    def test_group(self):
+        results = []
+        (RunnerGroup(self.builder)
+            .parallelism(2)
+            .run()
+                .command(['sh', '-c', 'sleep 0.2; pwd'])
+                .out_of('BUILD_DIR')
+                .on_success(lambda cmd, code, out: results.append(out))
+                .done()
+            .run()
+                .command(['sh', '-c', 'exit 2'])
+                .on_fail(lambda cmd, code, err: results.append(code))
+                .done()
+            .on_finish(results.append)
+            .done())
+        eq_(2, results[0])
+        eq_(self.build_dir, os.path.realpath(results[1].strip()))
+        eq_([0, 2], [r['returncode'] for r in results[2]])
+        eq_(True, results[2][0]['duration'] >= 0.2)
+        eq_(self.build_dir, results[2][0]['cwd'])
@@ -4,6 +4,7 @@ import tempfile
 import shutil
 from nose.tools import eq_
 from build_pack_utils import utils
+from build_pack_utils.manifest import ManifestIndex
 from compile_helpers import setup_webdir_if_it_doesnt_exist
 from compile_helpers import convert_php_extensions
 from compile_helpers import is_web_app
@@ -11,6 +12,9 @@ from compile_helpers import find_stand_alone_app_to_run
 from compile_helpers import load_manifest
 from compile_helpers import find_all_php_versions
 from compile_helpers import validate_php_version
+from compile_helpers import validate_php_extensions
+from compile_helpers import php_extension_filter
+from compile_helpers import module_urls
 from compile_helpers import setup_log_dir
 
 
@@ -283,6 +287,33 @@ class TestCompileHelpers(object):
         assert 'url_to_dependency_map' in manifest.keys()
         assert 'exclude_files' in manifest.keys()
 
+    def test_load_manifest_index_cache(self):
+        os.makedirs(self.build_dir)
+        ctx = {'BP_DIR': '.', 'BUILD_DIR': self.build_dir}
+        ManifestIndex._cache.clear()
+        assert load_manifest(ctx) is not None
+        eq_([], os.listdir(self.build_dir))
+        ctx['CACHE_DIR'] = self.cache_dir
+        os.makedirs(self.cache_dir)
+        ManifestIndex._cache.clear()
+        assert load_manifest(ctx) is not None
+        eq_(1, len(os.listdir(os.path.join(self.cache_dir,
+                                           'manifest-index'))))
+
+    def test_module_urls(self):
+        ctx = utils.FormattedDict({
+            'HTTPD_VERSION': '2.4.25',
+            'HTTPD_MODULES_PATTERN': '/httpd/{HTTPD_VERSION}/'
+                                     'httpd-{MODULE_NAME}-{HTTPD_VERSION}'
+                                     '.tar.gz',
+            'HTTPD_MODULES': ['mod_ssl', 'mod_rewrite']
+        })
+        eq_(['/httpd/2.4.25/httpd-mod_ssl-2.4.25.tar.gz',
+             '/httpd/2.4.25/httpd-mod_rewrite-2.4.25.tar.gz'],
+            module_urls(ctx, 'HTTPD'))
+        eq_(False, 'MODULE_NAME' in ctx)
+        eq_([], module_urls(ctx, 'NGINX'))
+
     def test_find_all_php_versions(self):
         ctx = {'BP_DIR': '.'}
         manifest = load_manifest(ctx)
@@ -305,3 +336,35 @@ class TestCompileHelpers(object):
         ctx['PHP_VERSION'] = '5.5.30'
         validate_php_version(ctx)
         eq_('5.5.30', ctx['PHP_VERSION'])
+
+    def test_php_extension_filter(self):
+        eq_(None, php_extension_filter({'PHP_EXTENSIONS': ['bz2']}))
+        ctx = {
+            'PHP_SELECTIVE_EXTRACTION': True,
+            'PHP_EXTENSIONS': ['bz2', 'curl'],
+            'ZEND_EXTENSIONS': ['opcache']
+        }
+        include = php_extension_filter(ctx)
+        # converted to php.ini lines once PHP is installed
+        ctx['PHP_EXTENSIONS'] = 'extension=bz2.so\nextension=curl.so'
+        eq_(True, include is php_extension_filter(ctx))
+        extDir = 'lib/php/extensions/no-debug-non-zts-20131226'
+        eq_(True, include('bin/php'))
+        eq_(True, include('lib/libphp.so'))
+        eq_(True, include(extDir))
+        eq_(True, include('%s/curl.so' % extDir))
+        eq_(True, include('%s/opcache.so' % extDir))
+        eq_(False, include('%s/mysqli.so' % extDir))
+
+    def test_validate_php_extensions_from_archive_index(self):
+        extDir = 'lib/php/extensions/no-debug-non-zts-20131226'
+        ctx = {
+            'PHP_INSTALL_PATH': self.build_dir,
+            'PHP_EXTENSIONS': ['bz2', 'curl', 'missing'],
+            'PHP_ARCHIVE_INDEX': ['bin/', 'bin/php', '%s/' % extDir,
+                                  '%s/bz2.so' % extDir,
+                                  '%s/curl.so' % extDir,
+                                  '%s/mysqli.so' % extDir]
+        }
+        validate_php_extensions(ctx)
+        eq_(['bz2', 'curl'], ctx['PHP_EXTENSIONS'])
@@ -82,6 +82,32 @@ class TestComposer(object):
         assert re.match('/composer/[\d\.]+/composer.phar', installer._installer.calls()[0].args[0]), \
             "was %s" % installer._installer.calls()[0].args[0]
 
+    def test_composer_tool_install_selected_extensions(self):
+        ctx = utils.FormattedDict({
+            'BP_DIR': '',
+            'PHP_VM': 'will_default_to_php_strategy',
+            'BUILD_DIR': '/build/dir',
+            'CACHE_DIR': '/cache/dir',
+            'WEBDIR': '',
+            'PHP_SELECTIVE_EXTRACTION': True,
+            'PHP_EXTENSIONS': ['bz2', 'openssl'],
+            'ZEND_EXTENSIONS': []
+        })
+        builder = Dingus(_ctx=ctx)
+        installer = Dingus()
+        builder.install = Dingus(_installer=Dingus(),
+                                 return_value=installer)
+        ct = self.extension_module.ComposerExtension(ctx)
+        ct._builder = builder
+        ct.install()
+        # PHP is installed again with the same files
+        eq_('PHP', installer.package.calls()[0].args[0])
+        include = installer.package.calls()[0].args[1]
+        eq_(True, include is ctx['PHP_EXTRACT_FILTER'])
+        extDir = 'lib/php/extensions/no-debug-non-zts-20131226'
+        eq_(True, include('%s/openssl.so' % extDir))
+        eq_(False, include('%s/mysqli.so' % extDir))
+
     def test_composer_tool_install_latest(self):
         ctx = utils.FormattedDict({
             'PHP_VM': 'will_default_to_php_strategy',
@@ -0,0 +1,456 @@
+import os
+import shutil
+import hashlib
+import tarfile
+import tempfile
+from nose.tools import eq_
+from build_pack_utils.downloads import DownloadCache
+from build_pack_utils.downloads import Downloader
+from build_pack_utils.downloads import Prefetcher
+from build_pack_utils.downloads import TreeCache
+from build_pack_utils.cloudfoundry import CloudFoundryInstaller
+from build_pack_utils.zips import MemberFilter
+
+
+class TestDownloadCache(object):
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp(prefix='cache-')
+        self.tmp_dir = tempfile.mkdtemp(prefix='tmp-')
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_dir)
+        shutil.rmtree(self.tmp_dir)
+
+    def _file(self, name, size):
+        path = os.path.join(self.tmp_dir, name)
+        with open(path, 'wb') as f:
+            f.write('x' * size)
+        return path
+
+    def test_fetch_after_store(self):
+        cache = DownloadCache(self.cache_dir, 1024)
+        key = DownloadCache.key_for('http://mock.com/php.tgz', 'abc')
+        toFile = os.path.join(self.tmp_dir, 'out', 'php.tgz')
+        eq_(False, cache.fetch(key, toFile))
+        cache.store(key, self._file('php.tgz', 100))
+        eq_(True, cache.fetch(key, toFile))
+        eq_(100, os.path.getsize(toFile))
+        eq_(False, key == DownloadCache.key_for('http://mock.com/php.tgz',
+                                                'def'))
+        eq_({'hits': 1, 'misses': 1, 'stores': 1, 'evictions': 0,
+             'bytes_from_cache': 100}, cache.stats())
+
+    def test_writing_over_files_does_not_change_cache(self):
+        cache = DownloadCache(self.cache_dir, 1024)
+        key = DownloadCache.key_for('http://mock.com/php.tgz', 'abc')
+        fromFile = self._file('php.tgz', 100)
+        cache.store(key, fromFile)
+        with open(fromFile, 'wb') as f:
+            f.write('partial')
+        toFile = os.path.join(self.tmp_dir, 'out', 'php.tgz')
+        eq_(True, cache.fetch(key, toFile))
+        eq_(1, os.stat(toFile).st_nlink)
+        with open(toFile, 'wb') as f:
+            f.write('partial')
+        eq_(True, cache.fetch(key, toFile))
+        eq_('x' * 100, open(toFile, 'rb').read())
+
+    def test_evicts_least_recently_used(self):
+        cache = DownloadCache(self.cache_dir, 250)
+        keys = [DownloadCache.key_for(name) for name in ('a', 'b', 'c')]
+        cache.store(keys[0], self._file('a', 100))
+        cache.store(keys[1], self._file('b', 100))
+        past = os.path.join(self.cache_dir, 'downloads', keys[1])
+        os.utime(past, (1, 1))
+        cache.store(keys[2], self._file('c', 100))
+        eq_(sorted([keys[0], keys[2]]),
+            sorted(os.listdir(os.path.join(self.cache_dir, 'downloads'))))
+        eq_(1, cache.stats()['evictions'])
+
+
+class TestTreeCache(object):
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp(prefix='cache-')
+        self.tmp_dir = tempfile.mkdtemp(prefix='tmp-')
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_dir)
+        shutil.rmtree(self.tmp_dir)
+
+    def _extract(self, size):
+        def extract(path):
+            os.makedirs(os.path.join(path, 'bin'))
+            with open(os.path.join(path, 'bin', 'php'), 'wb') as f:
+                f.write('x' * size)
+            os.symlink('php', os.path.join(path, 'bin', 'php-cgi'))
+            return path
+        return extract
+
+    def test_materialize_after_add(self):
+        cache = TreeCache(self.cache_dir, 1024)
+        key = TreeCache.key_for(DownloadCache.key_for('php.tgz', 'abc'), True)
+        first = os.path.join(self.tmp_dir, 'first')
+        second = os.path.join(self.tmp_dir, 'second')
+        eq_(False, cache.materialize(key, first))
+        eq_(False, os.path.exists(first))
+        cache.add(key, first, self._extract(100))
+        eq_(True, cache.materialize(key, second))
+        eq_('php', os.readlink(os.path.join(second, 'bin', 'php-cgi')))
+        eq_(True, os.path.samefile(os.path.join(first, 'bin', 'php'),
+                                   os.path.join(second, 'bin', 'php')))
+        eq_(False, key == TreeCache.key_for(
+            DownloadCache.key_for('php.tgz', 'abc'), False))
+        eq_({'hits': 1, 'misses': 1, 'stores': 1, 'evictions': 0,
+             'files_linked': 2}, cache.stats())
+
+    def test_materialize_into_same_directory(self):
+        cache = TreeCache(self.cache_dir, 1024)
+        into = os.path.join(self.tmp_dir, 'php')
+        cache.add('a', into, self._extract(100))
+        os.chmod(os.path.join(into, 'bin'), 0555)
+        eq_(True, cache.materialize('a', into))
+        # an extracted tree over the links from the cache
+        extract = self._extract(50)
+        eq_(into, cache.add('b', into, lambda path: extract(path) and into))
+        eq_(50, os.path.getsize(os.path.join(into, 'bin', 'php')))
+        eq_('php', os.readlink(os.path.join(into, 'bin', 'php-cgi')))
+        eq_(True, cache.materialize('a', into))
+        eq_(100, os.path.getsize(os.path.join(into, 'bin', 'php')))
+        eq_(0, cache.stats()['misses'])
+
+    def test_not_kept_when_extract_fails(self):
+        cache = TreeCache(self.cache_dir, 1024)
+        eq_(False, cache.add('a', os.path.join(self.tmp_dir, 'a'),
+                             lambda path: False))
+        eq_([], os.listdir(os.path.join(self.cache_dir, 'trees')))
+
+    def test_evicts_least_recently_used(self):
+        cache = TreeCache(self.cache_dir, 250)
+        for name in ('a', 'b', 'c'):
+            cache.add(name, os.path.join(self.tmp_dir, name),
+                      self._extract(100))
+            os.utime(os.path.join(self.cache_dir, 'trees', name),
+                     (len(name), name == 'a' and 3 or 2))
+        cache.evict()
+        eq_(['a', 'a.json', 'c', 'c.json'],
+            sorted(os.listdir(os.path.join(self.cache_dir, 'trees'))))
+        eq_(1, cache.stats()['evictions'])
+
+
+class TestPrefetcher(object):
+    def test_waits_for_prefetched(self):
+        fetched = []
+
+        def fetch(url):
+            fetched.append(url)
+            return '/tmp/%s' % url
+        prefetcher = Prefetcher(2)
+        prefetcher.submit('php.tgz', lambda: fetch('php.tgz'))
+        prefetcher.submit('php.tgz', lambda: fetch('php.tgz'))
+        eq_('/tmp/php.tgz', prefetcher.wait_for('php.tgz'))
+        eq_(None, prefetcher.wait_for('httpd.tgz'))
+        eq_(['php.tgz'], fetched)
+        eq_(['php.tgz'], prefetcher.urls())
+        prefetcher.shutdown()
+
+    def test_failures_are_left_to_installer(self):
+        def fail():
+            raise RuntimeError('Could not download dependency')
+        prefetcher = Prefetcher(2)
+        prefetcher.submit('php.tgz', fail)
+        eq_(None, prefetcher.wait_for('php.tgz'))
+        prefetcher.shutdown()
+
+    def test_one_per_directory(self):
+        eq_(True, Prefetcher.for_dir('/tmp/a') is Prefetcher.for_dir('/tmp/a'))
+        eq_(False, Prefetcher.for_dir('/tmp/a') is Prefetcher.for_dir('/tmp/b'))
+
+    def test_shutdown_dir(self):
+        prefetcher = Prefetcher.for_dir('/tmp/c', 2)
+        done = []
+        prefetcher.submit('php.tgz', lambda: done.append('php.tgz'))
+        Prefetcher.shutdown_dir('/tmp/c')
+        eq_(['php.tgz'], done)
+        eq_([], prefetcher._pool._threads)
+        eq_(False, prefetcher is Prefetcher.for_dir('/tmp/c'))
+        Prefetcher.shutdown_dir('/tmp/c')
+        Prefetcher.shutdown_dir('/tmp/missing')
+
+
+class TestStreamingInstall(object):
+    def setUp(self):
+        self.bp_dir = tempfile.mkdtemp(prefix='bp-')
+        self.tmp_dir = tempfile.mkdtemp(prefix='tmp-')
+        self.build_dir = tempfile.mkdtemp(prefix='build-')
+        src = os.path.join(self.tmp_dir, 'php-5.6.30', 'bin')
+        os.makedirs(src)
+        with open(os.path.join(src, 'php'), 'wt') as f:
+            f.write('php')
+        os.symlink('php', os.path.join(src, 'phar'))
+        uri = 'https://buildpacks.cloudfoundry.org/php-5.6.30.tgz'
+        deps = os.path.join(self.bp_dir, 'dependencies')
+        os.makedirs(deps)
+        archive = os.path.join(deps, uri.replace(':', '_').replace('/', '_'))
+        with tarfile.open(archive, 'w:gz') as tar:
+            tar.add(os.path.join(self.tmp_dir, 'php-5.6.30'), 'php-5.6.30')
+        shutil.rmtree(os.path.join(self.tmp_dir, 'php-5.6.30'))
+        with open(archive, 'rb') as f:
+            md5 = hashlib.md5(f.read()).hexdigest()
+        with open(archive, 'rb') as f:
+            self.sha256 = hashlib.sha256(f.read()).hexdigest()
+        with open(os.path.join(self.bp_dir, 'manifest.yml'), 'wt') as f:
+            f.write('url_to_dependency_map:\n'
+                    '- match: "php-(\\\\d+\\\\.\\\\d+\\\\.\\\\d+)"\n'
+                    '  name: php\n'
+                    '  version: "$1"\n'
+                    'dependencies:\n'
+                    '- name: php\n'
+                    '  version: 5.6.30\n'
+                    '  uri: %s\n'
+                    '  md5: %s\n' % (uri, md5))
+
+    def tearDown(self):
+        shutil.rmtree(self.bp_dir)
+        shutil.rmtree(self.tmp_dir)
+        shutil.rmtree(self.build_dir)
+
+    def test_download_into_directory(self):
+        downloader = Downloader({
+            'BP_DIR': self.bp_dir,
+            'TMPDIR': self.tmp_dir
+        })
+        downloader.download('/php/5.6.30/php-5.6.30.tgz', self.tmp_dir)
+        path = os.path.join(self.tmp_dir, 'php-5.6.30.tgz')
+        with tarfile.open(path, 'r:gz') as tar:
+            eq_(True, 'php-5.6.30/bin/php' in tar.getnames())
+        eq_(['php-5.6.30.tgz'], os.listdir(self.tmp_dir))
+        eq_(['md5'], downloader.verified_digests(path).keys())
+
+    def test_download_retries(self):
+        downloader = Downloader({
+            'BP_DIR': self.bp_dir,
+            'TMPDIR': self.tmp_dir,
+            'DOWNLOAD_RETRIES': 1,
+            'DOWNLOAD_RETRY_BACKOFF': 0
+        })
+        opened = []
+        open_url = downloader._open
+
+        def flaky(req, *args, **kwargs):
+            opened.append(req)
+            if len(opened) == 1:
+                raise IOError('connection reset')
+            return open_url(req, *args, **kwargs)
+        downloader._open = flaky
+        toFile = os.path.join(self.tmp_dir, 'php.tgz')
+        downloader.download('/php/5.6.30/php-5.6.30.tgz', toFile)
+        eq_(2, len(opened))
+        eq_(True, os.path.exists(toFile))
+        downloader._ctx['DOWNLOAD_RETRIES'] = 0
+        del opened[:]
+        try:
+            downloader.download('/php/5.6.30/php-5.6.30.tgz', toFile)
+        except RuntimeError, e:
+            eq_('Could not download dependency: '
+                '/php/5.6.30/php-5.6.30.tgz', str(e))
+        else:
+            assert False, 'expected RuntimeError'
+        eq_(1, len(opened))
+
+    def test_extracts_while_downloading(self):
+        installer = CloudFoundryInstaller({
+            'BP_DIR': self.bp_dir,
+            'TMPDIR': self.tmp_dir,
+            'BUILD_DIR': self.build_dir,
+            'PREFETCH_PARALLELISM': 0,
+            'DOWNLOAD_EXTRACT_PIPELINE': True
+        })
+        installDir = os.path.join(self.build_dir, 'php')
+        eq_(installDir, installer._install_binary_from_manifest(
+            '/php/5.6.30/php-5.6.30.tgz', installDir, strip=True))
+        eq_('php', open(os.path.join(installDir, 'bin', 'php')).read())
+        eq_([], os.listdir(self.tmp_dir))
+        eq_(['php'], os.listdir(self.build_dir))
+        eq_(0755, os.stat(installDir).st_mode & 0777)
+
+    def test_extracts_into_existing_directory(self):
+        installer = CloudFoundryInstaller({
+            'BP_DIR': self.bp_dir,
+            'TMPDIR': self.tmp_dir,
+            'BUILD_DIR': self.build_dir,
+            'PREFETCH_PARALLELISM': 0,
+            'DOWNLOAD_EXTRACT_PIPELINE': True
+        })
+        installDir = os.path.join(self.build_dir, 'php')
+        os.makedirs(os.path.join(installDir, 'etc'))
+        # the second time installDir already has the tree
+        for i in range(2):
+            installer._install_binary_from_manifest(
+                '/php/5.6.30/php-5.6.30.tgz', installDir, strip=True)
+            eq_(['bin', 'etc'], sorted(os.listdir(installDir)))
+            eq_('php', open(os.path.join(installDir, 'bin', 'php')).read())
+            eq_('php', os.readlink(os.path.join(installDir, 'bin', 'phar')))
+            eq_(['php'], os.listdir(self.build_dir))
+
+    def test_installs_cached_tree(self):
+        ctx = {
+            'BP_DIR': self.bp_dir,
+            'TMPDIR': self.tmp_dir,
+            'BUILD_DIR': self.build_dir,
+            'CACHE_DIR': os.path.join(self.tmp_dir, 'cache'),
+            'TREE_CACHE_SIZE_MB': 1,
+            'PREFETCH_PARALLELISM': 0,
+            'DOWNLOAD_EXTRACT_PIPELINE': True
+        }
+        installDir = os.path.join(self.build_dir, 'php')
+        CloudFoundryInstaller(ctx)._install_binary_from_manifest(
+            '/php/5.6.30/php-5.6.30.tgz', installDir, strip=True)
+        restaged = os.path.join(self.build_dir, 'restaged')
+        installer = CloudFoundryInstaller(ctx)
+        eq_(restaged, installer._install_binary_from_manifest(
+            '/php/5.6.30/php-5.6.30.tgz', restaged, strip=True))
+        eq_('php', open(os.path.join(restaged, 'bin', 'php')).read())
+        eq_(True, os.path.samefile(os.path.join(installDir, 'bin', 'php'),
+                                   os.path.join(restaged, 'bin', 'php')))
+        eq_(1, installer.tree_cache_stats()['hits'])
+        # it's not extracted again
+        eq_(0, installer._unzipUtil.stats()['archives'])
+
+    def test_installs_cached_tree_twice(self):
+        ctx = {
+            'BP_DIR': self.bp_dir,
+            'TMPDIR': self.tmp_dir,
+            'BUILD_DIR': self.build_dir,
+            'CACHE_DIR': os.path.join(self.tmp_dir, 'cache'),
+            'TREE_CACHE_SIZE_MB': 1,
+            'PREFETCH_PARALLELISM': 0,
+            'DOWNLOAD_EXTRACT_PIPELINE': True
+        }
+        installDir = os.path.join(self.build_dir, 'php')
+        installer = CloudFoundryInstaller(ctx)
+        # like composer, which installs PHP again into the same place
+        for i in range(2):
+            eq_(installDir, installer._install_binary_from_manifest(
+                '/php/5.6.30/php-5.6.30.tgz', installDir, strip=True))
+        eq_('php', os.readlink(os.path.join(installDir, 'bin', 'phar')))
+        eq_({'hits': 1, 'misses': 1}, dict(
+            (name, installer.tree_cache_stats()[name])
+            for name in ('hits', 'misses')))
+
+    def _add_extensions(self):
+        """Rebuild the archive with two extensions"""
+        deps = os.path.join(self.bp_dir, 'dependencies')
+        archive = os.path.join(deps, os.listdir(deps)[0])
+        src = os.path.join(self.tmp_dir, 'src')
+        with tarfile.open(archive, 'r:gz') as tar:
+            tar.extractall(src)
+        extDir = os.path.join(src, 'php-5.6.30', 'lib', 'php', 'extensions',
+                              'no-debug-non-zts-20131226')
+        os.makedirs(extDir)
+        for name in ('bz2.so', 'mysqli.so'):
+            with open(os.path.join(extDir, name), 'wt') as f:
+                f.write(name)
+        with tarfile.open(archive, 'w:gz') as tar:
+            tar.add(os.path.join(src, 'php-5.6.30'), 'php-5.6.30')
+        shutil.rmtree(src)
+        with open(archive, 'rb') as f:
+            md5 = hashlib.md5(f.read()).hexdigest()
+        path = os.path.join(self.bp_dir, 'manifest.yml')
+        with open(path, 'rt') as f:
+            manifest = f.read()
+        with open(path, 'wt') as f:
+            f.write(manifest[:manifest.index('md5:')] + 'md5: %s\n' % md5)
+
+    def test_installs_requested_extensions(self):
+        self._add_extensions()
+        ctx = {
+            'BP_DIR': self.bp_dir,
+            'TMPDIR': self.tmp_dir,
+            'BUILD_DIR': self.build_dir,
+            'CACHE_DIR': os.path.join(self.tmp_dir, 'cache'),
+            'TREE_CACHE_SIZE_MB': 1,
+            'PREFETCH_PARALLELISM': 0
+        }
+        include = MemberFilter('lib/php/extensions/no-debug-non-zts-*',
+                               ['bz2.so'])
+        extDir = os.path.join('lib', 'php', 'extensions',
+                              'no-debug-non-zts-20131226')
+        for name in ('php', 'restaged'):
+            installDir = os.path.join(self.build_dir, name)
+            index = []
+            CloudFoundryInstaller(ctx)._install_binary_from_manifest(
+                '/php/5.6.30/php-5.6.30.tgz', installDir, strip=True,
+                include=include, index=index)
+            eq_(['bz2.so'], os.listdir(os.path.join(installDir, extDir)))
+            eq_('php', open(os.path.join(installDir, 'bin', 'php')).read())
+            eq_(True, '%s/mysqli.so' % extDir in index)
+
+    def test_checks_md5_while_downloading(self):
+        path = os.path.join(self.bp_dir, 'manifest.yml')
+        with open(path, 'rt') as f:
+            manifest = f.read()
+        with open(path, 'wt') as f:
+            f.write(manifest[:manifest.index('md5:')] + 'md5: 0123\n')
+        installer = CloudFoundryInstaller({
+            'BP_DIR': self.bp_dir,
+            'TMPDIR': self.tmp_dir,
+            'BUILD_DIR': self.build_dir,
+            'PREFETCH_PARALLELISM': 0,
+            'DOWNLOAD_EXTRACT_PIPELINE': True
+        })
+        try:
+            installer._install_binary_from_manifest(
+                '/php/5.6.30/php-5.6.30.tgz',
+                os.path.join(self.build_dir, 'php'), strip=True)
+        except RuntimeError, e:
+            eq_('MD5 of downloaded dependency does not match expected value',
+                str(e))
+        else:
+            assert False, 'expected RuntimeError'
+        # it was extracted while downloading, none of it is kept
+        eq_([], os.listdir(self.build_dir))
+        eq_([], os.listdir(self.tmp_dir))
+
+    def _add_sha256(self, sha256):
+        with open(os.path.join(self.bp_dir, 'manifest.yml'), 'at') as f:
+            f.write('  sha256: %s\n' % sha256)
+
+    def test_records_verified_digests(self):
+        self._add_sha256(self.sha256)
+        cache_dir = os.path.join(self.tmp_dir, 'cache')
+        installer = CloudFoundryInstaller({
+            'BP_DIR': self.bp_dir,
+            'TMPDIR': self.tmp_dir,
+            'BUILD_DIR': self.build_dir,
+            'CACHE_DIR': cache_dir,
+            'DOWNLOAD_CACHE_SIZE_MB': 1,
+            'PREFETCH_PARALLELISM': 0
+        })
+        installer._install_binary_from_manifest(
+            '/php/5.6.30/php-5.6.30.tgz', os.path.join(self.build_dir, 'php'),
+            strip=True)
+        digests = [installer._cache.digests(name)
+                   for name in os.listdir(os.path.join(cache_dir, 'downloads'))
+                   if not name.endswith('.digests')]
+        eq_(1, len(digests))
+        eq_(['md5', 'sha256'], sorted(digests[0].keys()))
+        eq_(self.sha256, digests[0]['sha256'])
+
+    def test_sha256_mismatch(self):
+        self._add_sha256('f' * 64)
+        installer = CloudFoundryInstaller({
+            'BP_DIR': self.bp_dir,
+            'TMPDIR': self.tmp_dir,
+            'BUILD_DIR': self.build_dir,
+            'PREFETCH_PARALLELISM': 0
+        })
+        try:
+            installer._install_binary_from_manifest(
+                '/php/5.6.30/php-5.6.30.tgz',
+                os.path.join(self.build_dir, 'php'), strip=True)
+        except RuntimeError, e:
+            eq_('SHA256 of downloaded dependency does not match expected '
+                'value', str(e))
+        else:
+            assert False, 'expected RuntimeError'
+        eq_([], os.listdir(self.tmp_dir))
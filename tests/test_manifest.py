@@ -0,0 +1,186 @@
+import os
+import shutil
+import tempfile
+from datetime import date
+from nose.tools import eq_
+from build_pack_utils.manifest import Manifest
+from build_pack_utils.manifest import ManifestIndex
+from build_pack_utils.manifest import ManifestError
+from build_pack_utils.compile_extensions import CompileExtensions
+
+
+MANIFEST = '''\
+---
+language: php
+default_versions:
+- name: php
+  version: 5.6.30
+url_to_dependency_map:
+- match: "([^\\\\/]*)-(\\\\d+\\\\.\\\\d+\\\\.\\\\d+)"
+  name: "$1"
+  version: "$2"
+dependency_deprecation_dates:
+- match: 5.6.\\d+
+  version_line: '5.6'
+  name: php
+  date: 2018-12-31
+dependencies:
+- name: php
+  version: 5.6.29
+  uri: https://buildpacks.cloudfoundry.org/dependencies/php/php-5.6.29.tgz
+  md5: 5f2a5b8b8d7d4e5fb6b1b0dbd0a9c1f6
+- name: php
+  version: 5.6.30
+  uri: https://buildpacks.cloudfoundry.org/dependencies/php/php-5.6.30.tgz
+  cf_stacks:
+  - cflinuxfs2
+  md5: 0d61e8bb1a8e5a5e3d1c2a7e6e0c5f95
+'''
+
+
+class TestManifest(object):
+    def setUp(self):
+        self.bp_dir = tempfile.mkdtemp(prefix='bp-')
+        self.path = os.path.join(self.bp_dir, 'manifest.yml')
+        with open(self.path, 'wt') as f:
+            f.write(MANIFEST)
+
+    def tearDown(self):
+        shutil.rmtree(self.bp_dir)
+
+    def test_default_version(self):
+        manifest = Manifest.load(self.path, stack='cflinuxfs2')
+        eq_('5.6.30', manifest.default_version_for('php'))
+        eq_(True, manifest is Manifest.load(self.path, stack='cflinuxfs2'))
+        try:
+            Manifest.load(self.path, stack='other').default_version_for('php')
+        except ManifestError:
+            pass
+        else:
+            assert False, 'expected ManifestError'
+
+    def test_translate_url(self):
+        manifest = Manifest.load(self.path, stack='cflinuxfs2')
+        eq_('https://buildpacks.cloudfoundry.org/dependencies/php/'
+            'php-5.6.29.tgz',
+            manifest.translate_url('/php/5.6.29/php-5.6.29.tar.gz'))
+        os.makedirs(os.path.join(self.bp_dir, 'dependencies'))
+        eq_('file://%s/dependencies/https___buildpacks.cloudfoundry.org_'
+            'dependencies_php_php-5.6.29.tgz' % self.bp_dir,
+            manifest.translate_url('/php/5.6.29/php-5.6.29.tar.gz'))
+        try:
+            manifest.translate_url('/php/5.6.1/php-5.6.1.tar.gz')
+        except ManifestError:
+            pass
+        else:
+            assert False, 'expected ManifestError'
+
+    def test_warnings(self):
+        manifest = Manifest.load(self.path, stack='cflinuxfs2')
+        url = '/php/5.6.29/php-5.6.29.tar.gz'
+        eq_(True, 'use version 5.6.30 instead of version 5.6.29' in
+            manifest.newer_patch_warning(url))
+        eq_('', manifest.newer_patch_warning('/php/5.6.30/php-5.6.30.tgz'))
+        eq_('', manifest.deprecation_warning(url, today=date(2018, 1, 1)))
+        eq_('**WARNING** php 5.6 will no longer be available in new '
+            'buildpacks released after 2018-12-31.',
+            manifest.deprecation_warning(url, today=date(2018, 12, 15)))
+
+
+class TestManifestIndex(object):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp(prefix='index-')
+        self.path = os.path.join(self.tmp_dir, 'manifest.yml')
+        self.cache_dir = os.path.join(self.tmp_dir, 'cache')
+        with open(self.path, 'wt') as f:
+            f.write(MANIFEST + '# %s\n' % self.tmp_dir)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_lookups(self):
+        index = ManifestIndex.load(self.path, self.cache_dir)
+        eq_(['5.6.29', '5.6.30'], index.versions_for('php'))
+        eq_([], index.versions_for('nginx'))
+        eq_('https://buildpacks.cloudfoundry.org/dependencies/php/'
+            'php-5.6.30.tgz', index.uri_for('php', '5.6.30'))
+        eq_(None, index.uri_for('php', '7.0.0'))
+        eq_('https://buildpacks.cloudfoundry.org/dependencies/php/'
+            'php-{version}.tgz', index.uri_template_for('php'))
+        eq_('5.6.30', index.default_version_for('php'))
+        eq_('2018-12-31',
+            index.manifest['dependency_deprecation_dates'][0]['date'])
+
+    def test_cached_by_hash(self):
+        index = ManifestIndex.load(self.path, self.cache_dir)
+        eq_(True, index is ManifestIndex.load(self.path))
+        cachePath = os.path.join(self.cache_dir,
+                                 'manifest-%s.json' % index.sha1)
+        eq_(True, os.path.exists(cachePath))
+        ManifestIndex._cache.clear()
+        eq_(['5.6.29', '5.6.30'],
+            ManifestIndex.load(self.path, self.cache_dir).versions_for('php'))
+
+
+class TestCompileExtensions(object):
+    def setUp(self):
+        self.bp_dir = tempfile.mkdtemp(prefix='bp-')
+        self.bin_dir = os.path.join(self.bp_dir, 'compile-extensions', 'bin')
+        os.makedirs(self.bin_dir)
+        script = os.path.join(self.bin_dir, 'default_version_for')
+        with open(script, 'wt') as f:
+            f.write('#!/bin/sh\n'
+                    'seq 1 100000 >/dev/null\n'
+                    'echo "$2 from $1"\n'
+                    'test "$2" = php\n')
+        os.chmod(script, 0755)
+        with open(os.path.join(self.bp_dir, 'manifest.yml'), 'wt') as f:
+            f.write(MANIFEST)
+
+    def tearDown(self):
+        shutil.rmtree(self.bp_dir)
+
+    def test_query_with_scripts(self):
+        compile_exts = CompileExtensions(self.bp_dir, use_scripts=True)
+        eq_([(0, 'php from a.yml'), (1, 'nginx from b c.yml')],
+            compile_exts.query([('default_version_for', 'a.yml', 'php'),
+                                ('default_version_for', 'b c.yml', 'nginx')]))
+        eq_((0, 'php from a.yml'),
+            compile_exts.default_version_for('a.yml', 'php'))
+
+    def test_persistent(self):
+        with CompileExtensions(self.bp_dir, use_scripts=True,
+                               persistent=True) as compile_exts:
+            for i in range(3):
+                eq_((0, 'php from a.yml'),
+                    compile_exts.default_version_for('a.yml', 'php'))
+            helper = compile_exts._helper
+        eq_(None, helper._proc)
+
+    def test_query_in_process(self):
+        compile_exts = CompileExtensions(self.bp_dir, use_scripts=False)
+        manifest = os.path.join(self.bp_dir, 'manifest.yml')
+        eq_([(0, '5.6.30')],
+            compile_exts.query([('default_version_for', manifest, 'php')]))
+
+    def test_shares_index_in_cache_dir(self):
+        cache_dir = os.path.join(self.bp_dir, 'cache')
+        os.makedirs(cache_dir)
+        ctx = {'BP_DIR': self.bp_dir, 'CACHE_DIR': cache_dir}
+        manifest = os.path.join(self.bp_dir, 'manifest.yml')
+        ManifestIndex._cache.clear()
+        Manifest._cache.clear()
+        compile_exts = CompileExtensions.for_context(ctx, use_scripts=False)
+        eq_((0, '5.6.30'), compile_exts.default_version_for(manifest, 'php'))
+        eq_(1, len(os.listdir(os.path.join(cache_dir, 'manifest-index'))))
+        # another stager reads the index instead of parsing the yaml
+        ManifestIndex._cache.clear()
+        Manifest._cache.clear()
+        build = ManifestIndex.__dict__['build']
+        ManifestIndex.build = staticmethod(lambda *args: None)
+        try:
+            eq_([(0, '5.6.30')], CompileExtensions.for_context(
+                ctx, use_scripts=False).query(
+                    [('default_version_for', manifest, 'php')]))
+        finally:
+            ManifestIndex.build = build
@@ -0,0 +1,82 @@
+import time
+import threading
+import BaseHTTPServer
+import SocketServer
+from nose.tools import eq_
+from build_pack_utils.mirrors import MirrorRace
+from build_pack_utils.mirrors import parse_mirrors
+from build_pack_utils.resumable import ResumableDownload
+
+
+class SlowHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    def do_GET(self):
+        time.sleep(self.server.latency)
+        if self.server.missing:
+            self.send_error(404)
+            return
+        body = '%s %s' % (self.server.name, self.path)
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class ThreadedServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+
+class TestMirrorRace(object):
+    def setUp(self):
+        self.servers = {}
+        for name, latency, missing in (('upstream', 0.5, False),
+                                       ('near', 0.0, False),
+                                       ('far', 0.3, False),
+                                       ('broken', 0.0, True)):
+            server = ThreadedServer(('127.0.0.1', 0), SlowHandler)
+            server.name = name
+            server.latency = latency
+            server.missing = missing
+            thread = threading.Thread(target=server.serve_forever,
+                                      args=(0.05,))
+            thread.daemon = True
+            thread.start()
+            self.servers[name] = server
+
+    def tearDown(self):
+        for server in self.servers.values():
+            server.shutdown()
+            server.server_close()
+
+    def _url(self, name):
+        return 'http://127.0.0.1:%d' % self.servers[name].server_port
+
+    def test_urls_for(self):
+        race = MirrorRace(parse_mirrors('http://proxy.local/, '
+                                        'https://buildpacks.example.com'),
+                          'https://buildpacks.example.com')
+        eq_(['http://proxy.local/php/php.tgz',
+             'https://buildpacks.example.com/php/php.tgz'],
+            race.urls_for('https://buildpacks.example.com/php/php.tgz'))
+        eq_(['https://getcomposer.org/composer.phar'],
+            race.urls_for('https://getcomposer.org/composer.phar'))
+
+    def test_fastest_wins(self):
+        race = MirrorRace([self._url('far'), self._url('near')],
+                          self._url('upstream'), race=3)
+        eq_('near /php.tgz', ResumableDownload(
+            self._url('upstream') + '/php.tgz', opener=race.open).read())
+        time.sleep(0.7)
+        stats = race.stats()
+        eq_(1, stats[self._url('near')[7:]]['won'])
+        eq_(1, stats[self._url('far')[7:]]['lost'])
+        eq_(1, stats[self._url('upstream')[7:]]['lost'])
+
+    def test_fails_over(self):
+        race = MirrorRace([self._url('broken'), self._url('broken')],
+                          self._url('far'), race=1)
+        eq_('far /php.tgz', ResumableDownload(
+            self._url('far') + '/php.tgz', opener=race.open).read())
+        eq_(1, race.stats()[self._url('broken')[7:]]['failed'])
@@ -0,0 +1,55 @@
+import os
+import json
+import shutil
+import tempfile
+from nose.tools import eq_
+from build_pack_utils import StagingProfiler
+
+
+class TestStagingProfiler(object):
+    def setUp(self):
+        self.build_dir = tempfile.mkdtemp(prefix='build-')
+
+    def tearDown(self):
+        if os.path.exists(self.build_dir):
+            shutil.rmtree(self.build_dir)
+
+    def test_nested_stages(self):
+        profiler = StagingProfiler()
+        install = profiler.start('install')
+        with profiler.measure('compile:php'):
+            pass
+        profiler.stop(install)
+        stages = profiler.spans()
+        eq_(2, len(stages))
+        eq_('install', stages[0]['name'])
+        eq_(None, stages[0]['parent'])
+        eq_('compile:php', stages[1]['name'])
+        eq_('install', stages[1]['parent'])
+        for key in ('wall_time', 'cpu_time', 'child_time'):
+            eq_(True, stages[0][key] >= 0)
+
+    def test_stop_closes_open_children(self):
+        profiler = StagingProfiler()
+        install = profiler.start('install')
+        profiler.start('copy')
+        profiler.stop(install)
+        eq_(['install', 'copy'],
+            [stage['name'] for stage in profiler.spans()])
+        eq_(None, profiler.start('configure').parent)
+
+    def test_write(self):
+        profiler = StagingProfiler()
+        with profiler.measure('configure'):
+            pass
+        path = os.path.join(self.build_dir, '.bp', 'logs',
+                            'staging-profile.json')
+        profiler.write(path)
+        data = json.load(open(path))
+        eq_(1, len(data['stages']))
+        eq_('configure', data['stages'][0]['name'])
+        eq_(True, 'wall_time' in data['total'])
+        summary = profiler.summary().split('\n')
+        eq_(3, len(summary))
+        eq_(True, summary[1].startswith('configure'))
+        eq_(True, summary[2].startswith('total'))
@@ -0,0 +1,99 @@
+import os
+import shutil
+import tempfile
+import threading
+import BaseHTTPServer
+from nose.tools import eq_
+from build_pack_utils.resumable import ResumableDownload
+
+
+BODY = ''.join(chr(i % 256) for i in range(100000))
+
+
+class FlakyHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Fails the way `self.server.plan` says, one step per request"""
+
+    def do_GET(self):
+        step = self.server.plan.pop(0) if self.server.plan else 'ok'
+        self.server.ranges.append(self.headers.getheader('Range'))
+        if step == 'error':
+            self.send_error(503)
+            return
+        if step == 'missing':
+            self.send_error(404)
+            return
+        start = 0
+        rng = self.headers.getheader('Range')
+        if rng and step != 'ignore-range':
+            start = int(rng.split('=')[1].rstrip('-'))
+            self.send_response(206)
+        else:
+            self.send_response(200)
+        self.send_header('Content-Length', str(len(BODY) - start))
+        self.end_headers()
+        if step == 'truncate':
+            self.wfile.write(BODY[start:start + 30000])
+        else:
+            self.wfile.write(BODY[start:])
+
+    def log_message(self, *args):
+        pass
+
+
+class TestResumableDownload(object):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp(prefix='resumable-')
+        self.server = BaseHTTPServer.HTTPServer(('127.0.0.1', 0),
+                                                FlakyHandler)
+        self.server.plan = []
+        self.server.ranges = []
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        self.url = 'http://127.0.0.1:%d/php.tgz' % self.server.server_port
+        self.delays = []
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.tmp_dir)
+
+    def _download(self, retries=3):
+        return ResumableDownload(self.url, retries=retries, backoff=0.1,
+                                 chunk_size=4096, sleep=self.delays.append)
+
+    def test_resumes_after_errors(self):
+        self.server.plan = ['error', 'truncate', 'truncate', 'ok']
+        path = os.path.join(self.tmp_dir, 'php.tgz')
+        metrics = self._download().to_file(path)
+        eq_(BODY, open(path, 'rb').read())
+        eq_([None, None, 'bytes=30000-', 'bytes=60000-'], self.server.ranges)
+        eq_([0.1, 0.2, 0.4], self.delays)
+        eq_(3, metrics['retries'])
+        eq_(len(BODY), metrics['bytes'])
+        eq_(True, metrics['time_to_first_byte'] >= 0)
+
+    def test_restarts_when_range_is_ignored(self):
+        self.server.plan = ['truncate', 'ignore-range']
+        eq_(BODY, self._download().read())
+        eq_(1, len(self.delays))
+
+    def test_gives_up(self):
+        self.server.plan = ['error', 'error', 'error']
+        try:
+            self._download(retries=2).read()
+        except IOError, e:
+            eq_(503, e.code)
+        else:
+            assert False, 'expected IOError'
+        eq_([0.1, 0.2], self.delays)
+
+    def test_does_not_retry_client_errors(self):
+        self.server.plan = ['missing']
+        try:
+            self._download().read()
+        except IOError, e:
+            eq_(404, e.code)
+        else:
+            assert False, 'expected IOError'
+        eq_([], self.delays)
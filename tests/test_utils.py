@@ -0,0 +1,176 @@
+import os
+import sys
+import shutil
+import tempfile
+import threading
+from nose.tools import eq_
+from build_pack_utils import utils
+
+
+class TestExtensionRegistry(object):
+    def setUp(self):
+        self.extns_dir = tempfile.mkdtemp(prefix='extns-')
+        self.path = os.path.join(self.extns_dir, 'registry_extn')
+        os.makedirs(self.path)
+        with open(os.path.join(self.path, 'extension.py'), 'wt') as f:
+            f.write("def configure(ctx):\n"
+                    "    ctx['CONFIGURED'] = True\n"
+                    "\n"
+                    "def service_commands(ctx):\n"
+                    "    return {'app': ('run',)}\n")
+
+    def tearDown(self):
+        shutil.rmtree(self.extns_dir)
+        sys.modules.pop('registry_extn.extension', None)
+        sys.modules.pop('registry_extn', None)
+
+    def test_loads_once(self):
+        registry = utils.ExtensionRegistry()
+        registry.register(self.path).register(self.path)
+        eq_([self.path], registry.paths())
+        ctx = {'EXTENSIONS': [self.path]}
+        results = []
+        registry.call(self.path, ctx, 'configure', results.append)
+        registry.call(self.path, ctx, 'service_commands', results.append)
+        registry.call(self.path, ctx, 'compile', results.append)
+        eq_([None, {'app': ('run',)}], results)
+        eq_(True, ctx['CONFIGURED'])
+        eq_(True, registry.load(self.path) is registry.load(self.path))
+        timings = registry.timings()[self.path]
+        eq_(True, timings['load_time'] >= 0)
+        eq_(['configure', 'service_commands'],
+            sorted(timings['calls'].keys()))
+        eq_(1, timings['calls']['configure']['count'])
+
+    def test_ignore_errors(self):
+        registry = utils.ExtensionRegistry()
+
+        def fail(val):
+            raise ValueError('failed')
+        registry.call(self.path, {}, 'configure', fail, ignore=True)
+        try:
+            registry.call(self.path, {}, 'configure', fail)
+        except ValueError:
+            pass
+        else:
+            assert False, 'expected ValueError'
+
+
+class TestMaterializer(object):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp(prefix='materialize-')
+        self.src = os.path.join(self.tmp_dir, 'src')
+        os.makedirs(os.path.join(self.src, 'conf'))
+        with open(os.path.join(self.src, 'conf', 'app.conf'), 'wt') as f:
+            f.write('home=#{HOME}\n')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_copy(self):
+        dst = os.path.join(self.tmp_dir, 'dst')
+        materialize = utils.Materializer('copy')
+        utils.copytree(self.src, dst, copy_function=materialize)
+        eq_(1, os.stat(os.path.join(dst, 'conf', 'app.conf')).st_nlink)
+        eq_({'reflink': 0, 'hardlink': 0, 'copy': 1}, materialize.counts)
+
+    def test_link_and_rewrite(self):
+        dst = os.path.join(self.tmp_dir, 'dst')
+        materialize = utils.Materializer('link')
+        utils.copytree(self.src, dst, copy_function=materialize)
+        eq_(1, materialize.counts['reflink'] + materialize.counts['hardlink'])
+        cfgPath = os.path.join(dst, 'conf', 'app.conf')
+        utils.rewrite_cfgs(cfgPath, {'HOME': '/home/vcap'})
+        eq_('home=/home/vcap\n', open(cfgPath).read())
+        eq_('home=#{HOME}\n',
+            open(os.path.join(self.src, 'conf', 'app.conf')).read())
+
+    def test_clone(self):
+        dst = os.path.join(self.tmp_dir, 'dst')
+        materialize = utils.Materializer('clone')
+        utils.copytree(self.src, dst, copy_function=materialize)
+        eq_(1, os.stat(os.path.join(dst, 'conf', 'app.conf')).st_nlink)
+        eq_(0, materialize.counts['hardlink'])
+
+    def test_unknown_strategy(self):
+        try:
+            utils.Materializer('symlink')
+        except ValueError:
+            pass
+        else:
+            assert False, 'expected ValueError'
+
+
+class TestFormattedDict(object):
+    def test_cached_until_changed(self):
+        ctx = utils.FormattedDict({
+            'BUILD_DIR': '/tmp/app',
+            'LIBDIR': 'lib',
+            'VENDOR_DIR': '{BUILD_DIR}/{LIBDIR}/vendor',
+            'PHP_VERSION': '5.6.30'
+        })
+        eq_('/tmp/app/lib/vendor', ctx['VENDOR_DIR'])
+        eq_('/tmp/app/lib/vendor', ctx.format('{VENDOR_DIR}'))
+        ctx['LIBDIR'] = 'libs'
+        eq_('/tmp/app/libs/vendor', ctx['VENDOR_DIR'])
+        ctx.update(BUILD_DIR='/home/vcap/app')
+        eq_('/home/vcap/app/libs/vendor', ctx.format('{VENDOR_DIR}'))
+        ctx['PHP_VERSION'] = '7.0.15'
+        eq_('/home/vcap/app/libs/vendor', ctx._cache[(str, '{VENDOR_DIR}')])
+
+    def test_mutable_values_are_not_cached(self):
+        ctx = utils.FormattedDict({
+            'PHP_EXTENSIONS': ['bz2'],
+            'EXTNS': 'extns {PHP_EXTENSIONS}'
+        })
+        eq_("extns ['bz2']", ctx['EXTNS'])
+        ctx['PHP_EXTENSIONS'].append('zlib')
+        eq_("extns ['bz2', 'zlib']", ctx['EXTNS'])
+
+    def test_not_cached_when_changed_while_formatting(self):
+        resolving = threading.Event()
+        changed = threading.Event()
+
+        class SlowDict(utils.FormattedDict):
+            def _resolve(self, val):
+                resolved = utils.FormattedDict._resolve(self, val)
+                if not resolving.isSet():
+                    resolving.set()
+                    changed.wait(5)
+                return resolved
+        ctx = SlowDict({'X': 'old', 'Y': '{X}/y'})
+        results = []
+        thread = threading.Thread(target=lambda: results.append(ctx['Y']))
+        thread.start()
+        resolving.wait(5)
+        ctx['X'] = 'new'
+        changed.set()
+        thread.join(5)
+        eq_(['old/y'], results)
+        eq_('new/y', ctx['Y'])
+        eq_('new/y', ctx['Y'])
+
+    def test_missing_key(self):
+        ctx = utils.FormattedDict({'URL': '{HOST}/php'})
+        try:
+            ctx['URL']
+        except KeyError, e:
+            eq_('HOST', e.args[0])
+        else:
+            assert False, 'expected KeyError'
+        ctx['HOST'] = 'http://localhost'
+        eq_('http://localhost/php', ctx['URL'])
+
+    def test_journal(self):
+        ctx = utils.FormattedDict({'LIBDIR': 'lib'})
+        ctx.journal = utils.ContextJournal()
+        ctx['LIBDIR'] = 'libs'
+        ctx.update(WEBDIR='htdocs')
+        del ctx['LIBDIR']
+        entries = ctx.journal.entries()
+        eq_([('set', 'LIBDIR', 'lib', 'libs'),
+             ('set', 'WEBDIR', None, 'htdocs'),
+             ('delete', 'LIBDIR', 'libs', None)],
+            [(e['action'], e['key'], e['old'], e['new']) for e in entries])
+        eq_(['test_journal'] * 3, [e['function'] for e in entries])
+        eq_(__file__.rstrip('c'), entries[0]['file'].rstrip('c'))
@@ -0,0 +1,97 @@
+import os
+import time
+import shutil
+import tempfile
+import threading
+from nose.tools import eq_
+from nose.tools import raises
+from build_pack_utils import utils
+from build_pack_utils.workers import WorkerPool
+from build_pack_utils.workers import run_with_dependencies
+
+
+class TestWorkerPool(object):
+    def test_inline_pool(self):
+        pool = WorkerPool(1)
+        names = []
+        task = pool.submit(lambda: names.append(
+            threading.current_thread().name))
+        eq_(True, task.done())
+        eq_([threading.current_thread().name], names)
+
+    def test_map(self):
+        with WorkerPool(3) as pool:
+            eq_([1, 4, 9], pool.map(lambda x: x * x, [1, 2, 3]))
+
+    @raises(ValueError)
+    def test_wait_raises_error(self):
+        def fail():
+            raise ValueError('failed')
+        with WorkerPool(2) as pool:
+            pool.submit(fail).wait()
+
+
+class TestRunWithDependencies(object):
+    def test_runs_in_dependency_order(self):
+        order = []
+        lock = threading.Lock()
+
+        def run(item):
+            time.sleep((item == 'a') and 0.1 or 0)
+            with lock:
+                order.append(item)
+            return item.upper()
+        with WorkerPool(4) as pool:
+            results = run_with_dependencies(
+                pool, ['a', 'b', 'c'], {2: set([0])}, run)
+        eq_(['A', 'B', 'C'], results)
+        eq_(['b', 'a', 'c'], order)
+
+    def test_stops_after_failure(self):
+        ran = []
+
+        def run(item):
+            ran.append(item)
+            if item == 'a':
+                raise RuntimeError('Extension Failed with [1]')
+        try:
+            run_with_dependencies(WorkerPool(1), ['a', 'b'],
+                                  {1: set([0])}, run)
+        except RuntimeError, e:
+            eq_('Extension Failed with [1]', str(e))
+        else:
+            assert False, 'expected RuntimeError'
+        eq_(['a'], ran)
+
+
+class TestFindExtensionDependencies(object):
+    def setUp(self):
+        self.extns_dir = tempfile.mkdtemp(prefix='extns-')
+
+    def tearDown(self):
+        shutil.rmtree(self.extns_dir)
+
+    def _extension(self, name, body):
+        path = os.path.join(self.extns_dir, name)
+        os.makedirs(path)
+        with open(os.path.join(path, 'extension.py'), 'wt') as f:
+            f.write(body)
+        return path
+
+    def test_dependencies(self):
+        paths = [
+            self._extension('wdeps_web', "PROVIDES = ('web-server',)\n"),
+            self._extension('wdeps_php', "PROVIDES = ('php', 'php.ini')\n"),
+            self._extension('wdeps_agent', "REQUIRES = ('php.ini',)\n"
+                                           "PROVIDES = ('php.ini',)\n"),
+            self._extension('wdeps_tool', "REQUIRES = ('php',)\n"),
+            self._extension('wdeps_user', "\n"),
+            self._extension('wdeps_last', "PROVIDES = ()\n")
+        ]
+        deps = utils.find_extension_dependencies(paths)
+        eq_(set(), deps[0])
+        eq_(set(), deps[1])
+        eq_(set([1]), deps[2])
+        eq_(set([1]), deps[3])
+        eq_(set([0, 1, 2, 3]), deps[4])
+        eq_(set([4]), deps[5])
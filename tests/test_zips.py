@@ -0,0 +1,192 @@
+import os
+import stat
+import shutil
+import tarfile
+import zipfile
+import tempfile
+from StringIO import StringIO
+from nose.tools import eq_
+from build_pack_utils.zips import UnzipUtil
+from build_pack_utils.zips import MemberFilter
+
+
+def _add(tar, name, data=None, mode=0644, type=tarfile.REGTYPE,
+         linkname=''):
+    info = tarfile.TarInfo(name)
+    info.type = type
+    info.mode = mode
+    info.linkname = linkname
+    if data is not None:
+        info.size = len(data)
+        tar.addfile(info, StringIO(data))
+    else:
+        tar.addfile(info)
+
+
+class TestNativeTarExtraction(object):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp(prefix='zips-')
+        self.into = os.path.join(self.tmp, 'into')
+        self.util = UnzipUtil({})
+
+    def tearDown(self):
+        for root, dirs, files in os.walk(self.tmp):
+            for name in dirs:
+                os.chmod(os.path.join(root, name), 0755)
+        shutil.rmtree(self.tmp)
+
+    def _archive(self, name, build, mode='w:gz'):
+        path = os.path.join(self.tmp, name)
+        tar = tarfile.open(path, mode)
+        build(tar)
+        tar.close()
+        return path
+
+    def _package(self, tar):
+        _add(tar, 'pkg', mode=0555, type=tarfile.DIRTYPE)
+        _add(tar, 'pkg/bin', type=tarfile.DIRTYPE, mode=0555)
+        _add(tar, 'pkg/bin/tool', '#!/bin/sh\n', mode=0755)
+        _add(tar, 'pkg/README', 'readme')
+        _add(tar, 'pkg/bin/alias', type=tarfile.SYMTYPE, linkname='tool')
+        _add(tar, 'pkg/COPY', type=tarfile.LNKTYPE, linkname='pkg/README')
+
+    def test_extract_strip(self):
+        path = self._archive('pkg.tar.gz', self._package)
+        self.util.extract(path, self.into, strip=True)
+        eq_('readme', open(os.path.join(self.into, 'README')).read())
+        eq_('readme', open(os.path.join(self.into, 'COPY')).read())
+        eq_('tool', os.readlink(os.path.join(self.into, 'bin', 'alias')))
+        eq_(0755, stat.S_IMODE(
+            os.stat(os.path.join(self.into, 'bin', 'tool')).st_mode))
+        eq_(0555, stat.S_IMODE(
+            os.stat(os.path.join(self.into, 'bin')).st_mode))
+        stats = self.util.stats()
+        eq_(1, stats['archives'])
+        eq_(2, stats['files'])
+        eq_(len('#!/bin/sh\n') + len('readme'), stats['bytes'])
+        eq_(2, stats['links'])
+
+    def test_extract_bz2_without_strip(self):
+        path = self._archive('pkg.tar.bz2', self._package, 'w:bz2')
+        self.util.extract(path, self.into)
+        eq_('readme', open(os.path.join(self.into, 'pkg', 'README')).read())
+        eq_(0555, stat.S_IMODE(
+            os.stat(os.path.join(self.into, 'pkg')).st_mode))
+
+    def test_extract_skips_unsafe_members(self):
+        def build(tar):
+            _add(tar, 'pkg/../../escaped', 'bad')
+            _add(tar, 'pkg/link', type=tarfile.SYMTYPE, linkname='/tmp')
+            _add(tar, 'pkg/link/escaped', 'bad')
+            _add(tar, 'pkg/ok', 'good')
+        path = self._archive('unsafe.tgz', build)
+        self.util.extract(path, self.into, strip=True)
+        eq_(False, os.path.exists(os.path.join(self.tmp, 'escaped')))
+        eq_(False, os.path.exists('/tmp/escaped'))
+        eq_('good', open(os.path.join(self.into, 'ok')).read())
+        eq_(2, self.util.stats()['skipped'])
+
+    def test_extract_replaces_symlinks(self):
+        outside = os.path.join(self.tmp, 'outside')
+        open(outside, 'w').write('outside')
+        os.makedirs(self.into)
+        os.symlink(outside, os.path.join(self.into, 'README'))
+        path = self._archive('pkg.tgz', self._package)
+        self.util.extract(path, self.into, strip=True)
+        eq_('outside', open(outside).read())
+        eq_('readme', open(os.path.join(self.into, 'README')).read())
+
+    def test_extract_stream(self):
+        path = self._archive('pkg.tgz', self._package)
+        chunks = []
+        with open(path, 'rb') as stream:
+            self.util.extract_stream(stream, path, self.into, strip=True,
+                                     on_chunk=chunks.append)
+        eq_(open(path, 'rb').read(), ''.join(chunks))
+        eq_('readme', open(os.path.join(self.into, 'README')).read())
+
+    def test_extract_members(self):
+        path = self._archive('pkg.tgz', self._package)
+        index = []
+        self.util.extract(path, self.into, strip=True,
+                          include=MemberFilter('', ['COPY']), index=index)
+        # COPY is a link to README, which wasn't extracted
+        eq_(['bin'], os.listdir(self.into))
+        eq_(['bin/', 'bin/tool', 'README', 'bin/alias', 'COPY'], index)
+        eq_(2, self.util.stats()['filtered'])
+
+    def test_extract_cancelled(self):
+        path = self._archive('pkg.tgz', self._package)
+        self.util.cancel.set()
+        try:
+            self.util.extract(path, self.into, strip=True)
+        except RuntimeError, e:
+            assert 'cancelled' in str(e)
+        else:
+            assert False, 'expected RuntimeError'
+
+    def test_extract_corrupt(self):
+        path = os.path.join(self.tmp, 'corrupt.tgz')
+        open(path, 'wb').write('not a tarball')
+        try:
+            self.util.extract(path, self.into)
+        except RuntimeError, e:
+            assert 'failed' in str(e)
+        else:
+            assert False, 'expected RuntimeError'
+
+    def test_extract_shell(self):
+        path = self._archive('pkg.tgz', self._package)
+        util = UnzipUtil({'TAR_EXTRACTION': 'shell'})
+        util.extract(path, self.into, strip=True)
+        eq_('readme', open(os.path.join(self.into, 'README')).read())
+        eq_(0, util.stats()['archives'])
+
+
+class TestUnzip(object):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp(prefix='zips-')
+        self.into = os.path.join(self.tmp, 'into')
+        self.util = UnzipUtil({})
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def _archive(self, members):
+        path = os.path.join(self.tmp, 'app.zip')
+        zipOut = zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED)
+        for name, data in members:
+            zipOut.writestr(name, data)
+        zipOut.close()
+        return path
+
+    def test_unzip_strip(self):
+        path = self._archive([('app/', ''),
+                              ('app/index.php', 'index'),
+                              ('app/lib/util.php', 'util')])
+        self.util.extract(path, self.into, strip=True)
+        eq_(['index.php', 'lib'], sorted(os.listdir(self.into)))
+        eq_('util', open(os.path.join(self.into, 'lib', 'util.php')).read())
+        eq_([], [name for name in os.listdir(self.tmp)
+                 if name not in ('app.zip', 'into')])
+        stats = self.util.stats()
+        eq_(2, stats['files'])
+        eq_(len('index') + len('util'), stats['bytes'])
+
+    def test_unzip_does_not_need_strip(self):
+        path = self._archive([('index.php', 'index'),
+                              ('lib/util.php', 'util')])
+        self.util.extract(path, self.into, strip=True)
+        eq_(['index.php', 'lib'], sorted(os.listdir(self.into)))
+
+    def test_unzip_one_file_is_not_stripped(self):
+        path = self._archive([('index.php', 'index')])
+        self.util.extract(path, self.into, strip=True)
+        eq_('index', open(os.path.join(self.into, 'index.php')).read())
+
+    def test_unzip_without_strip(self):
+        path = self._archive([('app/index.php', 'index')])
+        self.util.extract(path, self.into)
+        eq_('index', open(os.path.join(self.into, 'app', 'index.php')).read())